@@ -1,6 +1,25 @@
+"""Build mypyc-compiled versions of integrations.py's hot modules.
+
+Run from the integrations directory:
+    python ../build/setup.py build_ext --inplace
+
+The compiled extension modules are written next to their sources and are
+imported in preference to them. If they aren't built (or are deleted),
+the pure-Python modules are used instead.
+"""
+
 from setuptools import setup
 from mypyc.build import mypycify
 
-setup(name='mypyc_output',
-      ext_modules=mypycify(['-h'], opt_level="3", debug_level="1"),
+HOT_MODULES = [
+    "utils/api_utils.py",
+    "interactive/pages.py",
+    "interactive/transform.py",
+]
+
+setup(
+    name="mypyc_output",
+    ext_modules=mypycify(
+        ["--explicit-package-bases"] + HOT_MODULES, opt_level="3", debug_level="1"
+    ),
 )
@@ -7,5 +7,73 @@ CREATE = "create"
 LIST = "list"
 DELETE = "delete"
 UPDATE = "update"
+EXPORT_METRICS = "export-metrics"
+EXPORT_CONFIG = "export-config"
+PLAN = "plan"
+REBALANCE = "rebalance"
+UPGRADE = "upgrade"
+ROLLBACK = "rollback"
+SNAPSHOT = "snapshot"
+
+# Modes which can be run against several Kibana clusters with --cluster.
+# list merges the clusters' integrations into one table itself.
+CLUSTER_MODES = (
+    CREATE,
+    DELETE,
+    UPDATE,
+    REBALANCE,
+    UPGRADE,
+    ROLLBACK,
+    SNAPSHOT,
+    EXPORT_CONFIG,
+)
 
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Package the integrations use, and the version created if Kibana doesn't
+# say which version is installed
+PACKAGE = "httpjson"
+PACKAGE_VERSION = "1.20.0"
+
+# Most integrations to upgrade in a single bulk request
+UPGRADE_CHUNK = 50
+
+# Times update re-fetches and re-applies edits to integrations which
+# someone else changed while they were being updated
+CONFLICT_RETRIES = 3
+
+# Number of HTTP requests to have in flight at once
+WORKERS = 8
+
+# Seconds to wait for each pmproxy probe during create --preflight
+PREFLIGHT_TIMEOUT = 2.0
+
+# Longest pmproxy fetch URL to create when packing groups together
+MAX_URL_LENGTH = 2048
+
+# What create can do with a group whose integration name is taken:
+# skip it, give it a free suffix, or merge it into the group taking it
+SKIP = "skip"
+SUFFIX = "suffix"
+MERGE = "merge"
+ON_COLLISION = (SKIP, SUFFIX, MERGE)
+
+# Seconds of pmproxy load simulated by plan --simulate
+SIMULATION_HORIZON = 60 * 60
+
+# Journals of the changes made by each run, for rollback
+JOURNAL_DIR = ROOT_DIR + "/config/journal"
+
+# Where snapshot save writes snapshots by default
+SNAPSHOT_DIR = ROOT_DIR + "/config/snapshots"
+
+# Median latency of each Kibana endpoint, measured by previous runs
+LATENCY_FILE = ROOT_DIR + "/config/latency.json"
+
+# Hashes of the API keys which Kibana accepted recently, and for how many
+# seconds they're trusted without checking again
+KEY_CACHE = ROOT_DIR + "/config/key-cache.json"
+KEY_CACHE_TTL = 5 * 60
+
+# Seconds for which metric names expanded by pmproxy are cached
+PMNS_TTL = 24 * 60 * 60
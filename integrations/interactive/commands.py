@@ -4,14 +4,19 @@
 import re
 from typing import Optional
 import time
-import json
 
-import requests
-
-from utils import api_utils
+from utils import api_utils, export_utils, journal, metric_utils
+from utils.dryrun_utils import DRY_RUN
+from utils.inventory import derived_fields
+from utils.journal import JOURNAL
 from interactive import renderer, pages
+from interactive.transform import snapshot, transform_body
+from utils.stats import STATS
 import constants
 
+VALID_METRICS = re.compile(r"(?:\w+(?:\.\w+)*,?)+")
+VALID_INTERVAL = re.compile(r"^[1-9][0-9]*[smh]$")
+
 
 class GenericCommandHandler:
     """Superclass for handlers in interactive mode."""
@@ -220,10 +225,15 @@ class UpdateHandler(GenericCommandHandler):
                 "added_metrics": None,  # Will be list
                 "removed_metrics": None,  # Will be list
             }
-            for name in name_map
-            if name in selected
+            for name in set(selected)
+            if name in name_map
         }
+        # Edits queued on each integration since it was last saved,
+        # so they can be re-applied if someone else changes it first
+        self.pending = {name: [] for name in self.edits}
+        self.originals = {}
         self.req_bodies = self.init_reqs()
+        self.body_index = {body["name"]: body for body in self.req_bodies}
         super().__init__(
             {
                 "e": self.enable,
@@ -243,51 +253,100 @@ class UpdateHandler(GenericCommandHandler):
 
     def init_reqs(self):
         """Create the lighter weight request bodies to be sent in requests."""
-        req_bodies = []
-        for integration in self.selected:
-            body = transform_body(self.name_map[integration])
+        return [self.init_body(integration) for integration in self.selected]
+
+    def init_body(self, integration):
+        """Create the request body of an integration from its package policy."""
+        url = re.compile(r"^(.*?)\/pmapi\/fetch\?hostspec=(.*?)&.*&names=(.*)$")
+        body = transform_body(self.name_map[integration])
+        for inp in body["inputs"]:
+            for stream in body["inputs"][inp]["streams"]:
+                match = url.match(
+                    body["inputs"][inp]["streams"][stream]["vars"]["request_url"]
+                )
+                body["hostname_"] = match.group(2)
+                body["pmproxy_url_"] = match.group(1)
+                body["metrics_"] = match.group(3)
+
+        self.originals[body["name"]] = snapshot(body)
+        body["metrics_"] = metric_utils.MetricSet(
+            body["metrics_"], self.allow_duplicates
+        )
+        return body
+
+    def queue(self, edit, value, names):
+        """Remember an edit to the named integrations until they're saved."""
+        for body in self.bodies(names):
+            self.pending[body["name"]].append((edit, value))
+
+    def bodies(self, names=None):
+        """Return the request bodies of the named integrations,
+        or of every selected integration if names is None."""
+        if names is None:
+            return self.req_bodies
+        return [self.body_index[name] for name in names if name in self.body_index]
+
+    def set_enabled(self, enabled: bool, names=None):
+        """Queue enabling or disabling integrations."""
+        self.queue("set_enabled", enabled, names)
+        for body in self.bodies(names):
             for inp in body["inputs"]:
+                # AFAIK they're always both True or False, never one and one
+                if body["inputs"][inp]["enabled"] != enabled:
+                    self.edits[body["name"]]["enabled"] = str(enabled)
+                    body["inputs"][inp]["enabled"] = enabled
                 for stream in body["inputs"][inp]["streams"]:
-                    url = re.compile(
-                        r"^(.*?)\/pmapi\/fetch\?hostspec=(.*?)&.*&names=(.*)$"
-                    )
-                    match = url.match(
-                        body["inputs"][inp]["streams"][stream]["vars"]["request_url"]
-                    )
-                    body["hostname_"] = match.group(2)
-                    body["pmproxy_url_"] = match.group(1)
-                    body["metrics_"] = match.group(3)
+                    body["inputs"][inp]["streams"][stream]["enabled"] = enabled
+        self.applied = False
+
+    def add_metric_list(self, metrics: list, names=None):
+        """Queue adding metrics to integrations."""
+        self.queue("add_metric_list", metrics, names)
+        for body in self.bodies(names):
+            body["metrics_"].add(metrics)
+            self.edits[body["name"]]["added_metrics"] = body["metrics_"].added
+        self.applied = False
+
+    def remove_metric_list(self, metrics: list, names=None):
+        """Queue removing metrics from integrations."""
+        self.queue("remove_metric_list", metrics, names)
+        for body in self.bodies(names):
+            body["metrics_"].remove(metrics)
+            self.edits[body["name"]]["removed_metrics"] = body["metrics_"].removed
+        self.applied = False
+
+    def set_interval(self, interval: str, names=None):
+        """Queue changing the request interval of integrations."""
+        self.queue("set_interval", interval, names)
+        for body in self.bodies(names):
+            for inp in body["inputs"]:
+                for stream in body["inputs"][inp]["streams"]:
+                    body["inputs"][inp]["streams"][stream]["vars"][
+                        "request_interval"
+                    ] = interval
 
-            req_bodies.append(body)
+                    self.edits[body["name"]]["interval"] = interval
+        self.applied = False
 
-        return req_bodies
+    def set_url(self, url: str, names=None):
+        """Queue changing the pmproxy URL of integrations."""
+        self.queue("set_url", url, names)
+        for body in self.bodies(names):
+            body["pmproxy_url_"] = url
+            self.edits[body["name"]]["url"] = url
+        self.applied = False
 
     def enable(self):
         """Enable selected integrations."""
         try:
-            for body in self.req_bodies:
-                for inp in body["inputs"]:
-                    # AFAIK they're always both True or False, never one and one
-                    if not body["inputs"][inp]["enabled"]:
-                        self.edits[body["name"]]["enabled"] = "True"
-                        body["inputs"][inp]["enabled"] = True
-                    for stream in body["inputs"][inp]["streams"]:
-                        body["inputs"][inp]["streams"][stream]["enabled"] = True
-            self.applied = False
+            self.set_enabled(True)
         except KeyError as e:
             print(e)
 
     def disable(self):
         """Disable selected integrations."""
         try:
-            for body in self.req_bodies:
-                for inp in body["inputs"]:
-                    if body["inputs"][inp]["enabled"]:
-                        self.edits[body["name"]]["enabled"] = "False"
-                        body["inputs"][inp]["enabled"] = False
-                    for stream in body["inputs"][inp]["streams"]:
-                        body["inputs"][inp]["streams"][stream]["enabled"] = False
-            self.applied = False
+            self.set_enabled(False)
         except KeyError as e:
             print(e)
 
@@ -340,47 +399,163 @@ class UpdateHandler(GenericCommandHandler):
 
         self.exit = True
 
-    def save(self):
-        """Send HTTP requests containing all specified updates."""
-        # TODO: Could probably be parallelized.
-        i = 1
-        bad_reqs = []
+    def changed(self, body):
+        """Check whether a request body differs from the fetched integration."""
+        if body["metrics_"].changed():
+            return True
+        original = self.originals[body["name"]]
+        return any(body[key] != original[key] for key in original)
+
+    def send_updates(self, workers: int = constants.WORKERS) -> dict:
+        """Concurrently send a PUT request for every changed integration.
+
+        Integrations whose bodies are unchanged since they were fetched
+        (or last saved) are skipped. Returns the names of the updated
+        and unchanged integrations, and a mapping of failed ones to errors.
+        """
+        result = {"updated": [], "unchanged": [], "failed": {}}
+        conflicts = self.send_bodies(self.req_bodies, result, workers)
+        for __ in range(constants.CONFLICT_RETRIES):
+            if not conflicts:
+                break
+            bodies = self.refetch(conflicts, result)
+            conflicts = self.send_bodies(bodies, result, workers)
+        for name in conflicts:
+            result["failed"][name] = "Changed by someone else while being updated"
+
         for body in self.req_bodies:
+            if body["name"] not in result["failed"]:
+                for k in self.edits[body["name"]]:
+                    self.edits[body["name"]][k] = None
+
+        return result
+
+    def send_bodies(self, bodies, result, workers):
+        """Concurrently send a PUT request for each changed body, adding
+        the outcomes to result. The policy's version is sent with each
+        one, so Kibana refuses it if the policy was changed since it was
+        fetched. Returns the names of the integrations it refused.
+        """
+        to_send = []
+        reqs = []
+        for body in bodies:
+            if not self.changed(body):
+                result["unchanged"].append(body["name"])
+                continue
+
             try:
-                print(
-                    f"Updating integration {i} of {len(self.req_bodies)} ({body['name']})."
-                )
-                i += 1
-                tmp = {
-                    "kibana_url": self.config["kibana"]["kibana_url"],
-                    "api_key": self.config["kibana"]["api_key"],
-                }
-                tmp.update(body)
-                req = api_utils.build_request(
-                    tmp, constants.UPDATE, id_=self.name_map[body["name"]]["id"]
+                with STATS.phase("request build"):
+                    tmp = {
+                        "kibana_url": self.config["kibana"]["kibana_url"],
+                        "api_key": self.config["kibana"]["api_key"],
+                    }
+                    # br_update rewrites the request URLs in place
+                    tmp.update(snapshot(body))
+                    tmp["metrics_"] = body["metrics_"].to_string()
+                    if self.name_map[body["name"]].get("version"):
+                        tmp["version"] = self.name_map[body["name"]]["version"]
+                    req = api_utils.build_request(
+                        tmp, constants.UPDATE, id_=self.name_map[body["name"]]["id"]
+                    )
+            except KeyError as e:
+                result["failed"][body["name"]] = repr(e)
+                continue
+            to_send.append(body)
+            reqs.append(req)
+
+        # Each policy is journaled before it's changed, so it can be put back
+        seqs = []
+        if not DRY_RUN.enabled:
+            seqs = [
+                JOURNAL.record(journal.PUT, self.name_map[body["name"]])
+                for body in to_send
+            ]
+
+        conflicts = []
+        responses = api_utils.request_many(reqs, constants.UPDATE, workers)
+        for i, (body, (item, error)) in enumerate(zip(to_send, responses)):
+            if seqs:
+                JOURNAL.resolve(
+                    seqs[i], self.name_map[body["name"]]["id"], error is None
                 )
-                api_utils.request(req, constants.UPDATE)
+            if error is not None:
+                response = getattr(error, "response", None)
+                if getattr(response, "status_code", None) == 409:
+                    conflicts.append(body["name"])
+                else:
+                    result["failed"][body["name"]] = str(error)
+                continue
+
+            body["metrics_"].commit()
+            self.originals[body["name"]] = snapshot(body)
+            self.pending[body["name"]] = []
+            # Later saves have to send the version the PUT created
+            if item and item.get("version"):
+                self.name_map[body["name"]]["version"] = item["version"]
+            result["updated"].append(body["name"])
+
+        return conflicts
+
+    def refetch(self, names, result):
+        """Fetch the current package policies of the named integrations
+        in one batch, and re-apply their queued edits on top of them.
+        Returns their new request bodies."""
+        ids = {self.name_map[name]["id"]: name for name in names}
+        fetched = {}
+        with STATS.phase("conflict refetch"):
+            for policy in api_utils.bulk_get(
+                self.config["kibana"]["api_key"],
+                self.config["kibana"]["kibana_url"],
+                ids,
+            ):
+                policy.update(derived_fields(policy))
+                fetched[ids[policy["id"]]] = policy
+
+        bodies = []
+        for name in names:
+            if name not in fetched:
+                result["failed"][name] = "Deleted by someone else while being updated"
+                continue
+            self.name_map[name] = fetched[name]
+            body = self.init_body(name)
+            self.req_bodies[self.req_bodies.index(self.body_index[name])] = body
+            self.body_index[name] = body
+
+            # Queueing the edits again rebuilds the list of pending edits
+            edits, self.pending[name] = self.pending[name], []
+            for edit, value in edits:
+                getattr(self, edit)(value, [name])
+            bodies.append(body)
+        return bodies
 
-                for k in self.edits[body["name"]].items():
-                    self.edits[body["name"]][k] = None
+    def save(self):
+        """Send HTTP requests containing all specified updates."""
+        print("Updating changed integrations...")
+        result = self.send_updates()
+        skipped = len(result["unchanged"])
 
-            except (KeyError, requests.exceptions.RequestException) as e:
-                print(e)
-                bad_reqs.append(body["name"])
+        print(f"Updated {len(result['updated'])} integration(s).")
+        print(
+            f"Skipped {skipped} unchanged integration(s),"
+            f" avoiding {skipped} PUT request(s)."
+        )
 
-        if bad_reqs:
+        if result["failed"]:
+            for error in result["failed"].values():
+                print(error)
             print(
-                "Updates for integrations " + str(bad_reqs) + " might have failed."
-                "You should ensure they are as you expect."
+                "Updates for integrations "
+                + str(sorted(result["failed"]))
+                + " might have failed."
+                " You should ensure they are as you expect."
             )
 
         self.applied = True
 
     def add_metrics(self):
         """Request and add a list of metrics to selected integrations."""
-        valid = re.compile(r"(?:\w+(?:\.\w+)*,?)+")
         metrics = input("\033[34mMetrics\033[0m>> ")
-        if not valid.match(metrics):
+        if not VALID_METRICS.match(metrics):
             print(
                 "Invalid metrics. Metrics should be characters separated by dots,"
                 " and you should give a comma-separated list of metrics."
@@ -388,27 +563,14 @@ class UpdateHandler(GenericCommandHandler):
             return
 
         try:
-            for body in self.req_bodies:
-                mlist = body["metrics_"].split(",")
-                to_add = metrics.split(",")
-                if not self.allow_duplicates:
-                    to_add = list(set(to_add).difference(mlist))
-
-                if self.edits[body["name"]]["added_metrics"] is None:
-                    self.edits[body["name"]]["added_metrics"] = []
-                self.edits[body["name"]]["added_metrics"].extend(to_add)
-
-                mlist.extend(to_add)
-                body["metrics_"] = ",".join(mlist)
-            self.applied = False
+            self.add_metric_list(metric_utils.split_metrics(metrics))
         except KeyError as e:
             print(e)
 
     def remove_metrics(self):
         """Request and remove a list of metrics to selected integrations."""
-        valid = re.compile(r"(?:\w+(?:\.\w+)*,?)+")
         metrics = input("\033[34mMetrics\033[0m>> ")
-        if not valid.match(metrics):
+        if not VALID_METRICS.match(metrics):
             print(
                 "Invalid metrics. Metrics should be characters separated by dots,"
                 " and you should give a comma-separated list of metrics."
@@ -416,26 +578,14 @@ class UpdateHandler(GenericCommandHandler):
             return
 
         try:
-            for body in self.req_bodies:
-                mlist = body["metrics_"].split(",")
-                to_remove = metrics.split(",")
-
-                actual = list(set(to_remove).intersection(mlist))
-                if self.edits[body["name"]]["removed_metrics"] is None:
-                    self.edits[body["name"]]["removed_metrics"] = []
-                self.edits[body["name"]]["removed_metrics"].extend(actual)
-
-                new_mlist = [metric for metric in mlist if metric not in to_remove]
-                body["metrics_"] = ",".join(new_mlist)
-            self.applied = False
+            self.remove_metric_list(metric_utils.split_metrics(metrics))
         except KeyError as e:
             print(e)
 
     def change_interval(self):
         """Request and change the interval for selected integrations."""
-        valid = re.compile(r"^[1-9][0-9]*[smh]$")
         new_interval = input("\033[34mInterval\033[0m>> ")
-        if not valid.match(new_interval):
+        if not VALID_INTERVAL.match(new_interval):
             print(
                 f"Interval {new_interval} is invalid."
                 " It must be in the format <number><unit>, where unit can be s, m, or h."
@@ -443,15 +593,7 @@ class UpdateHandler(GenericCommandHandler):
             return
 
         try:
-            for body in self.req_bodies:
-                for inp in body["inputs"]:
-                    for stream in body["inputs"][inp]["streams"]:
-                        body["inputs"][inp]["streams"][stream]["vars"][
-                            "request_interval"
-                        ] = new_interval
-
-                        self.edits[body["name"]]["interval"] = new_interval
-            self.applied = False
+            self.set_interval(new_interval)
         except KeyError as e:
             print(e)
 
@@ -460,10 +602,7 @@ class UpdateHandler(GenericCommandHandler):
         new_url = input("\033[34mpmproxy URL\033[0m>> ")
 
         try:
-            for body in self.req_bodies:
-                body["pmproxy_url_"] = new_url
-                self.edits[body["name"]]["url"] = new_url
-            self.applied = False
+            self.set_url(new_url)
         except KeyError as e:
             print(e)
 
@@ -544,57 +683,22 @@ class UpdateHandler(GenericCommandHandler):
             else:
                 print(
                     f"{f'{integration}: ':<25}{color_wrap('32', '+')}"
-                    f" {color_wrap('32', ','.join(self.edits[integration]['added_metrics']))}"
+                    f" {color_wrap('32', ','.join(self.edits[integration]['added_metrics'] or []))}"
                 )
                 print(
                     f"{'':<25}{color_wrap('31', '-')}"
-                    f" {color_wrap('31', ','.join(self.edits[integration]['removed_metrics']))}\n"
+                    f" {color_wrap('31', ','.join(self.edits[integration]['removed_metrics'] or []))}\n"
                 )
 
     def create_config(self):
         """Create a sample config file which could be used to create the selected integrations."""
-        nodes = []
-        targets = [
-            body for (name, body) in self.name_map.items() if name in self.selected
-        ]
-
-        while targets:
-            # targets may have multiple integrations for the same host.
-            # We handle this somewhat inefficiently, by iterating through
-            # all the targets for each hostname.
-            current = targets.pop(0)
-            groups = [
-                {
-                    "policy_id": current["policy_id"],
-                    "pmproxy_url": current["pmproxy_url_"],
-                    "interval": current["inputs"][0]["streams"][0]["vars"][
-                        "request_interval"
-                    ]["value"],
-                    "metrics": current["metrics_"],
-                }
-            ]
-
-            for index, body in enumerate(targets):
-                if body["hostname_"] == current["hostname_"]:
-                    groups.append(
-                        {
-                            "policy_id": body["policy_id"],
-                            "pmproxy_url": body["pmproxy_url_"],
-                            "interval": body["inputs"][0]["streams"][0]["vars"][
-                                "request_interval"
-                            ]["value"],
-                            "metrics": body["metrics_"],
-                        }
-                    )
-                    targets.pop(index)
-
-            nodes.append({"fqdn": current["hostname_"], "groups": groups})
-
+        selected = set(self.selected)
+        targets = (body for (name, body) in self.name_map.items() if name in selected)
         with open(
             constants.ROOT_DIR + "/config/sample_config.json", "w", encoding="utf-8"
         ) as sample:
-            json.dump({"nodes": nodes}, sample)
-            print("Wrote config to config/sample_config.json")
+            count = export_utils.write_config(export_utils.group_nodes(targets), sample)
+        print(f"Wrote config for {count} node(s) to config/sample_config.json")
 
     def update_help(self):
         """Print help text for the update commands."""
@@ -611,54 +715,3 @@ class UpdateHandler(GenericCommandHandler):
             "c - generate a config file for create mode"
             " corresponding to the selected integrations\n"
         )
-
-
-def transform_body(old_body: dict, extended: bool = False):
-    """Change the body of the GET response
-    to something that can be sent in the update PUT request.
-    """
-    if extended:
-        good_keys = [
-            "package",
-            "name",
-            "namespace",
-            "description",
-            "policy_id",
-            "vars",
-            "hostname_",
-            "pmproxy_url_",
-            "metrics_",
-        ]
-    else:
-        good_keys = ["package", "name", "namespace", "description", "policy_id", "vars"]
-    new_body = {key: old_body[key] for key in good_keys}
-
-    new_body["package"].pop("title", "")
-
-    # Transform inputs
-    inputs = old_body["inputs"]
-    transformed_inputs = {}
-
-    for input_item in inputs:
-        input_type = input_item["type"]
-        policy_template = input_item["policy_template"]
-        streams = input_item["streams"]
-
-        transformed_inputs[f"{policy_template}-{input_type}"] = {
-            "enabled": input_item["enabled"],
-            "streams": {},
-        }
-
-        for stream in streams:
-            stream_data_stream = stream["data_stream"]
-            stream_vars = stream["vars"]
-            stream_vars_transformed = {
-                k: v["value"] for k, v in stream_vars.items() if "value" in v
-            }
-
-            transformed_inputs[f"{policy_template}-{input_type}"]["streams"][
-                stream_data_stream["dataset"]
-            ] = {"enabled": stream["enabled"], "vars": stream_vars_transformed}
-
-    new_body["inputs"] = transformed_inputs
-    return new_body
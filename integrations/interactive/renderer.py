@@ -57,8 +57,9 @@ def update(selected, name_map, config, args):
     print("<3")
 
 
-def cli_driver(page_list, name_map, config, args):
-    """Drive progression of update mode."""
+def cli_driver(page_list, load_policies, config, args):
+    """Drive progression of update mode. load_policies maps the names
+    of the selected integrations to their package policies."""
     selected = selection(page_list)
     if not selected:
         print("Nothing selected, exiting...")
@@ -76,7 +77,7 @@ def cli_driver(page_list, name_map, config, args):
             print()  # Flush the buffer
             break
 
-    update(lselected, name_map, config, args)
+    update(lselected, load_policies(lselected), config, args)
 
 
 def key_names(name):
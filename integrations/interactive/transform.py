@@ -0,0 +1,63 @@
+"""Functions for transforming Fleet package policies into request bodies.
+
+This module is compiled with mypyc when building with build/setup.py,
+so it shouldn't depend on the rest of the interactive package.
+"""
+
+import copy
+
+
+def snapshot(body: dict):
+    """Deep copy a request body, leaving out its metrics."""
+    return copy.deepcopy({key: val for key, val in body.items() if key != "metrics_"})
+
+
+def transform_body(old_body: dict, extended: bool = False):
+    """Change the body of the GET response
+    to something that can be sent in the update PUT request.
+    """
+    if extended:
+        good_keys = [
+            "package",
+            "name",
+            "namespace",
+            "description",
+            "policy_id",
+            "vars",
+            "hostname_",
+            "pmproxy_url_",
+            "metrics_",
+        ]
+    else:
+        good_keys = ["package", "name", "namespace", "description", "policy_id", "vars"]
+    new_body = {key: old_body[key] for key in good_keys}
+
+    new_body["package"].pop("title", "")
+
+    # Transform inputs
+    inputs = old_body["inputs"]
+    transformed_inputs = {}
+
+    for input_item in inputs:
+        input_type = input_item["type"]
+        policy_template = input_item["policy_template"]
+        streams = input_item["streams"]
+
+        transformed_inputs[f"{policy_template}-{input_type}"] = {
+            "enabled": input_item["enabled"],
+            "streams": {},
+        }
+
+        for stream in streams:
+            stream_data_stream = stream["data_stream"]
+            stream_vars = stream["vars"]
+            stream_vars_transformed = {
+                k: v["value"] for k, v in stream_vars.items() if "value" in v
+            }
+
+            transformed_inputs[f"{policy_template}-{input_type}"]["streams"][
+                stream_data_stream["dataset"]
+            ] = {"enabled": stream["enabled"], "vars": stream_vars_transformed}
+
+    new_body["inputs"] = transformed_inputs
+    return new_body
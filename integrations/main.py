@@ -9,15 +9,29 @@ Usage details such as command-line arguments are in the README.
 """
 
 import argparse
+import importlib
 import sys
 
 import constants
-from modes import create, delete, ilist, update
 
 
 def build_parser(args=sys.argv[1:]):
     """Build the command-line argument parser."""
     parser = argparse.ArgumentParser("./integrations.py")
+    parser.add_argument(
+        "--stats",
+        help="Print a summary of request latencies and phase timings after running",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        help="Write the timing of every request and phase to a JSON file",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write Prometheus metrics about this run's requests"
+        " to a node_exporter textfile",
+    )
     subparsers = parser.add_subparsers(
         dest="command", help="Mode of operation for integrations.py."
     )
@@ -50,9 +64,68 @@ def build_parser(args=sys.argv[1:]):
         " Defaults to config/id-map.json",
         default=constants.ROOT_DIR + "/config/id-map.json",
     )
+    parser_create.add_argument(
+        "--expand-metrics",
+        help="Expand metric prefixes (e.g. kernel.all) into the names of the"
+        " metrics under them, by asking each group's pmproxy",
+        action="store_true",
+    )
+    parser_create.add_argument(
+        "--pmns-cache-ttl",
+        help="Seconds for which expanded metric names are cached"
+        " in config/pmns-cache.json. Defaults to a day",
+        type=int,
+        default=constants.PMNS_TTL,
+    )
+    parser_create.add_argument(
+        "-w",
+        "--workers",
+        help="Number of pmproxy requests to send concurrently with"
+        f" --expand-metrics or --preflight. Defaults to {constants.WORKERS}",
+        type=int,
+        default=constants.WORKERS,
+    )
+    parser_create.add_argument(
+        "--preflight",
+        help="Before creating anything, check that each pmproxy is reachable"
+        " and can fetch metrics from its hosts, and skip the groups which fail",
+        action="store_true",
+    )
+    parser_create.add_argument(
+        "--preflight-timeout",
+        help="Seconds to wait for each pmproxy probe."
+        f" Defaults to {constants.PREFLIGHT_TIMEOUT}",
+        type=float,
+        default=constants.PREFLIGHT_TIMEOUT,
+    )
+
+    parser_create.add_argument(
+        "--pack",
+        help="Merge the groups of each host which share an interval, pmproxy"
+        " and policy into a single integration",
+        action="store_true",
+    )
+    parser_create.add_argument(
+        "--on-collision",
+        help="What to do with a group whose integration name is already taken,"
+        " in Kibana or by another group: skip it, add a suffix to its name,"
+        " or merge its metrics into the other group where they share a pmproxy"
+        " and policy (suffixing it otherwise). Defaults to skip",
+        choices=constants.ON_COLLISION,
+        default=constants.SKIP,
+    )
+    add_max_url_length(parser_create)
+    add_stagger(parser_create)
+    add_pool(parser_create)
+    add_policy_pool(parser_create)
+    add_dry_run(parser_create)
+    add_cluster(parser_create)
 
     # Parser for list
-    subparsers.add_parser("list", help="List the currently existing integrations")
+    parser_list = subparsers.add_parser(
+        "list", help="List the currently existing integrations"
+    )
+    add_cluster(parser_list)
 
     # Parser for delete
     parser_delete = subparsers.add_parser("delete", help="Delete integrations")
@@ -90,6 +163,8 @@ def build_parser(args=sys.argv[1:]):
         " when deciding which integrations to delete",
         action="store_true",
     )
+    add_dry_run(parser_delete)
+    add_cluster(parser_delete)
 
     # Parser for update
     parser_update = subparsers.add_parser(
@@ -101,15 +176,348 @@ def build_parser(args=sys.argv[1:]):
         help="Tell integrations.py to allow adding duplicate metrics.",
         action="store_true",
     )
+    parser_update.add_argument(
+        "-f",
+        "--file",
+        help="Non-interactively apply the operations in a JSON batch file",
+    )
+    parser_update.add_argument(
+        "--select",
+        help="Non-interactively update the integrations with names matching"
+        " this regex, using the update options below",
+    )
+    parser_update.add_argument(
+        "--set",
+        help="Set a field on the selected integrations."
+        " Can be given multiple times.",
+        action="append",
+        default=[],
+        metavar="{interval,pmproxy_url}=VALUE",
+    )
+    parser_update.add_argument(
+        "--add-metrics",
+        help="Comma-separated list of metrics to add to the selected integrations",
+    )
+    parser_update.add_argument(
+        "--remove-metrics",
+        help="Comma-separated list of metrics to remove"
+        " from the selected integrations",
+    )
+    state_group = parser_update.add_mutually_exclusive_group()
+    state_group.add_argument(
+        "--enable",
+        help="Enable the selected integrations",
+        action="store_const",
+        const=True,
+        dest="enabled",
+    )
+    state_group.add_argument(
+        "--disable",
+        help="Disable the selected integrations",
+        action="store_const",
+        const=False,
+        dest="enabled",
+    )
+    parser_update.add_argument(
+        "-w",
+        "--workers",
+        help="Number of update requests to send concurrently."
+        f" Defaults to {constants.WORKERS}",
+        type=int,
+        default=constants.WORKERS,
+    )
+    add_dry_run(parser_update)
+    add_cluster(parser_update)
+
+    # Parser for export-metrics
+    parser_export_metrics = subparsers.add_parser(
+        "export-metrics",
+        help="Write Prometheus metrics about the existing integrations"
+        " to a node_exporter textfile",
+    )
+    parser_export_metrics.add_argument(
+        "-o",
+        "--out",
+        help="Path to the textfile. Defaults to config/integrations.prom",
+        default=constants.ROOT_DIR + "/config/integrations.prom",
+    )
+
+    # Parser for export-config
+    parser_export_config = subparsers.add_parser(
+        "export-config",
+        help="Write a create config which makes the existing integrations again",
+    )
+    parser_export_config.add_argument(
+        "-o",
+        "--out",
+        help="Path to write the config to, or - for stdout. Defaults to -",
+        default="-",
+    )
+    parser_export_config.add_argument(
+        "--select",
+        help="Only export the integrations with names matching this regex",
+    )
+    add_cluster(parser_export_config)
+
+    # Parser for plan
+    parser_plan = subparsers.add_parser(
+        "plan",
+        help="Report how packing groups would change the integrations"
+        " created from a create config",
+    )
+    parser_plan.add_argument(
+        "file", help="Config file containing info about the integrations", nargs="?"
+    )
+    parser_plan.add_argument(
+        "--inventory",
+        help="Simulate the load of the existing integrations instead of a config",
+        action="store_true",
+    )
+    parser_plan.add_argument(
+        "-o",
+        "--out",
+        help="Write the packed config, which can be given to create, to this path",
+    )
+    add_max_url_length(parser_plan)
+    add_stagger(parser_plan)
+    add_pool(parser_plan)
+    add_policy_pool(parser_plan)
+    parser_plan.add_argument(
+        "--simulate",
+        help="Print the simulated fetches per second sent to each pmproxy",
+        action="store_true",
+    )
+    parser_plan.add_argument(
+        "--histogram",
+        help="Write the simulated fetches per second sent to each pmproxy"
+        " to a CSV file",
+    )
+    parser_plan.add_argument(
+        "--horizon",
+        help="Number of seconds to simulate."
+        f" Defaults to {constants.SIMULATION_HORIZON}",
+        type=int,
+        default=constants.SIMULATION_HORIZON,
+    )
+
+    # Parser for rebalance
+    parser_rebalance = subparsers.add_parser(
+        "rebalance",
+        help="Move existing integrations between the members of a pmproxy pool",
+    )
+    add_pool(parser_rebalance)
+    parser_rebalance.add_argument(
+        "--select",
+        help="Only rebalance the integrations with names matching this regex."
+        " Selected integrations on pmproxies outside the pool are moved into it",
+    )
+    parser_rebalance.add_argument(
+        "--adopt",
+        help="Also move integrations on pmproxies outside the pool into it",
+        action="store_true",
+    )
+    add_dry_run(parser_rebalance)
+    add_cluster(parser_rebalance)
+    parser_rebalance.add_argument(
+        "-w",
+        "--workers",
+        help="Number of update requests to send concurrently."
+        f" Defaults to {constants.WORKERS}",
+        type=int,
+        default=constants.WORKERS,
+    )
+
+    # Parser for upgrade
+    parser_upgrade = subparsers.add_parser(
+        "upgrade",
+        help="Upgrade the package of existing integrations"
+        " to the version installed in Kibana",
+    )
+    parser_upgrade.add_argument(
+        "--select",
+        help="Only upgrade the integrations with names matching this regex",
+    )
+    parser_upgrade.add_argument(
+        "--chunk-size",
+        help="Most integrations to upgrade in each bulk request."
+        f" Defaults to {constants.UPGRADE_CHUNK}",
+        type=int,
+        default=constants.UPGRADE_CHUNK,
+    )
+    add_dry_run(parser_upgrade)
+    add_cluster(parser_upgrade)
+    parser_upgrade.add_argument(
+        "-w",
+        "--workers",
+        help="Number of bulk requests to send concurrently."
+        f" Defaults to {constants.WORKERS}",
+        type=int,
+        default=constants.WORKERS,
+    )
+
+    # Parser for rollback
+    parser_rollback = subparsers.add_parser(
+        "rollback",
+        help="Undo the changes and deletions made by a previous run",
+    )
+    parser_rollback.add_argument(
+        "run_id", help="Id of the run to undo, printed at the end of the run"
+    )
+    add_dry_run(parser_rollback)
+    add_cluster(parser_rollback)
+    parser_rollback.add_argument(
+        "-w",
+        "--workers",
+        help="Number of requests to send concurrently."
+        f" Defaults to {constants.WORKERS}",
+        type=int,
+        default=constants.WORKERS,
+    )
+
+    # Parser for snapshot
+    parser_snapshot = subparsers.add_parser(
+        "snapshot", help="Save, compare and restore snapshots of the integrations"
+    )
+    snapshot_actions = parser_snapshot.add_subparsers(
+        dest="action", help="What to do with snapshots."
+    )
+    snapshot_actions.required = True
+    parser_save = snapshot_actions.add_parser(
+        "save", help="Save the integrations in Kibana to a snapshot"
+    )
+    parser_save.add_argument(
+        "-o",
+        "--out",
+        help="Path to the snapshot."
+        " Defaults to config/snapshots/<date and time>.jsonl.gz",
+    )
+    add_cluster(parser_save)
+    parser_diff = snapshot_actions.add_parser(
+        "diff", help="Compare a snapshot with another one or with Kibana"
+    )
+    parser_diff.add_argument("old", help="Snapshot to compare from")
+    parser_diff.add_argument(
+        "new",
+        help="Snapshot to compare to. Defaults to the integrations in Kibana",
+        nargs="?",
+    )
+    add_cluster(parser_diff)
+    parser_restore = snapshot_actions.add_parser(
+        "restore", help="Create the integrations in a snapshot missing from Kibana"
+    )
+    parser_restore.add_argument("file", help="Snapshot to restore")
+    parser_restore.add_argument(
+        "--select",
+        help="Only restore the integrations with names matching this regex",
+    )
+    add_dry_run(parser_restore)
+    parser_restore.add_argument(
+        "-w",
+        "--workers",
+        help="Number of create requests to send concurrently."
+        f" Defaults to {constants.WORKERS}",
+        type=int,
+        default=constants.WORKERS,
+    )
+    add_cluster(parser_restore)
 
     return parser.parse_args(args)
 
 
+def add_cluster(parser):
+    """Add the option choosing which Kibana clusters to work on to parser."""
+    parser.add_argument(
+        "--cluster",
+        help="Kibana cluster from web_config.ini to work on, or all of them."
+        " Can be given multiple times. Defaults to the [kibana] section",
+        action="append",
+        default=[],
+        metavar="NAME|all",
+    )
+
+
+def add_max_url_length(parser):
+    """Add the option limiting the URL length of packed groups to parser."""
+    parser.add_argument(
+        "--max-url-length",
+        help="Split packed groups whose pmproxy fetch URL would be longer"
+        f" than this. Defaults to {constants.MAX_URL_LENGTH}",
+        type=int,
+        default=constants.MAX_URL_LENGTH,
+    )
+
+
+def add_dry_run(parser):
+    """Add the option to plan requests without sending them to parser."""
+    parser.add_argument(
+        "--dry-run",
+        help="Print the requests which would change integrations, and an"
+        " estimate of how long they would take, without sending them",
+        action="store_true",
+    )
+
+
+def add_pool(parser):
+    """Add the options choosing pmproxies from a pool to parser."""
+    parser.add_argument(
+        "--pmproxy",
+        help="Member of the pmproxy pool used by groups without a pmproxy_url."
+        " Can be given multiple times. Defaults to the pool in web_config.ini",
+        action="append",
+        default=[],
+        metavar="URL[=WEIGHT]",
+    )
+    parser.add_argument(
+        "--strategy",
+        help="How hosts are assigned to pool members. hash keeps each host on"
+        " the same member, least-loaded uses the current inventory's load."
+        " Defaults to hash",
+        choices=("hash", "least-loaded"),
+        default="hash",
+    )
+
+
+def add_policy_pool(parser):
+    """Add the options placing integrations on a set of agent policies to parser."""
+    parser.add_argument(
+        "--policy",
+        help="Agent policy id used by groups without a policy_id."
+        " Can be given multiple times. Defaults to the policies in web_config.ini",
+        action="append",
+        default=[],
+        metavar="POLICY_ID",
+    )
+    parser.add_argument(
+        "--policy-cap",
+        help="Most integrations to put on each agent policy,"
+        " counting the ones already there",
+        type=int,
+    )
+
+
+def add_stagger(parser):
+    """Add the option staggering intervals to parser."""
+    parser.add_argument(
+        "--stagger",
+        help="Vary each group's interval by up to this percentage,"
+        " so integrations don't all fetch from pmproxy at once",
+        type=int,
+        default=0,
+        metavar="PERCENT",
+    )
+
+
 def validate_args(args):
     """Perform various validity checks on command-line arguments.
 
     Currently:
     Create: check that at most one of -o and --no-outfile are specified.
+    Create/Plan: check that --stagger is a sensible percentage.
+    Plan: check that exactly one of a file and --inventory are given.
+    Upgrade: check that --chunk-size is positive.
+    Update: check that --dry-run is only given for batch updates.
+    Update: check that batch update options are only given with --select,
+    and that --set is only given known fields.
     """
     if args.command == "create":
         if args.out and not args.outfile:
@@ -118,6 +526,43 @@ def validate_args(args):
                 file=sys.stderr,
             )
             sys.exit(1)
+    if args.command in ("create", "plan") and not 0 <= args.stagger <= 50:
+        print("--stagger must be between 0 and 50.", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "upgrade" and args.chunk_size < 1:
+        print("--chunk-size must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "plan" and (args.file is None) == (not args.inventory):
+        print("Give plan either a config file or --inventory.", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "update":
+        batch_opts = (
+            args.set
+            or args.add_metrics
+            or args.remove_metrics
+            or args.enabled is not None
+        )
+        if args.dry_run and args.select is None and not args.file:
+            print(
+                "--dry-run can only be used with --select or --file.", file=sys.stderr
+            )
+            sys.exit(1)
+        if batch_opts and args.select is None:
+            print(
+                "--set, --add-metrics, --remove-metrics, --enable and --disable"
+                " can only be used with --select.",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        for expr in args.set:
+            field = expr.split("=", 1)[0]
+            if "=" not in expr or field not in ("interval", "pmproxy_url"):
+                print(
+                    f"Invalid --set expression {expr}."
+                    " It must be interval=<value> or pmproxy_url=<value>.",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
     # Can add more as needed
 
 
@@ -125,27 +570,138 @@ def run_command(args):
     """Run the command provided by the user."""
     validate_args(args)
 
+    # Modes are only imported when they're run, to keep startup fast
     modes = {
-        constants.CREATE: (create.create, ("args",)),
-        constants.LIST: (ilist.ilist, ()),
-        constants.DELETE: (delete.delete, ("args",)),
-        constants.UPDATE: (update.update, ("args",)),
+        constants.CREATE: ("modes.create", "create", ("args",)),
+        constants.LIST: ("modes.ilist", "ilist", ("args",)),
+        constants.DELETE: ("modes.delete", "delete", ("args",)),
+        constants.UPDATE: ("modes.update", "update", ("args",)),
+        constants.EXPORT_METRICS: ("modes.export_metrics", "export_metrics", ("args",)),
+        constants.EXPORT_CONFIG: ("modes.export_config", "export_config", ("args",)),
+        constants.PLAN: ("modes.plan", "plan", ("args",)),
+        constants.REBALANCE: ("modes.rebalance", "rebalance", ("args",)),
+        constants.UPGRADE: ("modes.upgrade", "upgrade", ("args",)),
+        constants.ROLLBACK: ("modes.rollback", "rollback", ("args",)),
+        constants.SNAPSHOT: ("modes.snapshot", "snapshot", ("args",)),
     }
 
-    for command, (func, param_types) in modes.items():
+    for command, (module, func, param_types) in modes.items():
         if args.command == command:
             params = []
             for ptype in param_types:
                 if ptype == "args":
                     params.append(args)
-            func(*params)
+            mode_func = getattr(importlib.import_module(module), func)
+            if command in constants.CLUSTER_MODES:
+                run_clusters(args, lambda: mode_func(*params))
+            else:
+                mode_func(*params)
+
+
+def run_clusters(args, run):
+    """Run a mode against each cluster chosen with --cluster, concurrently
+    where they don't need to ask for input, and exit with the worst status."""
+    from utils import cluster_utils, file_utils
+    from utils.dryrun_utils import DRY_RUN
+
+    web_info = file_utils.read_config()
+    try:
+        names = cluster_utils.select(web_info, args.cluster)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if len(names) <= 1:
+        if not names or names[0] == cluster_utils.DEFAULT:
+            run()
+        else:
+            cluster_utils.run_in(names[0], run)
+        return
+
+    interactive = (args.command == constants.DELETE and args.interactive) or (
+        args.command == constants.UPDATE and args.select is None and not args.file
+    )
+    if args.command == constants.CREATE and args.outfile and not args.dry_run:
+        # Ask about missing id maps now, while the clusters' output isn't held back
+        for name in names:
+            file_utils.try_init_json(cluster_utils.cluster_path(args.out, name))
+
+    def run_cluster():
+        # Each cluster's planned requests are reported separately
+        DRY_RUN.calls = []
+        run()
+
+    # Dry runs go through the clusters one at a time, so their plans don't mix
+    dry_run = getattr(args, "dry_run", False)
+    workers = 1 if interactive or dry_run else len(names)
+    statuses = cluster_utils.fan_out(names, run_cluster, workers)
+    failed = [name for name, status in statuses.items() if status]
+    if failed:
+        print(f"Failed on cluster(s): {', '.join(failed)}", file=sys.stderr)
+        sys.exit(max(statuses.values()))
+
+
+def report_stats(args):
+    """Print and/or write the timings collected during the run, if asked to."""
+    if not args.stats and not args.trace and not args.metrics_file:
+        return
+
+    from utils.stats import STATS
+    from utils import prom_utils
+
+    if args.stats:
+        print(STATS.report(), file=sys.stderr)
+    if args.trace:
+        STATS.write_trace(args.trace)
+    if args.metrics_file:
+        prom_utils.write_textfile(
+            args.metrics_file, prom_utils.run_metrics(STATS, args.command)
+        )
+
+
+def save_latencies():
+    """Remember how long this run's Kibana requests took, so dry runs
+    can estimate how long their requests would take."""
+    # Nothing can have been sent if the stats were never imported
+    if "utils.stats" not in sys.modules:
+        return
+
+    from utils.stats import STATS
+
+    if STATS.requests:
+        try:
+            STATS.save_latencies(constants.LATENCY_FILE)
+        except OSError as e:
+            print(f"Could not save request latencies: {e}", file=sys.stderr)
+
+
+def report_journal():
+    """Tell the user how to undo the changes this run made, if it made any."""
+    # Nothing can have been journaled if the journal was never imported
+    if "utils.journal" not in sys.modules:
+        return
+
+    from utils.journal import JOURNAL
+
+    if JOURNAL.written():
+        JOURNAL.close()
+        print(
+            f"Changes were journaled as run {JOURNAL.run_id}. To undo them, run"
+            f" ./main.py rollback {JOURNAL.run_id}",
+            file=sys.stderr,
+        )
 
 
 def main():
     """The driver for integrations.py."""
     args = build_parser()
 
-    run_command(args)
+    try:
+        run_command(args)
+    finally:
+        report_stats(args)
+        save_latencies()
+        report_journal()
 
 
 if __name__ == "__main__":
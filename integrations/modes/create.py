@@ -1,55 +1,200 @@
 """Driver for the create command.
 """
 
+import sys
+
 import constants
-from utils import api_utils, file_utils
+from utils import (
+    api_utils,
+    cluster_utils,
+    file_utils,
+    plan_utils,
+    pmproxy_utils,
+    policy_utils,
+    pool_utils,
+)
+from utils.dryrun_utils import DRY_RUN
+from utils.stats import STATS
+
+# Number of nodes whose metrics are expanded at once
+EXPAND_CHUNK = 64
+
+
+def expand_nodes(nodes, cache, workers):
+    """Expand the metric prefixes in each node's groups using pmproxy,
+    a chunk of nodes at a time."""
+
+    def expand(chunk):
+        with STATS.phase("metric expansion"):
+            pmproxy_utils.expand_groups(
+                [group for node in chunk for group in node["groups"]], cache, workers
+            )
+        return chunk
+
+    chunk = []
+    for node in nodes:
+        for group in node["groups"]:
+            group["fqdn"] = node["fqdn"]
+        chunk.append(node)
+        if len(chunk) == EXPAND_CHUNK:
+            yield from expand(chunk)
+            chunk = []
+    yield from expand(chunk)
+
 
+def preflight(args, pool, loads):
+    """Probe every pmproxy and host in the config file,
+    returning a map of failing (pmproxy_url, fqdn) to the reason."""
+    targets = set()
+    # Balancing is deterministic, so hosts are probed on the pmproxies
+    # they'll be created on
+    nodes = pool_utils.assign_nodes(
+        file_utils.iter_nodes(args.file, []),
+        pool_utils.Balancer(args.strategy, loads),
+        pool,
+        [],
+    )
+    for node in nodes:
+        for group in node["groups"]:
+            targets.add((group["pmproxy_url"], node["fqdn"]))
+
+    print(f"Probing {len(targets)} pmproxy target(s)")
+    with STATS.phase("preflight"):
+        failures = pmproxy_utils.preflight(
+            targets, args.workers, args.preflight_timeout
+        )
+    for (pmproxy_url, fqdn), reason in sorted(failures.items()):
+        print(
+            f"Preflight failed for {fqdn} via {pmproxy_url}: {reason}", file=sys.stderr
+        )
+    return failures
 
-def iter_nodes(config, args):
-    """On each host and group specified in config:
+
+def iter_nodes(nodes, config, args, skip=()):
+    """On each host and group yielded by nodes:
 
     Build an HTTP request.
     Send an HTTP request.
     Optionally update name->id mapping.
+
+    Groups whose (pmproxy_url, fqdn) is in skip are not created.
+    Returns the number of groups skipped.
     """
 
     id_map = {}
+    skipped = 0
 
     i = 1
-    for node in config["nodes"]:
-        print(
-            f"Creating integrations for node {i} of {len(config['nodes'])} ({node['fqdn']})"
-        )
+    for node in nodes:
+        print(f"Creating integrations for node {i} ({node['fqdn']})")
         i += 1
 
         fqdn = node["fqdn"]
         for group in node["groups"]:
             group["fqdn"] = fqdn
-            # file_utils.expand_metrics(group)
-            req = api_utils.build_request(config, constants.CREATE, group)
-            mapping = api_utils.request(req, constants.CREATE)
+            if (group["pmproxy_url"], fqdn) in skip:
+                skipped += 1
+                continue
+            with STATS.phase("request build"):
+                req = api_utils.build_request(config, constants.CREATE, group)
+            with STATS.phase("dispatch"):
+                mapping = api_utils.request(req, constants.CREATE)
 
             id_map.update(mapping)
 
     if args.outfile:
-        file_utils.update_idmap(id_map, args)
-        print(f"Wrote name->id map to {args.out}")
+        out = cluster_utils.cluster_path(args.out)
+        file_utils.update_idmap(id_map, out)
+        print(f"Wrote name->id map to {out}")
+    return skipped
 
 
 def create(args):
     """Load config and perform validations."""
+    if args.check_config:
+        file_utils.check_file(args.file, constants.CREATE)
+
+    DRY_RUN.enabled = args.dry_run
+    if args.dry_run:
+        # Nothing is created, so there are no ids to write out
+        args.outfile = False
+
     web_info = file_utils.read_config()
-    config = file_utils.load_file(args.file)
-    config["api_key"] = web_info["kibana"]["api_key"]
-    config["kibana_url"] = web_info["kibana"]["kibana_url"]
+    config = {
+        "api_key": web_info["kibana"]["api_key"],
+        "kibana_url": web_info["kibana"]["kibana_url"],
+    }
 
-    if args.check_config:
-        file_utils.check_conf(config, constants.CREATE)
     if args.outfile:
-        file_utils.try_init_json(args.out)
+        file_utils.try_init_json(cluster_utils.cluster_path(args.out))
 
     api_utils.validate_key(
         web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"]
     )
+    config["package_version"] = api_utils.package_version(
+        web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"]
+    )
+
+    # The existing integrations are fetched once, for their names, the
+    # load on each pmproxy and the integrations on each policy
+    inventory = api_utils.generate_map(
+        web_info["kibana"]["api_key"],
+        web_info["kibana"]["kibana_url"],
+        extended=True,
+        slim=True,
+    )
+    pool, loads = pool_utils.load_pool(args, web_info, inventory)
+    policies, counts = policy_utils.load_policies(args, web_info, inventory)
+    # Every agent policy the config can use is looked up before anything
+    # is sent, so a missing one can't turn up halfway through the run
+    known = api_utils.agent_policies(
+        web_info["kibana"]["api_key"],
+        web_info["kibana"]["kibana_url"],
+        policy_utils.config_policies(args.file) | set(policies),
+    )
+
+    # Probing reads the file once up front, so no POST is sent to a
+    # pmproxy or host which is known to be unreachable
+    failures = preflight(args, pool, loads) if args.preflight else {}
+
+    # Nodes are validated and dispatched as they are read from the file
+    errors = []
+    nodes = STATS.timed_iter("config load", file_utils.iter_nodes(args.file, errors))
+    nodes = pool_utils.assign_nodes(
+        nodes, pool_utils.Balancer(args.strategy, loads), pool, errors
+    )
+    if args.expand_metrics:
+        cache = pmproxy_utils.PMNSCache(ttl=args.pmns_cache_ttl)
+        nodes = expand_nodes(nodes, cache, args.workers)
+    if args.pack:
+        summary = plan_utils.PackSummary()
+        nodes = plan_utils.pack_nodes(nodes, summary, args.max_url_length)
+    if args.stagger:
+        nodes = plan_utils.stagger_nodes(nodes, args.stagger)
+    # Names are checked once nothing else can change them
+    nodes = plan_utils.dedupe_nodes(
+        nodes, inventory, args.on_collision, errors, args.max_url_length
+    )
+    # Policies are placed last, so only the integrations which will be
+    # created count against --policy-cap
+    placer = policy_utils.PolicyPlacer(args.policy_cap, counts)
+    nodes = policy_utils.place_nodes(nodes, placer, policies, errors)
+    nodes = policy_utils.check_nodes(nodes, known, errors)
+    skipped = iter_nodes(nodes, config, args, failures)
+    if args.expand_metrics:
+        cache.save()
+    if args.pack:
+        print(summary.report())
+    if placer.placed:
+        print(placer.report())
+    if args.dry_run:
+        # Integrations are created one at a time
+        print(DRY_RUN.report(1, STATS))
 
-    iter_nodes(config, args)
+    if skipped:
+        print(f"Skipped {skipped} group(s) which failed preflight.", file=sys.stderr)
+    if errors:
+        file_utils.report_errors(errors)
+        print("Invalid parts of the config were skipped.", file=sys.stderr)
+    if errors or skipped:
+        sys.exit(1)
@@ -5,7 +5,10 @@ import sys
 import re
 
 import constants
-from utils import api_utils, file_utils
+from utils import api_utils, cluster_utils, file_utils, journal
+from utils.dryrun_utils import DRY_RUN
+from utils.journal import JOURNAL
+from utils.stats import STATS
 
 
 def handle_names(names, args, kib_info, ids):
@@ -14,7 +17,8 @@ def handle_names(names, args, kib_info, ids):
     if args.generate_map:
         idmap = api_utils.generate_map(*kib_info)
     else:
-        idmap = file_utils.load_file(args.mapfile)
+        with STATS.phase("config load"):
+            idmap = file_utils.load_file(cluster_utils.cluster_path(args.mapfile))
 
     for name in names:
         if args.regex:
@@ -55,15 +59,17 @@ def handle_names(names, args, kib_info, ids):
 
 def delete(args):
     """Build and send HTTP request to delete each provided integration."""
+    if args.check_config:
+        file_utils.check_file(args.file, constants.DELETE)
+
+    DRY_RUN.enabled = args.dry_run
     web_info = file_utils.read_config()
-    config = file_utils.load_file(args.file)
+    with STATS.phase("config load"):
+        config = file_utils.load_config(args.file, constants.DELETE)
     kib_info = (web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"])
     config["api_key"] = kib_info[0]
     config["kibana_url"] = kib_info[1]
 
-    if args.check_config:
-        file_utils.check_conf(config, constants.DELETE)
-
     api_utils.validate_key(*kib_info)
 
     ids = config.get("ids", [])
@@ -71,8 +77,16 @@ def delete(args):
         names_info = handle_names(config["names"], args, kib_info, ids)
         ids = names_info[0]
 
+    # The policies are kept in the journal, so the deletions can be undone
+    policies = {}
+    if not args.dry_run:
+        policies = {
+            policy["id"]: policy for policy in api_utils.bulk_get(*kib_info, ids)
+        }
+
     for i in ids:
-        req = api_utils.build_request(config, constants.DELETE, id_=i)
+        with STATS.phase("request build"):
+            req = api_utils.build_request(config, constants.DELETE, id_=i)
         if args.interactive:
             if "names" in config:
                 inv_map = {val["id"]: key for key, val in names_info[1].items()}
@@ -84,4 +98,14 @@ def delete(args):
             if input(proceed) != "y":
                 continue
 
-        api_utils.request(req, constants.DELETE)
+        seq = None
+        if i in policies:
+            seq = JOURNAL.record(journal.DELETE, policies[i])
+        with STATS.phase("dispatch"):
+            deleted = api_utils.request(req, constants.DELETE)
+        if seq is not None:
+            JOURNAL.resolve(seq, i, bool(deleted))
+
+    if args.dry_run:
+        # Integrations are deleted one at a time
+        print(DRY_RUN.report(1, STATS))
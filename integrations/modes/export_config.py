@@ -0,0 +1,51 @@
+"""Driver for the export-config command.
+"""
+
+import os
+import re
+import sys
+
+from utils import api_utils, cluster_utils, export_utils, file_utils
+from utils.inventory import with_derived_fields
+
+
+def export_config(args):
+    """Write a create config which makes the existing integrations again."""
+    web_info = file_utils.read_config()
+    kib_info = (web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"])
+
+    regex = None
+    if args.select is not None:
+        try:
+            regex = re.compile(args.select)
+        except re.error as err:
+            print(err.msg + " in " + args.select, file=sys.stderr)
+            sys.exit(1)
+
+    # Only the fields of each group are kept, not the policies they came from
+    policies = (
+        policy
+        for policy in api_utils.pcp_policies(*kib_info)
+        if regex is None or regex.search(policy["name"])
+    )
+    integrations = (
+        dict(fields, name=policy["name"], policy_id=policy["policy_id"])
+        for policy, fields in with_derived_fields(policies)
+    )
+    nodes = export_utils.group_nodes(integrations)
+
+    if args.out == "-":
+        export_utils.write_config(nodes, sys.stdout)
+        return
+
+    out = cluster_utils.cluster_path(args.out)
+    tmp_path = f"{out}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            count = export_utils.write_config(nodes, outfile)
+        os.replace(tmp_path, out)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    print(f"Wrote create config for {count} node(s) to {out}")
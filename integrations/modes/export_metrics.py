@@ -0,0 +1,18 @@
+"""Driver for the export-metrics command.
+"""
+
+from utils import api_utils, file_utils, prom_utils
+from utils.stats import STATS
+
+
+def export_metrics(args):
+    """Write gauges describing the existing integrations, along with
+    this run's request metrics, to a node_exporter textfile."""
+    web_info = file_utils.read_config()
+    kib_info = (web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"])
+
+    idmap = api_utils.generate_map(*kib_info, extended=True, slim=True)
+    lines = prom_utils.inventory_metrics(idmap)
+    lines += prom_utils.run_metrics(STATS, args.command)
+    prom_utils.write_textfile(args.out, lines)
+    print(f"Wrote metrics for {len(idmap)} integrations to {args.out}")
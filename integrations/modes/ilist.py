@@ -1,21 +1,50 @@
 """Driver for the list command.
 """
 
-from utils import api_utils, file_utils
+from concurrent.futures import ThreadPoolExecutor
+import sys
 
+from utils import api_utils, cluster_utils, file_utils
 
-def ilist():
-    """List each installed integration and whether it's enabled."""
-    web_info = file_utils.read_config()
-    kib_info = (web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"])
+
+def fetch_inventory(web_info, name):
+    """Validate the API key of a cluster and fetch its integrations."""
+    kib_info = cluster_utils.cluster_config(web_info, name)["kibana"]
+    kib_info = (kib_info["api_key"], kib_info["kibana_url"])
     api_utils.validate_key(*kib_info)
+    return api_utils.generate_map(*kib_info, extended=True, slim=True)
+
+
+def ilist(args):
+    """List each installed integration and whether it's enabled.
+
+    With several clusters, their integrations are fetched concurrently
+    and listed in one table, with a column for the cluster.
+    """
+    web_info = file_utils.read_config()
+    try:
+        names = cluster_utils.select(web_info, args.cluster) or [None]
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        idmaps = list(pool.map(lambda name: fetch_inventory(web_info, name), names))
+
+    rows = [
+        (cluster, name, idmap[name])
+        for cluster, idmap in zip(names, idmaps)
+        for name in idmap
+    ]
+    rows.sort(key=lambda row: (row[1], names.index(row[0])))
 
-    idmap = api_utils.generate_map(*kib_info, extended=True)
-    print(f"{'Name':<25}{'ID':<45}{'Status'}")
-    for name in sorted(idmap.keys()):
+    column = f"{'Cluster':<15}" if len(names) > 1 else ""
+    print(f"{column}{'Name':<25}{'ID':<45}{'Status'}")
+    for cluster, name, integration in rows:
+        column = f"{cluster:<15}" if len(names) > 1 else ""
         enabled = (
             "\033[32menabled\033[0m"
-            if idmap[name]["enabled_"]
+            if integration["enabled_"]
             else "\033[31mdisabled\033[0m"
         )
-        print(f"{name:<25}{idmap[name]['id']:<45}{enabled}")
+        print(f"{column}{name:<25}{integration['id']:<45}{enabled}")
@@ -0,0 +1,89 @@
+"""Driver for the plan command.
+"""
+
+import json
+import sys
+
+from utils import api_utils, file_utils, plan_utils, policy_utils, pool_utils
+from utils.stats import STATS
+
+
+def plan_config(args, simulator):
+    """Report how packing and staggering would change the integrations
+    created from a create config, optionally writing the result to a file."""
+    errors = []
+    summary = plan_utils.PackSummary()
+    web_info = file_utils.read_config()
+    pool, loads = pool_utils.load_pool(args, web_info)
+    policies, counts = policy_utils.load_policies(args, web_info)
+    placer = policy_utils.PolicyPlacer(args.policy_cap, counts)
+    nodes = pool_utils.assign_nodes(
+        STATS.timed_iter("config load", file_utils.iter_nodes(args.file, errors)),
+        pool_utils.Balancer(args.strategy, loads),
+        pool,
+        errors,
+    )
+    nodes = plan_utils.pack_nodes(nodes, summary, args.max_url_length)
+    if args.stagger:
+        nodes = plan_utils.stagger_nodes(nodes, args.stagger)
+    # Placed after packing, like create, so the cap counts packed groups
+    nodes = policy_utils.place_nodes(nodes, placer, policies, errors)
+
+    # Nodes are written out as they're planned, like create dispatches them
+    outfile = open(args.out, "w", encoding="utf-8") if args.out else None
+    try:
+        if outfile:
+            outfile.write('{"nodes": [')
+        for i, node in enumerate(nodes):
+            for group in node["groups"]:
+                simulator.add(group["pmproxy_url"], group["interval"])
+            if outfile:
+                outfile.write(("," if i else "") + "\n" + json.dumps(node))
+        if outfile:
+            outfile.write("\n]}\n")
+    finally:
+        if outfile:
+            outfile.close()
+
+    print(summary.report())
+    if placer.placed:
+        print(placer.report())
+    if args.out:
+        print(f"Wrote packed config to {args.out}")
+    return errors
+
+
+def plan(args):
+    """Plan a create config, or simulate the load of the existing
+    integrations with --inventory."""
+    simulator = plan_utils.LoadSimulator()
+    errors = []
+    if args.inventory:
+        web_info = file_utils.read_config()
+        idmap = api_utils.generate_map(
+            web_info["kibana"]["api_key"],
+            web_info["kibana"]["kibana_url"],
+            extended=True,
+            slim=True,
+        )
+        for integration in idmap.values():
+            simulator.add(integration["pmproxy_url_"], integration["interval_"])
+        print(
+            policy_utils.report_counts(
+                policy_utils.policy_counts(idmap), args.policy_cap
+            )
+        )
+    else:
+        errors = plan_config(args, simulator)
+
+    if args.simulate:
+        print(f"\nSimulated pmproxy fetches over {args.horizon} s:")
+        print(simulator.report(args.horizon))
+    if args.histogram:
+        simulator.write_histogram(args.histogram, args.horizon)
+        print(f"Wrote fetches per second to {args.histogram}")
+
+    if errors:
+        file_utils.report_errors(errors)
+        print("Invalid parts of the config were skipped.", file=sys.stderr)
+        sys.exit(1)
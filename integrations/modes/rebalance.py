@@ -0,0 +1,98 @@
+"""Driver for the rebalance command.
+"""
+
+import json
+import sys
+
+from interactive import commands
+from modes.update import load_policies, select_names
+from utils import api_utils, cluster_utils, file_utils, pool_utils
+from utils.dryrun_utils import DRY_RUN
+from utils.stats import STATS
+
+
+def placements(name_map, names):
+    """Group the named integrations by host and current pmproxy.
+
+    Returns a list of (fqdn, pmproxy_url, rate) and the names of the
+    integrations in each of them.
+    """
+    grouped = {}
+    for name in names:
+        integration = name_map[name]
+        key = (integration["hostname_"], integration["pmproxy_url_"])
+        rate, group_names = grouped.get(key, (0.0, []))
+        group_names.append(name)
+        grouped[key] = (
+            rate + pool_utils.integration_rate(integration["interval_"]),
+            group_names,
+        )
+
+    keys = sorted(grouped)
+    return (
+        [(fqdn, url, grouped[(fqdn, url)][0]) for fqdn, url in keys],
+        [grouped[key][1] for key in keys],
+    )
+
+
+def rebalance(args):
+    """Move integrations between the members of a pmproxy pool,
+    using batched PUTs, and print the results as JSON."""
+    web_info = file_utils.read_config()
+    pool, __ = pool_utils.load_pool(args, web_info)
+    if not pool:
+        print(
+            "No pmproxy pool given. Use --pmproxy or set pool in the [pmproxy]"
+            " section of web_config.ini.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    name_map = api_utils.generate_map(
+        web_info["kibana"]["api_key"],
+        web_info["kibana"]["kibana_url"],
+        extended=True,
+        slim=True,
+    )
+    names = sorted(name_map)
+    if args.select is not None:
+        names = select_names(args.select, names)
+
+    hosts, host_names = placements(name_map, names)
+    # Integrations on other pmproxies are left alone unless asked for
+    if not args.adopt and args.select is None:
+        members = {pool_utils.pmproxy_key(url) for url, __ in pool}
+        kept = [
+            i
+            for i, (__, url, __) in enumerate(hosts)
+            if pool_utils.pmproxy_key(url) in members
+        ]
+        hosts = [hosts[i] for i in kept]
+        host_names = [host_names[i] for i in kept]
+    targets = pool_utils.plan_moves(hosts, pool, args.strategy)
+
+    moves = {}
+    for (fqdn, url, __), group_names, target in zip(hosts, host_names, targets):
+        if target is not None:
+            print(f"{fqdn}: {url} -> {target} ({len(group_names)} integration(s))")
+            moves.setdefault(target, []).extend(group_names)
+
+    moved = sorted(name for group_names in moves.values() for name in group_names)
+    handler = commands.UpdateHandler(
+        moved, load_policies(web_info, name_map, moved), web_info, False
+    )
+    for target, group_names in moves.items():
+        handler.set_url(target, group_names)
+
+    DRY_RUN.enabled = args.dry_run
+    result = handler.send_updates(args.workers)
+    result["selected"] = len(names)
+    if args.dry_run:
+        result["planned"] = result.pop("updated")
+        print(DRY_RUN.report(args.workers, STATS), file=sys.stderr)
+    if cluster_utils.current() is not None:
+        result["cluster"] = cluster_utils.current()
+    print(json.dumps(result, indent=2))
+
+    if result["failed"]:
+        sys.exit(1)
@@ -0,0 +1,51 @@
+"""Driver for the rollback command.
+"""
+
+import json
+import sys
+
+import constants
+from utils import api_utils, cluster_utils, file_utils, journal
+from utils.dryrun_utils import DRY_RUN
+from utils.stats import STATS
+
+
+def rollback(args):
+    """Put back every integration changed or deleted by a previous run,
+    using the state recorded in its journal, and print the results as JSON."""
+    try:
+        entries = journal.load(args.run_id)
+    except OSError as e:
+        print(f"Could not read the journal of run {args.run_id}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    web_info = file_utils.read_config()
+    config = {
+        "api_key": web_info["kibana"]["api_key"],
+        "kibana_url": web_info["kibana"]["kibana_url"],
+    }
+
+    DRY_RUN.enabled = args.dry_run
+    with STATS.phase("request build"):
+        reqs = [
+            api_utils.build_request(config, constants.ROLLBACK, entry=entry)
+            for entry in entries
+        ]
+    result = {"run": args.run_id, "restored": [], "recreated": [], "failed": {}}
+    responses = api_utils.request_many(reqs, constants.ROLLBACK, args.workers)
+    for entry, (__, error) in zip(entries, responses):
+        if error is not None:
+            result["failed"][entry["name"]] = str(error)
+        elif entry["kind"] == journal.DELETE:
+            result["recreated"].append(entry["name"])
+        else:
+            result["restored"].append(entry["name"])
+
+    if args.dry_run:
+        print(DRY_RUN.report(args.workers, STATS), file=sys.stderr)
+    if cluster_utils.current() is not None:
+        result["cluster"] = cluster_utils.current()
+    print(json.dumps(result, indent=2))
+
+    if result["failed"]:
+        sys.exit(1)
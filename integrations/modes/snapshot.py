@@ -0,0 +1,118 @@
+"""Driver for the snapshot command.
+"""
+
+import json
+import re
+import sys
+import time
+
+import constants
+from utils import api_utils, cluster_utils, file_utils, journal, snapshot_utils
+from utils.dryrun_utils import DRY_RUN
+from utils.stats import STATS
+
+
+def live_entries(web_info):
+    """Yield the snapshot entries of the integrations in Kibana as
+    they're fetched."""
+    return (
+        snapshot_utils.entry(policy)
+        for policy in api_utils.pcp_policies(
+            web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"]
+        )
+    )
+
+
+def read_snapshot(path):
+    """Read a snapshot, full bodies included, exiting if it can't be read."""
+    try:
+        return list(snapshot_utils.read(path))
+    except (OSError, ValueError) as e:
+        print(f"Could not read snapshot {path}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def save(args, web_info):
+    """Stream the integrations in Kibana into a snapshot."""
+    if args.out:
+        out = cluster_utils.cluster_path(args.out)
+    else:
+        stem = f"{constants.SNAPSHOT_DIR}/{time.strftime('%Y%m%dT%H%M%S')}"
+        out = cluster_utils.cluster_path(stem) + ".jsonl.gz"
+    count = snapshot_utils.write(out, live_entries(web_info))
+    print(f"Saved {count} integration(s) to {out}")
+
+
+def diff(args, web_info):
+    """Compare a snapshot with another one, or with the integrations in
+    Kibana, and print the differences as JSON.
+
+    Both sides are streamed, and only the name and hash of each entry of
+    the old one are kept.
+    """
+    old = snapshot_utils.read(args.old)
+    new = snapshot_utils.read(args.new) if args.new else live_entries(web_info)
+    try:
+        result = snapshot_utils.diff(old, new)
+    except (OSError, ValueError) as e:
+        print(f"Could not read snapshot: {e}", file=sys.stderr)
+        sys.exit(1)
+    if cluster_utils.current() is not None:
+        result["cluster"] = cluster_utils.current()
+    print(json.dumps(result, indent=2))
+
+
+def restore(args, web_info):
+    """Create the integrations in a snapshot which are missing from
+    Kibana, and print the results as JSON."""
+    entries = read_snapshot(args.file)
+    if args.select is not None:
+        try:
+            regex = re.compile(args.select)
+        except re.error as err:
+            print(err.msg + " in " + args.select, file=sys.stderr)
+            sys.exit(1)
+        entries = [item for item in entries if regex.search(item["name"])]
+
+    config = {
+        "api_key": web_info["kibana"]["api_key"],
+        "kibana_url": web_info["kibana"]["kibana_url"],
+    }
+    live = api_utils.generate_map(
+        config["api_key"], config["kibana_url"], extended=True, slim=True
+    )
+    missing = [item for item in entries if item["name"] not in live]
+
+    DRY_RUN.enabled = args.dry_run
+    with STATS.phase("request build"):
+        # Missing integrations are recreated like deleted ones are rolled back
+        reqs = [
+            api_utils.build_request(
+                config, constants.ROLLBACK, entry=dict(item, kind=journal.DELETE)
+            )
+            for item in missing
+        ]
+    result = {"recreated": [], "present": len(entries) - len(missing), "failed": {}}
+    responses = api_utils.request_many(reqs, constants.ROLLBACK, args.workers)
+    for item, (__, error) in zip(missing, responses):
+        if error is None:
+            result["recreated"].append(item["name"])
+        else:
+            result["failed"][item["name"]] = str(error)
+
+    if args.dry_run:
+        result["planned"] = result.pop("recreated")
+        print(DRY_RUN.report(args.workers, STATS), file=sys.stderr)
+    if cluster_utils.current() is not None:
+        result["cluster"] = cluster_utils.current()
+    print(json.dumps(result, indent=2))
+
+    if result["failed"]:
+        sys.exit(1)
+
+
+def snapshot(args):
+    """Pass control to the snapshot action."""
+    web_info = file_utils.read_config()
+    actions = {"save": save, "diff": diff, "restore": restore}
+    actions[args.action](args, web_info)
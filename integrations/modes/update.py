@@ -1,8 +1,104 @@
 """Driver for the update command.
 """
 
-from interactive import renderer, pages
-from utils import api_utils, file_utils
+import json
+import re
+import sys
+
+import constants
+from interactive import commands, renderer, pages
+from utils import api_utils, cluster_utils, file_utils, metric_utils
+from utils.dryrun_utils import DRY_RUN
+from utils.stats import STATS
+
+
+def cli_operation(args):
+    """Build a batch operation out of the command-line options."""
+    operation = {"select": args.select}
+    if args.enabled is not None:
+        operation["enabled"] = args.enabled
+    for expr in args.set:
+        field, value = expr.split("=", 1)
+        operation[field] = value
+    if args.add_metrics:
+        operation["add_metrics"] = args.add_metrics
+    if args.remove_metrics:
+        operation["remove_metrics"] = args.remove_metrics
+    return operation
+
+
+def select_names(pattern, names):
+    """Return the names which contain a match for the regex pattern."""
+    try:
+        regex = re.compile(pattern)
+    except re.error as err:
+        print(err.msg + " in " + pattern, file=sys.stderr)
+        sys.exit(1)
+    return [name for name in names if regex.search(name)]
+
+
+def apply_operation(handler, operation, names):
+    """Queue the edits in a batch operation on the named integrations."""
+    if "enabled" in operation:
+        handler.set_enabled(operation["enabled"], names)
+    if "interval" in operation:
+        handler.set_interval(operation["interval"], names)
+    if "pmproxy_url" in operation:
+        handler.set_url(operation["pmproxy_url"], names)
+    if "add_metrics" in operation:
+        handler.add_metric_list(
+            metric_utils.split_metrics(operation["add_metrics"]), names
+        )
+    if "remove_metrics" in operation:
+        handler.remove_metric_list(
+            metric_utils.split_metrics(operation["remove_metrics"]), names
+        )
+
+
+def load_policies(web_info, name_map, names):
+    """Fetch the full package policies of the named integrations."""
+    return api_utils.fetch_policies(
+        web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"], name_map, names
+    )
+
+
+def batch_update(args, name_map, web_info):
+    """Apply update operations without any user interaction,
+    and print the results as JSON."""
+    operations = []
+    if args.file:
+        operations.extend(file_utils.load_file(args.file).get("operations", []))
+    if args.select is not None:
+        operations.append(cli_operation(args))
+    file_utils.validate_conf({"operations": operations}, constants.UPDATE)
+
+    names = sorted(name_map.keys(), key=renderer.key_names)
+    targets = [select_names(operation["select"], names) for operation in operations]
+    selected = sorted(
+        {name for target in targets for name in target}, key=renderer.key_names
+    )
+
+    handler = commands.UpdateHandler(
+        selected,
+        load_policies(web_info, name_map, selected),
+        web_info,
+        args.allow_duplicates,
+    )
+    for operation, target in zip(operations, targets):
+        apply_operation(handler, operation, target)
+
+    DRY_RUN.enabled = args.dry_run
+    result = handler.send_updates(args.workers)
+    result["selected"] = len(selected)
+    if args.dry_run:
+        result["planned"] = result.pop("updated")
+        print(DRY_RUN.report(args.workers, STATS), file=sys.stderr)
+    if cluster_utils.current() is not None:
+        result["cluster"] = cluster_utils.current()
+    print(json.dumps(result, indent=2))
+
+    if result["failed"]:
+        sys.exit(1)
 
 
 def update(args):
@@ -10,8 +106,15 @@ def update(args):
     # Make map
     web_info = file_utils.read_config()
     name_map = api_utils.generate_map(
-        web_info["kibana"]["api_key"], web_info["kibana"]["kibana_url"], extended=True
+        web_info["kibana"]["api_key"],
+        web_info["kibana"]["kibana_url"],
+        extended=True,
+        slim=True,
     )
+    if args.file or args.select is not None:
+        batch_update(args, name_map, web_info)
+        return
+
     # Get list of integration names
     names = sorted(name_map.keys(), key=renderer.key_names)
     # Build pl
@@ -22,4 +125,6 @@ def update(args):
         lpages.append(pages.Page(lines, line_nums))
     pl = pages.PageList(lpages)
     # Display pl
-    renderer.cli_driver(pl, name_map, web_info, args)
+    renderer.cli_driver(
+        pl, lambda names: load_policies(web_info, name_map, names), web_info, args
+    )
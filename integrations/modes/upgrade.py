@@ -0,0 +1,168 @@
+"""Driver for the upgrade command.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
+
+import constants
+from modes.update import load_policies, select_names
+from utils import api_utils, cluster_utils, file_utils, journal
+from utils.dryrun_utils import DRY_RUN
+from utils.journal import JOURNAL
+from utils.stats import STATS
+
+
+def chunks(items, size):
+    """Split items into lists of at most size items."""
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def parse_version(version):
+    """Turn a package version such as 1.20.0 or 1.21.0-beta1 into a key
+    which sorts in version order, with pre-releases before their release."""
+    release, __, pre = str(version).partition("-")
+    parts = [int(part) if part.isdigit() else 0 for part in release.split(".")]
+    parts += [0] * (3 - len(parts))
+    return tuple(parts), (0, pre) if pre else (1, "")
+
+
+def result_id(result):
+    """The id of the package policy a dry run result is about."""
+    policy = result.get("packagePolicy") or (result.get("diff") or [{}])[0] or {}
+    return policy.get("id")
+
+
+def result_error(result):
+    """Describe why a bulk upgrade result failed."""
+    message = (result.get("body") or {}).get("message")
+    return message or f"HTTP {result.get('statusCode')}"
+
+
+def check(config, ids):
+    """Ask Kibana whether each of the package policies can be upgraded.
+    Returns the reason each one can't, or None if it can. Results are
+    matched to the policies by id, not by their order."""
+    method, url, headers, body = api_utils.br_upgrade(config, ids, dry_run=True)
+    try:
+        resp = api_utils.send(method, url, headers=headers, json=body)
+        resp.raise_for_status()
+        results = resp.json()
+    except (api_utils.requests.exceptions.RequestException, ValueError) as e:
+        return [str(e)] * len(ids)
+
+    errors = {
+        result_id(result): result_error(result) if result.get("hasErrors") else None
+        for result in results
+    }
+    return [errors.get(id_, "No dry run result returned") for id_ in ids]
+
+
+def upgrade(args):
+    """Upgrade the package of the selected integrations to the installed
+    version with bulk requests, and print the results as JSON."""
+    web_info = file_utils.read_config()
+    config = {
+        "api_key": web_info["kibana"]["api_key"],
+        "kibana_url": web_info["kibana"]["kibana_url"],
+    }
+    installed = api_utils.package_version(config["api_key"], config["kibana_url"])
+    if installed is None:
+        print(
+            f"The {constants.PACKAGE} package isn't installed in Kibana.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    inventory = api_utils.generate_map(
+        config["api_key"], config["kibana_url"], extended=True, slim=True
+    )
+    names = sorted(inventory)
+    if args.select is not None:
+        names = select_names(args.select, names)
+
+    result = {
+        "version": installed,
+        "upgraded": [],
+        "current": [],
+        "newer": [],
+        "failed": {},
+    }
+    names_by_id = {}
+    for name in names:
+        version = parse_version(inventory[name]["package_version_"])
+        if version == parse_version(installed):
+            result["current"].append(name)
+        elif version > parse_version(installed):
+            # Upgrading these would downgrade them
+            result["newer"].append(name)
+        else:
+            names_by_id[inventory[name]["id"]] = name
+
+    # Policies which Kibana says can't be upgraded aren't sent
+    checks = chunks(list(names_by_id), args.chunk_size)
+    with STATS.phase("upgrade check"):
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+            errors = pool.map(lambda ids: check(config, ids), checks)
+            errors = [error for chunk_errors in errors for error in chunk_errors]
+    ready = []
+    for id_, error in zip(names_by_id, errors):
+        if error is None:
+            ready.append(id_)
+        else:
+            result["failed"][names_by_id[id_]] = error
+
+    DRY_RUN.enabled = args.dry_run
+    with STATS.phase("request build"):
+        reqs = [
+            api_utils.build_request(config, constants.UPGRADE, ids=ids)
+            for ids in chunks(ready, args.chunk_size)
+        ]
+
+    # Each policy is journaled before it's upgraded, so it can be rolled back
+    seqs = {}
+    if not args.dry_run and ready:
+        policies = load_policies(
+            web_info, inventory, [names_by_id[id_] for id_ in ready]
+        )
+        for id_ in ready:
+            if names_by_id[id_] in policies:
+                seqs[id_] = JOURNAL.record(journal.PUT, policies[names_by_id[id_]])
+
+    responses = api_utils.request_many(reqs, constants.UPGRADE, args.workers)
+    for req, (results, error) in zip(reqs, responses):
+        ids = req[3]["packagePolicyIds"]
+        if error is not None:
+            for id_ in ids:
+                result["failed"][names_by_id[id_]] = str(error)
+            continue
+        if args.dry_run:
+            result["upgraded"].extend(names_by_id[id_] for id_ in ids)
+            continue
+
+        by_id = {item.get("id"): item for item in results}
+        for id_ in ids:
+            item = by_id.get(id_)
+            if item is None:
+                result["failed"][names_by_id[id_]] = "No upgrade result returned"
+                continue
+            # Policies without a result may still have been upgraded, so
+            # only the ones with a result are marked in the journal
+            if id_ in seqs:
+                JOURNAL.resolve(seqs[id_], id_, bool(item.get("success")))
+            if item.get("success"):
+                result["upgraded"].append(names_by_id[id_])
+            else:
+                result["failed"][names_by_id[id_]] = result_error(item)
+
+    result["upgraded"].sort()
+    result["selected"] = len(names)
+    if args.dry_run:
+        result["planned"] = result.pop("upgraded")
+        print(DRY_RUN.report(args.workers, STATS), file=sys.stderr)
+    if cluster_utils.current() is not None:
+        result["cluster"] = cluster_utils.current()
+    print(json.dumps(result, indent=2))
+
+    if result["failed"]:
+        sys.exit(1)
@@ -2,21 +2,145 @@
 """
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import importlib
 import json
+import os
 import re
 import sys
-
-import requests
+import threading
+import time
+from typing import Dict, Optional, Set
 
 import constants
+from utils import json_utils
+from utils.dryrun_utils import DRY_RUN
+from utils.inventory import Inventory, derived_fields, with_derived_fields
+from utils.lazy_utils import lazy_import
+from utils.stats import KIBANA, STATS
+
+requests = lazy_import("requests")
+
+# Installed package versions, by Kibana URL
+_package_versions: Dict[str, Optional[str]] = {}
+# Hashes of the API keys validated in this run
+_validated: Set[str] = set()
+_key_cache_lock = threading.Lock()
+
+# Fields of package policies kept by slim inventory maps
+SLIM_FIELDS = ("id", "name", "policy_id", "version")
+# Most package policies fetched by a single bulk get
+BULK_SIZE = 1000
+
+# Responses which mean the request can be tried again
+RETRY_STATUSES = (429, 502, 503, 504)
+# Responses which mean the request wasn't handled, so any request can be
+# tried again. A gateway error may come after a POST went through.
+REFUSED_STATUSES = (429, 503)
+# Methods which are safe to resend after a connection or gateway error
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+RETRIES = 2
+# Longest time to wait before a retry, whatever Retry-After says
+MAX_RETRY_DELAY = 0.5 * 2 ** (RETRIES - 1)
+
+
+def send(method, url, retries=RETRIES, service=KIBANA, **kwargs):
+    """Send an HTTP request and record its timing in the run's stats,
+    under service.
+
+    Requests which get a throttling or unavailable response are retried,
+    as are idempotent requests which fail to connect or get a gateway
+    error. Retry-After is followed up to MAX_RETRY_DELAY seconds.
+    """
+    kwargs.setdefault("timeout", 10)
+    attempt = 0
+    while True:
+        start = time.monotonic()
+        try:
+            response = requests.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt < retries and method in IDEMPOTENT_METHODS:
+                attempt += 1
+                time.sleep(0.5 * 2 ** (attempt - 1))
+                continue
+            STATS.record(
+                method, url, None, 0, start, time.monotonic() - start, attempt, service
+            )
+            raise
+        latency = time.monotonic() - start
+
+        statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else REFUSED_STATUSES
+        if response.status_code in statuses and attempt < retries:
+            attempt += 1
+            delay = response.headers.get("Retry-After", "")
+            delay = int(delay) if delay.isdigit() else 0.5 * 2 ** (attempt - 1)
+            time.sleep(min(delay, MAX_RETRY_DELAY))
+            continue
+
+        if kwargs.get("stream"):
+            nbytes = int(response.headers.get("Content-Length", 0))
+        else:
+            nbytes = len(response.content)
+        STATS.record(
+            method, url, response.status_code, nbytes, start, latency, attempt, service
+        )
+        return response
+
+
+def key_digest(key, url):
+    """Identify an API key for a Kibana URL, without keeping the key."""
+    return hashlib.sha256(f"{url}|{key}".encode("utf-8")).hexdigest()
+
+
+def read_key_cache(path):
+    """Read the times at which API keys were last validated."""
+    try:
+        with open(path, encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def cache_key(digest, path, ttl):
+    """Record that an API key was validated just now, dropping the
+    entries which have expired."""
+    now = time.time()
+    entries = {
+        other: validated
+        for other, validated in read_key_cache(path).items()
+        if now - validated <= ttl
+    }
+    entries[digest] = now
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(entries, outfile)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save the API key cache: {e}", file=sys.stderr)
 
 
 def validate_key(key, url):
-    """Ensure api key and Kibana URL are valid."""
-    resp = requests.get(
-        f"{url}/api/fleet/agent_policies",
+    """Ensure api key and Kibana URL are valid.
+
+    Only a single agent policy is asked for. Keys which were accepted in
+    the last KEY_CACHE_TTL seconds, by this run or a recent one, aren't
+    checked again.
+    """
+    digest = key_digest(key, url)
+    with _key_cache_lock:
+        if digest in _validated:
+            return True
+        validated = read_key_cache(constants.KEY_CACHE).get(digest, 0)
+        if time.time() - validated <= constants.KEY_CACHE_TTL:
+            _validated.add(digest)
+            return True
+
+    resp = send(
+        "GET",
+        f"{url}/api/fleet/agent_policies?perPage=1",
         headers={"Authorization": f"ApiKey {key}"},
-        timeout=10,
     )
 
     if resp.status_code == 404:
@@ -30,43 +154,191 @@ def validate_key(key, url):
 
     resp.raise_for_status()
 
+    with _key_cache_lock:
+        _validated.add(digest)
+        cache_key(digest, constants.KEY_CACHE, constants.KEY_CACHE_TTL)
     return True
 
 
-def generate_map(key, url, extended=False):
-    """Create an integration name->id map from the Kibana API."""
-    idmap = defaultdict(dict)
-    resp = requests.get(
+def agent_policies(key, url, ids):
+    """Return which of the given agent policy ids Kibana has, looking
+    them up in batches of BULK_SIZE."""
+    ids = sorted(set(ids))
+    found = set()
+    for i in range(0, len(ids), BULK_SIZE):
+        resp = send(
+            "POST",
+            f"{url}/api/fleet/agent_policies/_bulk_get",
+            headers={"Authorization": f"ApiKey {key}", "kbn-xsrf": "true"},
+            json={"ids": ids[i : i + BULK_SIZE], "ignoreMissing": True},
+            stream=True,
+        )
+        try:
+            resp.raise_for_status()
+            found.update(policy["id"] for policy in iter_items(resp))
+        finally:
+            resp.close()
+    return found
+
+
+def package_version(key, url):
+    """Return the version of the package installed in Kibana, or None if
+    it isn't installed. It's only looked up once per Kibana."""
+    if url in _package_versions:
+        return _package_versions[url]
+
+    resp = send(
+        "GET",
+        f"{url}/api/fleet/epm/packages/{constants.PACKAGE}",
+        headers={"Authorization": f"ApiKey {key}"},
+    )
+    if resp.status_code == 404:
+        version = None
+    else:
+        resp.raise_for_status()
+        item = resp.json().get("item", {})
+        # Newer versions of Kibana keep it in installationInfo
+        info = item.get("installationInfo") or item.get("savedObject", {}).get(
+            "attributes", {}
+        )
+        version = info.get("version")
+        if version is None and item.get("status") == "installed":
+            version = item.get("version")
+    _package_versions[url] = version
+    return version
+
+
+def iter_items(resp):
+    """Yield the items of a Fleet list response one at a time, as they
+    are parsed from the response body.
+
+    ijson is used to parse them if it's installed, and json_utils if not.
+    """
+    # Imported by name, so type checking (and mypyc) don't need ijson
+    try:
+        ijson = importlib.import_module("ijson")
+    except ImportError:
+        ijson = None
+
+    if ijson is not None:
+        resp.raw.decode_content = True
+        yield from ijson.items(resp.raw, "items.item", use_float=True)
+        return
+
+    for key, index, item in json_utils.iter_object(
+        resp.iter_content(json_utils.CHUNK_SIZE), ("items",)
+    ):
+        if key == "items" and index is not None:
+            yield item
+
+
+def iter_policies(key, url):
+    """Yield each package policy from the Kibana API as it's parsed,
+    so the whole response is never held in memory."""
+    resp = send(
+        "GET",
         f"{url}/api/fleet/package_policies",
         headers={"Authorization": f"ApiKey {key}", "kbn-xsrf": "true"},
-        timeout=10,
+        stream=True,
     )
-    resp_body = resp.json()
+    try:
+        resp.raise_for_status()
+        yield from iter_items(resp)
+    finally:
+        resp.close()
 
-    for integration in resp_body["items"]:
-        name = integration["name"]
-        id_ = integration["id"]
-        if not re.match(r"^\.pcp-", name):
-            continue
 
-        idmap[name]["id"] = id_
-        if extended:
-            idmap[name] = integration
-            idmap[name]["enabled_"] = (
-                integration["inputs"][0]["enabled"]
-                and integration["inputs"][0]["streams"][0]["enabled"]
-            )
-            url = re.match(
-                r"^http:\/\/(.*?)\/pmapi\/fetch\?hostspec=(.*?)&.*&names=(.*)$",
-                integration["inputs"][0]["streams"][0]["vars"]["request_url"]["value"],
-            )
-            idmap[name]["pmproxy_url_"] = url.group(1)
-            idmap[name]["metrics_"] = url.group(3)
-            idmap[name]["hostname_"] = url.group(2)
+def pcp_policies(key, url):
+    """Yield the package policies of the PCP integrations (named .pcp-*)
+    from the Kibana API as they're parsed."""
+    policies = STATS.timed_iter("inventory fetch", iter_policies(key, url))
+    return (policy for policy in policies if re.match(r"^\.pcp-", policy["name"]))
+
 
+def generate_map(key, url, extended=False, slim=False):
+    """Create an integration name->id map from the Kibana API.
+
+    With extended, each integration's package policy is included, along
+    with fields derived from it (ending in _). With slim as well, an
+    Inventory is returned instead, which only keeps the SLIM_FIELDS of
+    each package policy and drops the rest of it as soon as it's parsed.
+    """
+    policies = pcp_policies(key, url)
+    if extended and slim:
+        return Inventory(policies)
+
+    idmap = defaultdict(dict)
+    if not extended:
+        for integration in policies:
+            idmap[integration["name"]]["id"] = integration["id"]
+        return idmap
+
+    for integration, fields in with_derived_fields(policies):
+        integration.update(fields)
+        idmap[integration["name"]] = integration
     return idmap
 
 
+def bulk_get(key, url, ids):
+    """Yield the package policies with the given ids, fetching them in
+    batches of BULK_SIZE. Policies which no longer exist are left out."""
+    ids = list(ids)
+    for i in range(0, len(ids), BULK_SIZE):
+        batch = set(ids[i : i + BULK_SIZE])
+        resp = send(
+            "POST",
+            f"{url}/api/fleet/package_policies/_bulk_get",
+            headers={"Authorization": f"ApiKey {key}", "kbn-xsrf": "true"},
+            json={"ids": sorted(batch), "ignoreMissing": True},
+            stream=True,
+        )
+        try:
+            resp.raise_for_status()
+            for policy in iter_items(resp):
+                if policy["id"] in batch:
+                    yield policy
+        finally:
+            resp.close()
+
+
+def fetch_policies(key, url, idmap, names):
+    """Map each named integration in idmap to its full package policy,
+    with the fields of an extended map.
+
+    Only the policies which idmap doesn't already hold in full (e.g.
+    records of a slim Inventory) are fetched, so that large inventories
+    can be kept slim until the integrations to change are known.
+    """
+    policies = {}
+    missing = {}
+    for name in names:
+        if isinstance(idmap[name], dict) and "inputs" in idmap[name]:
+            policies[name] = idmap[name]
+        else:
+            missing[idmap[name]["id"]] = name
+
+    if not missing:
+        return policies
+    fetched = STATS.timed_iter("inventory fetch", bulk_get(key, url, missing))
+    for policy in fetched:
+        policy.update(derived_fields(policy))
+        policies[missing[policy["id"]]] = policy
+    return policies
+
+
+def fetch_url(pmproxy_url, fqdn, metrics):
+    """Build the pmproxy URL an integration fetches metrics from."""
+    return f"{pmproxy_url}/pmapi/fetch?hostspec={fqdn}&client={fqdn}&names={metrics}"
+
+
+def integration_name(fqdn, group):
+    """Name of the integration created from a group on a host. Staggered
+    groups are named after their nominal interval."""
+    hostname = fqdn[0 : fqdn.find(".")]
+    interval = group.get("nominal_interval", group["interval"])
+    return f".pcp-{hostname}-{interval}{group.get('suffix', '')}"
+
+
 def br_create(config, group):
     """Build HTTP request for the create command."""
     headers = {
@@ -76,15 +348,14 @@ def br_create(config, group):
     }
 
     fqdn = group["fqdn"]
-    hostname = fqdn[0 : fqdn.find(".")]
 
     body = {
         "policy_id": f"{group['policy_id']}",
         "package": {
-            "name": "httpjson",
-            "version": "1.20.0",
+            "name": constants.PACKAGE,
+            "version": config.get("package_version") or constants.PACKAGE_VERSION,
         },
-        "name": f".pcp-{hostname}-{group['interval']}",
+        "name": integration_name(fqdn, group),
         "description": f"Collect PCP metrics from {fqdn} every {group['interval']}",
         "namespace": "default",
         "inputs": {
@@ -96,10 +367,9 @@ def br_create(config, group):
                         "vars": {
                             "data_stream.dataset": "httpjson.pcp",
                             "pipeline": "pmwebapi-parser",
-                            "request_url": f"{group['pmproxy_url']}/pmapi/fetch"
-                            f"?hostspec={fqdn}"
-                            f"&client={fqdn}"
-                            f"&names={group['metrics']}",
+                            "request_url": fetch_url(
+                                group["pmproxy_url"], fqdn, group["metrics"]
+                            ),
                             "request_interval": f"{group['interval']}",
                             "request_method": "GET",
                             "request_redirect_headers_ban_list": [],
@@ -134,17 +404,17 @@ def br_update(config, id_):
     url = f"{config['kibana_url']}/api/fleet/package_policies/{id_}"
     headers = {"Authorization": f"ApiKey {config['api_key']}", "kbn-xsrf": "exists"}
 
-    url_re = re.compile(r"^.*?(/p.*?spec=).*?(&client=).*?(&names=).*$")
+    url_re = re.compile(r"^.*?(/pmapi/fetch\?hostspec=).*?(&client=).*?(&names=).*$")
     for inp in config["inputs"]:
         for stream in config["inputs"][inp]["streams"]:
             old_url = config["inputs"][inp]["streams"][stream]["vars"]["request_url"]
             transformed_url = url_re.sub(
                 config["pmproxy_url_"]
+                + r"\1"
+                + config["hostname_"]
                 + r"\2"
                 + config["hostname_"]
                 + r"\3"
-                + config["hostname_"]
-                + r"\4"
                 + config["metrics_"],
                 old_url,
             )
@@ -161,7 +431,32 @@ def br_update(config, id_):
     return (method, url, headers, config)
 
 
-def build_request(config, mode, group=None, id_=None):
+def br_upgrade(config, ids, dry_run=False):
+    """Build HTTP request for the upgrade command, or for checking what
+    upgrading would change with dry_run."""
+    method = "POST"
+    url = f"{config['kibana_url']}/api/fleet/package_policies/upgrade"
+    if dry_run:
+        url += "/dryrun"
+    headers = {"Authorization": f"ApiKey {config['api_key']}", "kbn-xsrf": "exists"}
+    return (method, url, headers, {"packagePolicyIds": list(ids)})
+
+
+def br_rollback(config, entry):
+    """Build HTTP request for undoing a change recorded in a journal."""
+    headers = {
+        "Authorization": f"ApiKey {config['api_key']}",
+        "Content-Type": "application/json",
+        "kbn-xsrf": "exists",
+    }
+    url = f"{config['kibana_url']}/api/fleet/package_policies"
+    if entry["kind"] == "DELETE":
+        # Recreated with the same id, so id maps stay valid
+        return ("POST", url, headers, dict(entry["body"], id=entry["id"]))
+    return ("PUT", f"{url}/{entry['id']}", headers, entry["body"])
+
+
+def build_request(config, mode, group=None, id_=None, ids=None, entry=None):
     """Pass control to the request builder for the specified command."""
     if mode == constants.CREATE:
         return br_create(config, group)
@@ -171,17 +466,26 @@ def build_request(config, mode, group=None, id_=None):
         return br_list(config)
     if mode == constants.UPDATE:
         return br_update(config, id_)
+    if mode == constants.UPGRADE:
+        return br_upgrade(config, ids)
+    if mode == constants.ROLLBACK:
+        return br_rollback(config, entry)
 
     print("what the")
     sys.exit(1)
 
 
 def request(req, mode):
-    """Send HTTP request with info from req."""
+    """Send HTTP request with info from req.
+
+    In a dry run, the request is only recorded.
+    """
+    if DRY_RUN.enabled:
+        DRY_RUN.record(req)
+        return {}
+
     if mode == constants.CREATE:
-        response = requests.request(
-            req[0], req[1], headers=req[2], json=req[3], timeout=10
-        )
+        response = send(req[0], req[1], headers=req[2], json=req[3])
         if response.status_code == 409:
             print(response.text)
             return {}
@@ -191,21 +495,51 @@ def request(req, mode):
         return {int_name: int_id}
 
     if mode == constants.DELETE:
-        response = requests.request(req[0], req[1], headers=req[2], timeout=10)
+        response = send(req[0], req[1], headers=req[2])
         if response.status_code != 200:
             print(response.text)
-        return {}
+            return {}
+        return {"deleted": True}
 
     if mode == constants.LIST:
         pass
 
     if mode == constants.UPDATE:
-        response = requests.request(
-            req[0], req[1], headers=req[2], json=json.dumps(req[3]), timeout=10
-        )
+        response = send(req[0], req[1], headers=req[2], json=req[3])
         # Handled in caller
         response.raise_for_status()
+        return response.json().get("item", {})
+
+    if mode == constants.UPGRADE:
+        response = send(req[0], req[1], headers=req[2], json=req[3])
+        response.raise_for_status()
+        # A result for each package policy id
+        return response.json()
+
+    if mode == constants.ROLLBACK:
+        response = send(req[0], req[1], headers=req[2], json=req[3])
+        response.raise_for_status()
         return {}
 
     print("invalid mode", file=sys.stderr)
     sys.exit(1)
+
+
+def request_many(reqs, mode, workers=constants.WORKERS):
+    """Send several HTTP requests concurrently.
+
+    Returns a list of (result, exception) pairs in the same order as reqs,
+    where the exception is None if the request succeeded.
+    """
+
+    def attempt(req):
+        try:
+            return (request(req, mode), None)
+        except requests.exceptions.RequestException as e:
+            return (None, e)
+
+    if not reqs:
+        return []
+    with STATS.phase("dispatch"):
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            return list(pool.map(attempt, reqs))
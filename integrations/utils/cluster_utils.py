@@ -0,0 +1,165 @@
+"""Functions for running commands against several Kibana clusters.
+
+Besides the [kibana] section, web_config.ini can name other clusters
+in sections like [kibana:dc2], each with its own kibana_url and api_key.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import configparser
+import os
+import sys
+import threading
+import traceback
+
+# Name of the cluster in the plain [kibana] section
+DEFAULT = "default"
+# Selects every cluster in web_config.ini
+ALL = "all"
+SECTION_PREFIX = "kibana:"
+
+_context = threading.local()
+
+
+def clusters(web_info):
+    """Return the names of the clusters in web_config.ini, in order."""
+    names = [DEFAULT] if web_info.has_section("kibana") else []
+    names += [
+        section[len(SECTION_PREFIX) :]
+        for section in web_info.sections()
+        if section.startswith(SECTION_PREFIX)
+    ]
+    return names
+
+
+def select(web_info, selectors):
+    """Resolve the --cluster options into cluster names. Without any,
+    the default cluster is used, or the only cluster if there's one.
+
+    Raises ValueError if a cluster isn't in web_config.ini.
+    """
+    names = clusters(web_info)
+    if not selectors:
+        return names[:1]
+
+    selected = []
+    for selector in selectors:
+        for name in selector.split(","):
+            if name == ALL:
+                wanted = names
+            elif name in names:
+                wanted = [name]
+            else:
+                raise ValueError(f"No cluster named {name} in web_config.ini")
+            selected.extend(name for name in wanted if name not in selected)
+    return selected
+
+
+def current():
+    """The name of the cluster the current thread is working on, if any."""
+    return getattr(_context, "cluster", None)
+
+
+def cluster_config(web_info, name=None):
+    """Return web_info with the [kibana] section replaced by the named
+    cluster's, or the current cluster's if no name is given."""
+    name = name or current()
+    if name is None or name == DEFAULT:
+        return web_info
+
+    config = configparser.ConfigParser()
+    config.read_dict(web_info)
+    config.remove_section("kibana")
+    config.read_dict({"kibana": dict(web_info[SECTION_PREFIX + name])})
+    return config
+
+
+def cluster_path(path, name=None):
+    """Return the path of a per-cluster file, such as an id map, for the
+    named (or current) cluster. The default cluster uses path as it is,
+    and the others insert their name before its extension."""
+    name = name or current()
+    if name is None or name == DEFAULT:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+class ClusterOutput:
+    """Stand-in for sys.stdout or sys.stderr which keeps what the threads
+    of each cluster write, so it can be printed in one piece."""
+
+    def __init__(self, stream, buffers):
+        self.stream = stream
+        self.buffers = buffers
+
+    def write(self, text):
+        buffer = self.buffers.get(current())
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append((self.stream, text))
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_in(name, func, *args):
+    """Call func(*args) while working on the named cluster."""
+    previous = current()
+    _context.cluster = name
+    try:
+        return func(*args)
+    finally:
+        _context.cluster = previous
+
+
+def fan_out(names, func, workers=None):
+    """Call func() once for each of the named clusters, running
+    workers of them (by default, all of them) at once.
+
+    The output of each cluster is printed in one piece, after a header
+    on stderr, as soon as it finishes. With one worker, clusters are run
+    in order and their output isn't held back, so they can ask for input.
+    Returns a map of each cluster to the exit status it ended with.
+    """
+    workers = workers or len(names)
+    buffers = {}
+    streams = (sys.stdout, sys.stderr)
+    lock = threading.Lock()
+
+    def attempt(name):
+        if workers > 1:
+            buffers[name] = []
+        else:
+            print(f"=== cluster {name} ===", file=sys.stderr)
+        try:
+            run_in(name, func)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            # One cluster failing shouldn't stop the others
+            traceback.print_exc()
+            status = 1
+
+        output = buffers.pop(name, None)
+        if output is not None:
+            with lock:
+                streams[1].write(f"=== cluster {name} ===\n")
+                for stream, text in output:
+                    stream.write(text)
+                for stream in streams:
+                    stream.flush()
+        return status
+
+    if workers > 1:
+        sys.stdout = ClusterOutput(streams[0], buffers)
+        sys.stderr = ClusterOutput(streams[1], buffers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(names, pool.map(attempt, names)))
+    finally:
+        sys.stdout, sys.stderr = streams
@@ -0,0 +1,76 @@
+"""Recording and estimating the HTTP requests a run would send.
+"""
+
+import threading
+
+import constants
+from utils import stats
+
+# Latency assumed for requests to endpoints which have never been measured
+DEFAULT_LATENCY = 0.5
+
+
+class DryRun:
+    """Collects the write requests a dry run would have sent."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def record(self, req):
+        """Record a request built by api_utils.build_request."""
+        body = req[3] if len(req) > 3 and isinstance(req[3], dict) else {}
+        with self.lock:
+            self.calls.append((req[0], req[1], body.get("name")))
+
+    def estimate(self, workers, run_stats, path=constants.LATENCY_FILE):
+        """Estimate how long the recorded requests would take to send,
+        workers at a time.
+
+        Each request is assumed to take the median latency its endpoint
+        had in the last run which used it. Endpoints which haven't been
+        measured are assumed to take the median latency of the requests
+        sent so far in this run, if any. Returns (seconds, unmeasured)
+        where unmeasured is the number of requests which were guessed.
+        """
+        saved = stats.load_latencies(path)
+        measured = sorted(rec.latency for rec in run_stats.kibana_requests())
+        fallback = stats.percentile(measured, 50) if measured else DEFAULT_LATENCY
+
+        total = 0.0
+        longest = 0.0
+        unmeasured = 0
+        for method, url, __ in self.calls:
+            entry = saved.get(f"{method} {stats.endpoint_template(url)}")
+            if entry is None:
+                unmeasured += 1
+            latency = fallback if entry is None else entry["p50"]
+            total += latency
+            longest = max(longest, latency)
+
+        parallel = max(1, min(workers, len(self.calls)))
+        return (max(longest, total / parallel), unmeasured)
+
+    def report(self, workers, run_stats, path=constants.LATENCY_FILE):
+        """Build a list of the recorded requests and an estimate of how
+        long they would take."""
+        lines = [
+            f"{method} {url}" + (f"  ({name})" if name else "")
+            for method, url, name in self.calls
+        ]
+        seconds, unmeasured = self.estimate(workers, run_stats, path)
+        lines.append(
+            f"\nDry run: {len(self.calls)} request(s) planned, estimated to take"
+            f" {seconds:.1f} s with {workers} worker(s)."
+        )
+        if unmeasured:
+            lines.append(
+                f"{unmeasured} of them are to endpoints with no measured latency,"
+                " so their latency was guessed."
+            )
+        return "\n".join(lines)
+
+
+# The dry run state for this run
+DRY_RUN = DryRun()
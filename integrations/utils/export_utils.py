@@ -0,0 +1,50 @@
+"""Functions for turning existing integrations back into a create config.
+"""
+
+import json
+
+from utils.inventory import intern
+
+
+def group(integration):
+    """Build the create config group which makes an integration again.
+
+    integration is a package policy with its derived fields (ending in
+    _), or a record from an Inventory.
+    """
+    fqdn = integration["hostname_"]
+    interval = integration["interval_"]
+    config_group = {
+        "policy_id": intern(integration["policy_id"]),
+        "pmproxy_url": intern(integration["pmproxy_url_"]),
+        "interval": intern(interval),
+        "metrics": intern(integration["metrics_"]),
+    }
+    # Whatever follows the name create would give it is kept as its suffix
+    prefix = f".pcp-{fqdn[0 : fqdn.find('.')]}-{interval}"
+    if integration["name"].startswith(prefix) and integration["name"] != prefix:
+        config_group["suffix"] = integration["name"][len(prefix) :]
+    return config_group
+
+
+def group_nodes(integrations):
+    """Group integrations into create config nodes by host, in one pass
+    through a map of each host to its groups. Hosts are yielded in the
+    order they were first seen."""
+    hosts = {}
+    for integration in integrations:
+        fqdn = intern(integration["hostname_"])
+        hosts.setdefault(fqdn, []).append(group(integration))
+    return ({"fqdn": fqdn, "groups": groups} for fqdn, groups in hosts.items())
+
+
+def write_config(nodes, outfile):
+    """Write a create config holding nodes to outfile, a node at a time.
+    Returns how many nodes were written."""
+    outfile.write('{"nodes": [')
+    count = 0
+    for node in nodes:
+        outfile.write(("," if count else "") + "\n  " + json.dumps(node))
+        count += 1
+    outfile.write("\n]}\n")
+    return count
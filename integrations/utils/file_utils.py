@@ -1,24 +1,144 @@
 """Functions for working with local files.
 """
 
+import functools
 import json
 import os
 import sys
 import configparser
 
-import jsonschema
+import constants
+from utils import cluster_utils, host_utils, json_utils
+from utils.lazy_utils import lazy_import
 
-# from pcp import pmapi
-# import cpmapi as c_api
+jsonschema = lazy_import("jsonschema")
 
-import constants
+GROUP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "policy_id": {"type": "string"},
+        "pmproxy_url": {"type": "string"},
+        "interval": {"type": "string", "pattern": r"^[1-9][0-9]*[smh]$"},
+        "nominal_interval": {"type": "string", "pattern": r"^[1-9][0-9]*[smh]$"},
+        "metrics": {"type": "string"},
+        "pmproxy_pool": {
+            "type": "array",
+            "items": {"type": "string", "pattern": r"^[^=\s]+(=[1-9][0-9]*)?$"},
+            "minItems": 1,
+        },
+        "policy_pool": {
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 1,
+        },
+        "suffix": {"type": "string"},
+    },
+    "required": [
+        "interval",
+        "metrics",
+    ],
+}
+
+NODE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "fqdn": {"type": "string"},
+        "groups": {"type": "array", "items": GROUP_SCHEMA},
+    },
+    "required": ["fqdn", "groups"],
+}
+
+# Compact create configs give hosts, whose fqdn can be a range expression,
+# using named templates of groups
+HOST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "fqdn": {"type": "string"},
+        "template": {"type": "string"},
+        "templates": {"type": "array", "items": {"type": "string"}},
+        "groups": {"type": "array", "items": GROUP_SCHEMA},
+    },
+    "required": ["fqdn"],
+}
+
+TEMPLATES_SCHEMA = {
+    "type": "object",
+    "additionalProperties": {"type": "array", "items": GROUP_SCHEMA},
+}
+
+SCHEMAS = {
+    constants.CREATE: {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "type": "object",
+        "properties": {
+            "nodes": {"type": "array", "items": NODE_SCHEMA},
+            "hosts": {"type": "array", "items": HOST_SCHEMA},
+        },
+        "anyOf": [{"required": ["nodes"]}, {"required": ["hosts"]}],
+    },
+    constants.LIST: {},
+    constants.DELETE: {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "type": "object",
+        "properties": {
+            "names": {"type": "array", "items": {"type": "string"}},
+            "ids": {"type": "array", "items": {"type": "string"}},
+        },
+        "oneOf": [{"required": ["names"]}, {"required": ["ids"]}],
+    },
+    constants.UPDATE: {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "type": "object",
+        "properties": {
+            "operations": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "select": {"type": "string"},
+                        "enabled": {"type": "boolean"},
+                        "interval": {
+                            "type": "string",
+                            "pattern": r"^[1-9][0-9]*[smh]$",
+                        },
+                        "pmproxy_url": {"type": "string"},
+                        "add_metrics": {
+                            "type": "string",
+                            "pattern": r"^\w+(\.\w+)*(,\w+(\.\w+)*)*$",
+                        },
+                        "remove_metrics": {
+                            "type": "string",
+                            "pattern": r"^\w+(\.\w+)*(,\w+(\.\w+)*)*$",
+                        },
+                    },
+                    "required": ["select"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["operations"],
+    },
+}
+
+# Arrays which are streamed from config files and validated one item at a time
+STREAMED = {
+    constants.CREATE: {"nodes": NODE_SCHEMA, "hosts": HOST_SCHEMA},
+    constants.DELETE: {"names": {"type": "string"}, "ids": {"type": "string"}},
+}
+
+# Values which are validated and yielded as soon as they are read,
+# because the streamed items after them depend on them
+EARLY = {
+    constants.CREATE: {"templates": TEMPLATES_SCHEMA},
+}
 
 
 def read_config():
-    """Read web_config.ini file."""
+    """Read web_config.ini file. When working on a cluster other than
+    the default one, its section is returned as [kibana]."""
     cfg = configparser.ConfigParser()
     cfg.read(f"{constants.ROOT_DIR}/config/web_config.ini")
-    return cfg
+    return cluster_utils.cluster_config(cfg)
 
 
 def load_file(infile):
@@ -35,94 +155,169 @@ def load_file(infile):
             sys.exit(1)
 
 
-def check_conf(config, mode):
-    """Validate config against a schema, chosen depending on mode."""
-    schemas = {
-        constants.CREATE: {
-            "$schema": "http://json-schema.org/draft-04/schema#",
-            "type": "object",
-            "properties": {
-                "api_key": {"type": "string"},
-                "kibana_url": {"type": "string"},
-                "nodes": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "fqdn": {"type": "string"},
-                            "groups": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "policy_id": {"type": "string"},
-                                        "pmproxy_url": {"type": "string"},
-                                        "interval": {"type": "string"},
-                                        "metrics": {"type": "string"},
-                                    },
-                                    "required": [
-                                        "policy_id",
-                                        "pmproxy_url",
-                                        "interval",
-                                        "metrics",
-                                    ],
-                                },
-                            },
-                        },
-                        "required": ["fqdn", "groups"],
-                    },
-                },
-            },
-            "required": ["api_key", "kibana_url", "nodes"],
-        },
-        constants.LIST: {},
-        constants.DELETE: {
-            "$schema": "http://json-schema.org/draft-04/schema#",
-            "type": "object",
-            "properties": {
-                "api_key": {"type": "string"},
-                "kibana_url": {"type": "string"},
-                "names": {"type": "array", "items": {"type": "string"}},
-                "ids": {"type": "array", "items": {"type": "string"}},
-            },
-            "required": ["api_key", "kibana_url"],
-            "oneOf": [{"required": ["names"]}, {"required": ["ids"]}],
-        },
-        constants.UPDATE: {},
-    }
+def validate_conf(config, mode):
+    """Validate config against a schema, chosen depending on mode.
+
+    Exits if the config is invalid.
+    """
+    errors = schema_errors(get_validator(mode), config)
+    if errors:
+        report_errors(errors)
+        sys.exit(1)
 
+
+def iter_config(infile, mode, errors):
+    """Stream the items of a create or delete config file, validating each one.
+
+    Yields (key, item) for each valid item in the mode's streamed arrays
+    (nodes and hosts for create, names and ids for delete), and for each
+    valid early value (templates for create). Invalid items are
+    skipped, and their errors are appended to errors along with their
+    JSON paths. The rest of the config is validated once the whole file
+    has been read.
+    """
+    streamed = STREAMED[mode]
+    early = EARLY.get(mode, {})
+    rest = {}
+    with open(infile, encoding="utf-8") as infd:
+        try:
+            for key, index, item in json_utils.iter_file(infd, streamed):
+                if index is None and key in early:
+                    item_errors = schema_errors(get_validator(mode, key), item, (key,))
+                    errors.extend(item_errors)
+                    if not item_errors:
+                        yield (key, item)
+                    continue
+                if index is None:
+                    rest[key] = item
+                    continue
+
+                item_errors = schema_errors(
+                    get_validator(mode, key), item, (key, index)
+                )
+                if item_errors:
+                    errors.extend(item_errors)
+                    continue
+                yield (key, item)
+
+        except json.decoder.JSONDecodeError as err:
+            errors.append(f"Failed to parse JSON in {infile}: {err}")
+            return
+
+    errors.extend(schema_errors(get_validator(mode), rest))
+
+
+def iter_nodes(infile, errors):
+    """Stream the nodes of a create config file, validating each one.
+
+    Hosts in compact configs are expanded into nodes as they're read,
+    with their templates' groups followed by their own. Templates and
+    host ranges are only validated once, however many nodes they make.
+    """
+    templates = {}
+    for key, item in iter_config(infile, constants.CREATE, errors):
+        if key == "nodes":
+            yield item
+        elif key == "templates":
+            templates.update(item)
+        else:
+            yield from expand_host(item, templates, errors)
+
+
+def expand_host(host, templates, errors):
+    """Yield a node for each host in a compact host's fqdn."""
+    names = host.get("templates", [])
+    if "template" in host:
+        names = [host["template"]] + names
+    missing = [name for name in names if name not in templates]
+    if missing:
+        errors.append(
+            f"{host['fqdn']}: unknown template(s) {', '.join(missing)}."
+            " Templates must come before hosts in the file."
+        )
+        return
+
+    groups = [group for name in names for group in templates[name]]
+    groups += host.get("groups", [])
     try:
-        jsonschema.validate(config, schemas[mode])
-    except jsonschema.exceptions.ValidationError as exception:
-        print("Config file is invalid:", file=sys.stderr)
-        print(exception.message, file=sys.stderr)
+        for fqdn in host_utils.expand_hosts(host["fqdn"]):
+            # Groups are changed in place further down the pipeline
+            yield {"fqdn": fqdn, "groups": [dict(group) for group in groups]}
+    except ValueError as e:
+        errors.append(f"{host['fqdn']}: {e}")
 
-        # TODO: fix this super duper jank
-        if "is valid under each of" in exception.message:
-            print(
-                "Ensure that you haven't specified conflicting keys!", file=sys.stderr
-            )
+
+def load_config(infile, mode):
+    """Load and validate a create or delete config file.
+
+    Exits if the config is invalid.
+    """
+    config = {}
+    errors = []
+    for key, item in iter_config(infile, mode, errors):
+        config.setdefault(key, []).append(item)
+
+    if errors:
+        report_errors(errors)
+        sys.exit(1)
+    return config
+
+
+def check_file(infile, mode):
+    """Validate a create or delete config file, then exit."""
+    errors = []
+    if mode == constants.CREATE:
+        items = iter_nodes(infile, errors)
+    else:
+        items = iter_config(infile, mode, errors)
+    for __ in items:
+        pass
+
+    if errors:
+        report_errors(errors)
         sys.exit(1)
 
     print("Config file is valid.")
     sys.exit(0)
 
 
-# Attempt at expanding metric names
-# The pmapi struggles with finding the correct PMNS
-"""
-def expand_metrics(group):
-    expanded = []
-    ctx = pmapi.pmContext(c_api.PM_CONTEXT_HOST, group['fqdn'])
+@functools.lru_cache(maxsize=None)
+def get_validator(mode, key=None):
+    """Build the validator for a mode's config,
+    or for the items of one of its streamed arrays."""
+    if key is None:
+        schema = SCHEMAS[mode]
+    else:
+        schema = STREAMED[mode].get(key) or EARLY[mode][key]
+    return jsonschema.Draft4Validator(schema)
 
-    def add_metric(name):
-        expanded.append(name)
 
-    for metric in group['metrics'].split(','):
-        ctx.pmTraversePMNS(metric, add_metric)
+def schema_errors(validator, instance, path=()):
+    """Return every error in instance, each prefixed with its JSON path."""
+    errors = []
+    for error in validator.iter_errors(instance):
+        message = (
+            f"{json_path(tuple(path) + tuple(error.absolute_path))}: {error.message}"
+        )
+        if error.validator == "oneOf":
+            message += " Ensure that you haven't specified conflicting keys!"
+        errors.append(message)
+    return errors
 
-    group['metrics'] = ','.join(expanded)
-"""
+
+def json_path(path):
+    """Format a sequence of keys and indices as a JSON path."""
+    out = "$"
+    for part in path:
+        out += f"[{part}]" if isinstance(part, int) else f".{part}"
+    return out
+
+
+def report_errors(errors):
+    """Print the errors found in a config file."""
+    print("Config file is invalid:", file=sys.stderr)
+    for error in errors:
+        print(error, file=sys.stderr)
 
 
 def try_init_json(path):
@@ -137,11 +332,11 @@ def try_init_json(path):
             json.dump({}, newfile)
 
 
-def update_idmap(new_map, args):
+def update_idmap(new_map, path):
     """Update the name->id mapping with the newly created integrations."""
-    with open(args.out, mode="r+", encoding="utf-8") as outfile:
+    with open(path, mode="r+", encoding="utf-8") as outfile:
         try:
-            file_map = json.load(outfile) if os.path.getsize(args.out) > 0 else {}
+            file_map = json.load(outfile) if os.path.getsize(path) > 0 else {}
             file_map.update(new_map)
             outfile.seek(0)
             json.dump(file_map, outfile)
@@ -149,5 +344,5 @@ def update_idmap(new_map, args):
             # Shouldn't happen, but just in case.
             outfile.truncate()
         except json.decoder.JSONDecodeError:
-            print(f"Failed to parse JSON in {args.out}.", file=sys.stderr)
+            print(f"Failed to parse JSON in {path}.", file=sys.stderr)
             sys.exit(1)
@@ -0,0 +1,51 @@
+"""Functions for expanding compact host range expressions.
+"""
+
+import itertools
+import re
+
+# A bracketed range list, e.g. [001-400] or [1,3,5-7]
+_RANGE = re.compile(r"\[([^\[\]]*)\]")
+
+
+def parse_ranges(text):
+    """Parse the inside of a bracketed range list into a list of ranges,
+    each a (start, stop, width) where width is the zero-padding to use."""
+    ranges = []
+    for part in text.split(","):
+        start, __, end = part.strip().partition("-")
+        end = end or start
+        if not (start.isdigit() and end.isdigit()) or int(end) < int(start):
+            raise ValueError(f"Invalid host range [{text}]")
+        width = len(start) if start.startswith("0") else 0
+        ranges.append((int(start), int(end) + 1, width))
+    return ranges
+
+
+def expand_hosts(pattern):
+    """Lazily yield the hosts in a pattern such as web[001-400].dc1.example.com.
+
+    A pattern can have several range lists, which expand to every
+    combination of their values. Numbers are zero-padded to the width
+    of the range's start if it begins with 0.
+    Raises ValueError if a range list is invalid.
+    """
+    parts = _RANGE.split(pattern)
+    # Odd parts are the insides of range lists
+    values = []
+    for text in parts[1::2]:
+        values.append(
+            [
+                (number, width)
+                for start, stop, width in parse_ranges(text)
+                for number in range(start, stop)
+            ]
+        )
+    if any(char in part for part in parts[::2] for char in "[]"):
+        raise ValueError(f"Unbalanced brackets in {pattern}")
+
+    for combo in itertools.product(*values):
+        host = parts[0]
+        for (number, width), literal in zip(combo, parts[2::2]):
+            host += str(number).zfill(width) + literal
+        yield host
@@ -0,0 +1,174 @@
+"""A compact, read-only store for the integrations in Kibana.
+
+Large inventories repeat the same pmproxy URLs, intervals, agent policies
+and metric names across thousands of integrations, so each is held once
+and shared between the records which use it.
+"""
+
+from collections.abc import Mapping
+import re
+import sys
+
+# Matches the request_url of an integration, capturing the pmproxy URL
+# (with its scheme), the host and the metrics
+REQUEST_URL = re.compile(
+    r"^([a-z]+:\/\/.*?)\/pmapi\/fetch\?hostspec=(.*?)&.*&names=(.*)$"
+)
+
+# Keys of the records in an extended map, and the attributes holding them
+KEYS = {
+    "id": "id",
+    "name": "name",
+    "policy_id": "policy_id",
+    "version": "version",
+    "enabled_": "enabled",
+    "pmproxy_url_": "pmproxy_url",
+    "metrics_": None,
+    "hostname_": "hostname",
+    "interval_": "interval",
+    "package_version_": "package_version",
+}
+
+
+def derived_fields(policy):
+    """Work out the fields of an extended map (ending in _) which are
+    derived from a package policy.
+
+    Raises ValueError if its request_url isn't a pmproxy fetch URL.
+    """
+    stream = policy["inputs"][0]["streams"][0]
+    url = REQUEST_URL.match(stream["vars"]["request_url"]["value"])
+    if url is None:
+        raise ValueError(
+            f"Skipping {policy['name']}: can't parse its request_url"
+            f" {stream['vars']['request_url']['value']}"
+        )
+    return {
+        "enabled_": policy["inputs"][0]["enabled"] and stream["enabled"],
+        "pmproxy_url_": url.group(1),
+        "metrics_": url.group(3),
+        "hostname_": url.group(2),
+        "interval_": stream["vars"]["request_interval"]["value"],
+        "package_version_": policy["package"]["version"],
+    }
+
+
+def with_derived_fields(policies):
+    """Yield each package policy with its derived fields, skipping the
+    ones they can't be worked out for with a warning."""
+    for policy in policies:
+        try:
+            fields = derived_fields(policy)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            continue
+        yield policy, fields
+
+
+def intern(value):
+    """Intern value if it's a string."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Integration(Mapping):
+    """A single integration in an Inventory.
+
+    Its fields are attributes, and can also be looked up by the keys of an
+    extended map from api_utils.generate_map. metric_ids holds the ids of
+    its metrics in the inventory's metric table.
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "policy_id",
+        "version",
+        "enabled",
+        "pmproxy_url",
+        "hostname",
+        "interval",
+        "package_version",
+        "metric_ids",
+        "table",
+    )
+
+    def __init__(self, table, **fields):
+        self.table = table
+        for key in self.__slots__[:-1]:
+            setattr(self, key, fields[key])
+
+    @property
+    def metrics(self):
+        """The names of the integration's metrics, in order."""
+        return tuple(self.table[id_] for id_ in self.metric_ids)
+
+    def __getitem__(self, key):
+        if key not in KEYS:
+            raise KeyError(key)
+        if key == "metrics_":
+            return ",".join(self.metrics)
+        return getattr(self, KEYS[key])
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    def __repr__(self):
+        return f"Integration({dict(self)!r})"
+
+
+class Inventory(Mapping):
+    """Map of integration names to Integration records.
+
+    Strings which repeat between integrations are interned, each distinct
+    metric name is stored once in a table and referred to by its index,
+    and integrations with the same metrics share one tuple of ids.
+    """
+
+    def __init__(self, policies=()):
+        self.records = {}
+        self.metric_table = []
+        self.metric_index = {}
+        self.metric_lists = {}
+        for policy, fields in with_derived_fields(policies):
+            self.add(policy, fields)
+
+    def metric_id(self, metric):
+        """Return the id of a metric name, adding it to the table if it's new."""
+        id_ = self.metric_index.get(metric)
+        if id_ is None:
+            id_ = self.metric_index[metric] = len(self.metric_table)
+            self.metric_table.append(sys.intern(metric))
+        return id_
+
+    def add(self, policy, fields=None):
+        """Add a package policy from the Fleet API, keeping only the fields
+        of a slim extended map. Returns its record."""
+        fields = fields or derived_fields(policy)
+        ids = tuple(self.metric_id(metric) for metric in fields["metrics_"].split(","))
+        record = Integration(
+            self.metric_table,
+            id=policy["id"],
+            name=policy["name"],
+            policy_id=intern(policy.get("policy_id")),
+            version=policy.get("version"),
+            enabled=fields["enabled_"],
+            pmproxy_url=intern(fields["pmproxy_url_"]),
+            hostname=intern(fields["hostname_"]),
+            interval=intern(fields["interval_"]),
+            package_version=intern(fields["package_version_"]),
+            metric_ids=self.metric_lists.setdefault(ids, ids),
+        )
+        self.records[record.name] = record
+        return record
+
+    def __getitem__(self, name):
+        return self.records[name]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
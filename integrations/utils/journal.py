@@ -0,0 +1,128 @@
+"""An append-only journal of the changes made to integrations, so a run
+can be rolled back.
+
+Each run that changes integrations writes one JSON line per change to
+config/journal/<run id>.jsonl before the change is sent, holding the
+request body which puts the integration back as it was. Once Kibana has
+answered, another line records whether the change was applied.
+"""
+
+import json
+import os
+import threading
+import time
+
+import constants
+from interactive.transform import transform_body
+from utils import cluster_utils
+
+# Kinds of change, and how each is undone
+PUT = "PUT"  # Undone by putting the old body back
+DELETE = "DELETE"  # Undone by creating the integration again
+
+# Outcomes of a change. Changes without one may or may not have been applied.
+APPLIED = "applied"
+FAILED = "failed"
+
+
+def new_run_id():
+    """Make an id for this run, which sorts by when the run started."""
+    return time.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+
+
+def journal_path(run_id, directory=constants.JOURNAL_DIR, cluster=None):
+    """Path of the journal of a run, on the named (or current) cluster."""
+    return cluster_utils.cluster_path(f"{directory}/{run_id}.jsonl", cluster)
+
+
+class Journal:
+    """Records the state of integrations before this run changed them."""
+
+    def __init__(self, directory=constants.JOURNAL_DIR):
+        self.directory = directory
+        self.run_id = new_run_id()
+        self.lock = threading.Lock()
+        self.files = {}
+        self.seq = 0
+
+    def write(self, entry):
+        """Append an entry to the journal of the current cluster, and flush
+        it to disk before going on."""
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        path = journal_path(self.run_id, self.directory)
+        with self.lock:
+            if path not in self.files:
+                os.makedirs(self.directory, exist_ok=True)
+                self.files[path] = open(path, "a", encoding="utf-8")
+            self.files[path].write(line)
+            self.files[path].flush()
+            os.fsync(self.files[path].fileno())
+
+    def record(self, kind, policy):
+        """Record that a package policy from Kibana is about to be changed
+        (PUT) or deleted (DELETE), keeping what's needed to undo it.
+
+        Must be called before the request is sent. Returns the entry's
+        sequence number, to pass to resolve once the outcome is known.
+        """
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        self.write(
+            {
+                "seq": seq,
+                "kind": kind,
+                "id": policy["id"],
+                "name": policy["name"],
+                "body": transform_body(policy),
+            }
+        )
+        return seq
+
+    def resolve(self, seq, id_, applied):
+        """Record whether the change recorded as seq was applied."""
+        self.write({"seq": seq, "id": id_, "status": APPLIED if applied else FAILED})
+
+    def written(self):
+        """Whether anything has been recorded in this run."""
+        return bool(self.files)
+
+    def close(self):
+        """Close the run's journal files."""
+        with self.lock:
+            for journal_file in self.files.values():
+                journal_file.close()
+            self.files = {}
+
+
+def load(run_id, directory=constants.JOURNAL_DIR, cluster=None):
+    """Load the entries of a run's journal, keeping the first change to
+    each integration which wasn't known to fail, since that holds its
+    state before the run. Changes whose outcome was never recorded, such
+    as one in flight when the run was killed, are kept.
+
+    Raises OSError if there's no journal for the run.
+    """
+    changes = []
+    statuses = {}
+    with open(journal_path(run_id, directory, cluster), encoding="utf-8") as infile:
+        for line in infile:
+            # A run which was killed may have left a partial last line
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "status" in entry:
+                statuses[(entry["seq"], entry["id"])] = entry["status"]
+            else:
+                changes.append(entry)
+
+    entries = {}
+    for entry in changes:
+        if statuses.get((entry.get("seq"), entry["id"])) != FAILED:
+            entries.setdefault(entry["id"], entry)
+    return list(entries.values())
+
+
+# The journal of this run
+JOURNAL = Journal()
@@ -0,0 +1,131 @@
+"""Functions for incrementally parsing large JSON documents.
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_CHARS = "0123456789.eE+-"
+
+
+class JSONReader:
+    """Read JSON values one at a time from an iterable of text or byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Append the next chunk to the buffer, dropping the consumed part.
+
+        Returns False if there are no chunks left.
+        """
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            chunk = self.utf8.decode(b"", final=True)
+        elif isinstance(chunk, bytes):
+            chunk = self.utf8.decode(chunk)
+
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Skip whitespace and return the next character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars,
+        and return it."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(
+                f"Expecting one of {chars!r}", self.buf, self.pos
+            )
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode and consume the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+
+            # A number cut off by the end of the buffer decodes as a shorter
+            # number (e.g. "12." as 12), so make sure it really ended
+            if not self.eof and (
+                end == len(self.buf)
+                or (isinstance(val, (int, float)) and self.buf[end] in _NUMBER_CHARS)
+            ):
+                self.fill()
+                continue
+
+            self.pos = end
+            return val
+
+
+def iter_object(chunks, stream_keys=()):
+    """Incrementally parse a JSON object from an iterable of chunks.
+
+    Yields (key, None, value) for each of the object's keys. For arrays
+    whose key is in stream_keys, (key, None, []) is yielded instead,
+    followed by (key, index, item) for each item of the array, so those
+    arrays are never held in memory.
+    Raises json.JSONDecodeError if the chunks don't contain a JSON object.
+    """
+    reader = JSONReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.expect("}")
+        return
+
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise json.JSONDecodeError("Expecting property name", reader.buf, 0)
+        reader.expect(":")
+
+        if key in stream_keys and reader.peek() == "[":
+            reader.expect("[")
+            yield (key, None, [])
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                index = 0
+                while True:
+                    yield (key, index, reader.value())
+                    index += 1
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            yield (key, None, reader.value())
+
+        if reader.expect(",}") == "}":
+            break
+
+    if reader.peek():
+        raise json.JSONDecodeError("Extra data", reader.buf, reader.pos)
+
+
+def iter_file(infd, stream_keys=()):
+    """Incrementally parse a JSON object from an open file."""
+    return iter_object(iter(lambda: infd.read(CHUNK_SIZE), ""), stream_keys)
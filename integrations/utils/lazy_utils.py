@@ -0,0 +1,22 @@
+"""Functions for deferring expensive imports until they are needed.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return a module which is only actually imported
+    the first time one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
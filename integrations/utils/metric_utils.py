@@ -0,0 +1,98 @@
+"""Functions and classes for working with PCP metric lists.
+"""
+
+
+class MetricSet:
+    """The metrics of a single integration, held as an ordered set.
+
+    If allow_duplicates is set, the set behaves as an ordered multiset:
+    adding a metric that is already present adds another copy, and
+    removing a metric removes every copy of it.
+
+    Metrics are kept in the order they were added, copies included, with
+    a count of each for membership tests. Additions and removals are
+    recorded in added and removed, and the comma-separated string is only
+    rebuilt when to_string is called.
+    """
+
+    __slots__ = (
+        "metrics",
+        "counts",
+        "original",
+        "allow_duplicates",
+        "added",
+        "removed",
+    )
+
+    def __init__(self, metrics="", allow_duplicates=False):
+        self.original = metrics
+        self.allow_duplicates = allow_duplicates
+        self.metrics = split_metrics(metrics)
+        self.counts = {}
+        self.added = []
+        self.removed = []
+
+        for metric in self.metrics:
+            self.counts[metric] = self.counts.get(metric, 0) + 1
+
+    def __contains__(self, metric):
+        return metric in self.counts
+
+    def __iter__(self):
+        return iter(self.metrics)
+
+    def __len__(self):
+        return len(self.metrics)
+
+    def __str__(self):
+        return self.to_string()
+
+    def add(self, metrics):
+        """Add each metric in metrics, and return the ones actually added."""
+        out = []
+        for metric in metrics:
+            if metric in self.counts and not self.allow_duplicates:
+                continue
+            self.counts[metric] = self.counts.get(metric, 0) + 1
+            out.append(metric)
+
+        self.metrics.extend(out)
+        self.added.extend(out)
+        return out
+
+    def remove(self, metrics):
+        """Remove every copy of each metric in metrics,
+        and return the ones actually removed."""
+        out = []
+        for metric in metrics:
+            if self.counts.pop(metric, None) is not None:
+                out.append(metric)
+
+        if out:
+            gone = set(out)
+            self.metrics = [metric for metric in self.metrics if metric not in gone]
+        self.removed.extend(out)
+        return out
+
+    def to_string(self):
+        """Build the comma-separated metrics string."""
+        if not self.added and not self.removed:
+            return self.original
+        return ",".join(self)
+
+    def changed(self):
+        """Whether the metrics differ from the ones the set was built with."""
+        if not self.added and not self.removed:
+            return False
+        return self.to_string() != self.original
+
+    def commit(self):
+        """Make the current metrics the new baseline, and forget the edits."""
+        self.original = self.to_string()
+        self.added = []
+        self.removed = []
+
+
+def split_metrics(metrics):
+    """Split a comma-separated metrics string, dropping empty names."""
+    return [metric for metric in metrics.split(",") if metric]
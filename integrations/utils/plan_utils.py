@@ -0,0 +1,294 @@
+"""Functions for planning how create configs become integrations.
+"""
+
+import re
+import zlib
+
+import constants
+from utils import api_utils
+from utils.metric_utils import split_metrics
+from utils.stats import percentile
+
+# Seconds in each unit an interval can be given in
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 60 * 60}
+
+
+def interval_seconds(interval):
+    """Convert an interval such as 10s or 5m to seconds."""
+    match = re.match(r"^([1-9][0-9]*)([smh])$", interval)
+    if not match:
+        raise ValueError(f"Invalid interval {interval}")
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def fetch_rate(groups):
+    """Number of pmproxy fetches per second made by integrations
+    created from groups."""
+    return sum(1 / interval_seconds(group["interval"]) for group in groups)
+
+
+def policy_key(group):
+    """What a group's agent policy is chosen from: its policy_id, its
+    policy_pool, or None for the default policies."""
+    if "policy_id" in group:
+        return ("policy_id", group["policy_id"])
+    if "policy_pool" in group:
+        return ("policy_pool", tuple(group["policy_pool"]))
+    return None
+
+
+def pack_groups(fqdn, groups, max_url_length=constants.MAX_URL_LENGTH):
+    """Merge the groups of a host which share an interval, pmproxy and
+    policy (or policy pool), so each of them is fetched by a single
+    integration. Policies are placed after packing, so only the packed
+    groups count against a policy's cap.
+
+    Merged metrics are split over several groups if they would make
+    the fetch URL longer than max_url_length. Groups after the first
+    of a split get a suffix for their integration's name.
+    """
+    merged = {}
+    for group in groups:
+        key = (group["interval"], group["pmproxy_url"], policy_key(group))
+        names = merged.setdefault(key, {})
+        for name in split_metrics(group["metrics"]):
+            names[name] = None
+
+    packed = []
+    for (interval, pmproxy_url, policy), names in merged.items():
+        base_length = len(api_utils.fetch_url(pmproxy_url, fqdn, ""))
+        chunks = [[]]
+        length = base_length
+        for name in names:
+            if chunks[-1] and length + 1 + len(name) > max_url_length:
+                chunks.append([])
+                length = base_length
+            length += len(name) + (len(chunks[-1]) > 0)
+            chunks[-1].append(name)
+
+        for i, chunk in enumerate(chunks):
+            group = {
+                "pmproxy_url": pmproxy_url,
+                "interval": interval,
+                "metrics": ",".join(chunk),
+            }
+            if policy is not None:
+                field, value = policy
+                group[field] = list(value) if field == "policy_pool" else value
+            if i:
+                group["suffix"] = f"-{i + 1}"
+            packed.append(group)
+    return packed
+
+
+class PackSummary:
+    """Tally of the groups and fetch rate before and after packing."""
+
+    def __init__(self):
+        self.nodes = 0
+        self.groups_before = 0
+        self.groups_after = 0
+        self.rate_before = 0.0
+        self.rate_after = 0.0
+
+    def add(self, before, after):
+        """Count a node's groups before and after packing."""
+        self.nodes += 1
+        self.groups_before += len(before)
+        self.groups_after += len(after)
+        self.rate_before += fetch_rate(before)
+        self.rate_after += fetch_rate(after)
+
+    def report(self):
+        """Build a human-readable summary of the packing."""
+        saved = self.rate_before - self.rate_after
+        pct = 100 * saved / self.rate_before if self.rate_before else 0.0
+        return (
+            f"{self.nodes} node(s): {self.groups_before} group(s) packed into"
+            f" {self.groups_after} integration(s)\n"
+            f"pmproxy fetches/s: {self.rate_before:.3f} before,"
+            f" {self.rate_after:.3f} after ({pct:.1f}% fewer)"
+        )
+
+
+def pack_nodes(nodes, summary, max_url_length=constants.MAX_URL_LENGTH):
+    """Pack the groups of each node yielded by nodes, tallying them in summary."""
+    for node in nodes:
+        packed = pack_groups(node["fqdn"], node["groups"], max_url_length)
+        summary.add(node["groups"], packed)
+        node["groups"] = packed
+        yield node
+
+
+def free_name(name, *taken):
+    """Return the first of name-2, name-3, ... which isn't in any of taken."""
+    i = 2
+    while any(f"{name}-{i}" in names for names in taken):
+        i += 1
+    return f"{name}-{i}"
+
+
+def dedupe_nodes(nodes, existing, on_collision, errors, max_url_length):
+    """Check the name of each group of each node yielded by nodes against
+    the existing integration names (any container, such as an inventory
+    from api_utils.generate_map) and the names of the groups before it,
+    so no create request is sent for a name which is taken.
+
+    Groups whose name is taken are reported in errors and dropped, or
+    given the first free suffix with on_collision SUFFIX. With MERGE, a
+    group is merged into an earlier group of the same node which shares
+    its name, pmproxy and policy, as long as the fetch URL stays under
+    max_url_length; otherwise it's suffixed.
+    """
+    taken = set()
+    for node in nodes:
+        fqdn = node["fqdn"]
+        named = {}
+        groups = []
+        for group in node["groups"]:
+            name = api_utils.integration_name(fqdn, group)
+            if name not in existing and name not in taken:
+                taken.add(name)
+                named[name] = group
+                groups.append(group)
+                continue
+
+            earlier = named.get(name)
+            if on_collision == constants.MERGE and earlier is not None:
+                same = (earlier["pmproxy_url"], policy_key(earlier)) == (
+                    group["pmproxy_url"],
+                    policy_key(group),
+                )
+                metrics = ",".join(
+                    dict.fromkeys(
+                        split_metrics(earlier["metrics"])
+                        + split_metrics(group["metrics"])
+                    )
+                )
+                url = api_utils.fetch_url(group["pmproxy_url"], fqdn, metrics)
+                if same and len(url) <= max_url_length:
+                    earlier["metrics"] = metrics
+                    continue
+
+            if on_collision == constants.SKIP:
+                where = "in Kibana" if name in existing else "in the config"
+                errors.append(f"{fqdn}: integration {name} already exists {where}")
+                continue
+
+            suffixed = free_name(name, existing, taken)
+            group["suffix"] = group.get("suffix", "") + suffixed[len(name) :]
+            taken.add(suffixed)
+            named[suffixed] = group
+            groups.append(group)
+
+        node["groups"] = groups
+        yield node
+
+
+def stagger_interval(fqdn, group, jitter):
+    """Pick a variant of a group's interval, up to jitter percent longer
+    or shorter, so integrations with the same interval drift apart.
+
+    The variant is picked by hashing the group, so it's the same every
+    time the config is planned. Groups which were already staggered are
+    staggered again from their nominal_interval.
+    """
+    interval = group.get("nominal_interval", group["interval"])
+    seconds = interval_seconds(interval)
+    spread = int(seconds * jitter / 100)
+    if not spread:
+        return interval
+
+    key = f"{fqdn}|{group['pmproxy_url']}|{interval}|{group.get('suffix', '')}"
+    offset = zlib.crc32(key.encode("utf-8")) % (2 * spread + 1) - spread
+    return f"{seconds + offset}s" if offset else interval
+
+
+def stagger_nodes(nodes, jitter):
+    """Stagger the intervals of the groups of each node yielded by nodes.
+
+    Integrations are named after their interval, so the interval a group
+    had before it was staggered is kept in nominal_interval and used to
+    name it.
+    """
+    for node in nodes:
+        for group in node["groups"]:
+            interval = stagger_interval(node["fqdn"], group, jitter)
+            if interval != group["interval"]:
+                group.setdefault("nominal_interval", group["interval"])
+                group["interval"] = interval
+        yield node
+
+
+class LoadSimulator:
+    """Simulates the pmproxy fetches made each second by a set of integrations.
+
+    Agents start every integration in a policy at once when it's rolled
+    out, so integrations are assumed to start together. Simulations begin
+    after the longest interval, once that first burst is over.
+    """
+
+    def __init__(self):
+        # pmproxy -> {interval in seconds: number of integrations}
+        self.intervals = {}
+        self.skipped = 0
+
+    def add(self, pmproxy_url, interval):
+        """Add an integration. Those with unknown intervals are counted
+        in skipped."""
+        try:
+            seconds = interval_seconds(interval)
+        except ValueError:
+            self.skipped += 1
+            return
+        counts = self.intervals.setdefault(pmproxy_url, {})
+        counts[seconds] = counts.get(seconds, 0) + 1
+
+    def histogram(self, pmproxies=None, horizon=constants.SIMULATION_HORIZON):
+        """Count the fetches sent to pmproxies (by default, all of them)
+        in each second of the horizon."""
+        start = max(
+            (seconds for counts in self.intervals.values() for seconds in counts),
+            default=0,
+        )
+        load = [0] * horizon
+        for pmproxy_url in self.intervals if pmproxies is None else pmproxies:
+            for seconds, count in self.intervals[pmproxy_url].items():
+                first = -(-start // seconds) * seconds
+                for second in range(first - start, horizon, seconds):
+                    load[second] += count
+        return load
+
+    def report(self, horizon=constants.SIMULATION_HORIZON):
+        """Build a table of the load on each pmproxy, and on all of them."""
+        lines = [
+            f"{'pmproxy':<40}{'Integrations':>13}{'Mean/s':>9}"
+            f"{'p99/s':>8}{'Peak/s':>8}"
+        ]
+        rows = [(url, [url]) for url in sorted(self.intervals)]
+        rows.append(("total", sorted(self.intervals)))
+        for label, pmproxies in rows:
+            load = self.histogram(pmproxies, horizon)
+            total = sum(sum(self.intervals[url].values()) for url in pmproxies)
+            lines.append(
+                f"{label:<40}{total:>13}{sum(load) / max(1, horizon):>9.2f}"
+                f"{percentile(sorted(load), 99):>8}{max(load, default=0):>8}"
+            )
+        if self.skipped:
+            lines.append(
+                f"{self.skipped} integration(s) with unknown intervals skipped"
+            )
+        return "\n".join(lines)
+
+    def write_histogram(self, path, horizon=constants.SIMULATION_HORIZON):
+        """Write the fetches per second to each pmproxy as CSV."""
+        pmproxies = sorted(self.intervals)
+        columns = [self.histogram([url], horizon) for url in pmproxies]
+        with open(path, "w", encoding="utf-8") as outfile:
+            outfile.write(",".join(["second"] + pmproxies + ["total"]) + "\n")
+            for second in range(horizon):
+                counts = [column[second] for column in columns]
+                outfile.write(
+                    ",".join(str(val) for val in [second] + counts + [sum(counts)])
+                    + "\n"
+                )
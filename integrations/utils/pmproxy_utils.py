@@ -0,0 +1,185 @@
+"""Functions that interact with the pmproxy REST API.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import time
+
+import constants
+from utils import api_utils, stats
+from utils.metric_utils import split_metrics
+
+PMNS_CACHE = constants.ROOT_DIR + "/config/pmns-cache.json"
+# Metric fetched from each host to check that pmproxy can reach it
+PROBE_METRIC = "pmcd.numagents"
+
+
+class PMNSCache:
+    """On-disk cache of metric prefix expansions, keyed by pmproxy and host."""
+
+    def __init__(self, path=PMNS_CACHE, ttl=constants.PMNS_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.dirty = False
+
+        if os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as infile:
+                    self.entries = json.load(infile)
+            except (OSError, ValueError):
+                print(f"Ignoring unreadable PMNS cache {path}.", file=sys.stderr)
+
+    @staticmethod
+    def key(pmproxy_url, host):
+        """Key for the cache entries of a host, as seen by a pmproxy."""
+        return f"{pmproxy_url}|{host}"
+
+    def get(self, pmproxy_url, host, prefix):
+        """Return the cached names under prefix, or None if missing or expired."""
+        entry = self.entries.get(self.key(pmproxy_url, host), {}).get(prefix)
+        if entry is None or time.time() - entry["fetched"] > self.ttl:
+            return None
+        return entry["names"]
+
+    def put(self, pmproxy_url, host, prefix, names):
+        """Cache the names under prefix."""
+        self.entries.setdefault(self.key(pmproxy_url, host), {})[prefix] = {
+            "fetched": time.time(),
+            "names": names,
+        }
+        self.dirty = True
+
+    def save(self):
+        """Write the cache back to disk, if it changed."""
+        if not self.dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(self.entries, outfile)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+def fetch_names(pmproxy_url, host, prefix, timeout=5):
+    """Ask pmproxy for the names of every metric under prefix on host."""
+    resp = api_utils.send(
+        "GET",
+        f"{pmproxy_url}/pmapi/metric",
+        params={"hostspec": host, "prefix": prefix},
+        timeout=timeout,
+        service=stats.PMPROXY,
+    )
+    resp.raise_for_status()
+    return [metric["name"] for metric in resp.json().get("metrics", [])]
+
+
+def probe(url, timeout, params=None, require_ok=True):
+    """Send a single GET to pmproxy, with no retries.
+
+    Returns None if pmproxy answered (successfully, if require_ok),
+    or a description of why the probe failed.
+    """
+    try:
+        resp = api_utils.send(
+            "GET",
+            url,
+            retries=0,
+            params=params,
+            timeout=timeout,
+            service=stats.PMPROXY,
+        )
+    except api_utils.requests.exceptions.Timeout:
+        return f"no response within {timeout} s"
+    except api_utils.requests.exceptions.ConnectionError:
+        return "could not connect"
+    except api_utils.requests.exceptions.RequestException as e:
+        return str(e)
+
+    if resp.status_code == 200 or not require_ok:
+        return None
+    try:
+        message = resp.json().get("message")
+    except (ValueError, AttributeError):
+        message = None
+    return f"HTTP {resp.status_code}" + (f": {message}" if message else "")
+
+
+def preflight(targets, workers=constants.WORKERS, timeout=constants.PREFLIGHT_TIMEOUT):
+    """Check that each pmproxy in targets, a collection of
+    (pmproxy_url, host), is reachable and can fetch metrics from the host.
+
+    Identical probes are only sent once, and are sent concurrently.
+    Hosts behind an unreachable pmproxy aren't probed.
+    Returns a map of each failing (pmproxy_url, host) to the reason.
+    """
+    targets = set(targets)
+    proxies = sorted({pmproxy_url for pmproxy_url, __ in targets})
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        proxy_errors = dict(
+            zip(
+                proxies,
+                pool.map(
+                    lambda url: probe(
+                        f"{url}/pmapi/context", timeout, require_ok=False
+                    ),
+                    proxies,
+                ),
+            )
+        )
+        hosts = sorted(target for target in targets if not proxy_errors[target[0]])
+        host_errors = pool.map(
+            lambda target: probe(
+                f"{target[0]}/pmapi/fetch",
+                timeout,
+                params={"hostspec": target[1], "names": PROBE_METRIC},
+            ),
+            hosts,
+        )
+        failures = dict(zip(hosts, host_errors))
+
+    for target in targets:
+        if proxy_errors[target[0]]:
+            failures[target] = f"pmproxy unreachable: {proxy_errors[target[0]]}"
+    return {target: reason for target, reason in failures.items() if reason}
+
+
+def expand_groups(groups, cache, workers=constants.WORKERS):
+    """Replace the metric prefixes in each group's metrics with the
+    names of the metrics under them.
+
+    Each group needs fqdn, pmproxy_url and metrics. Lookups which
+    aren't cached are sent concurrently, and each distinct
+    (pmproxy, host, prefix) is only looked up once. Prefixes which
+    can't be expanded are left as they are.
+    """
+    missing = {}
+    for group in groups:
+        for prefix in split_metrics(group["metrics"]):
+            lookup = (group["pmproxy_url"], group["fqdn"], prefix)
+            if lookup not in missing and cache.get(*lookup) is None:
+                missing[lookup] = None
+
+    def attempt(lookup):
+        try:
+            return fetch_names(*lookup)
+        except (api_utils.requests.exceptions.RequestException, ValueError) as e:
+            print(f"Could not expand {lookup[2]} on {lookup[1]}: {e}", file=sys.stderr)
+            return None
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for lookup, names in zip(missing, pool.map(attempt, list(missing))):
+                if names:
+                    cache.put(*lookup, names)
+
+    for group in groups:
+        expanded = {}
+        for prefix in split_metrics(group["metrics"]):
+            names = cache.get(group["pmproxy_url"], group["fqdn"], prefix)
+            for name in names or [prefix]:
+                expanded[name] = None
+        group["metrics"] = ",".join(expanded)
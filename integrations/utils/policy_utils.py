@@ -0,0 +1,176 @@
+"""Functions for spreading integrations over sets of agent policies.
+"""
+
+import hashlib
+import re
+
+import constants
+from utils import api_utils, file_utils
+
+
+def read_policies(web_info):
+    """Read the default policies from the policies option of the [fleet]
+    section of web_config.ini, a comma or newline separated list of ids."""
+    if not web_info.has_option("fleet", "policies"):
+        return []
+    ids = re.split(r"[,\s]+", web_info.get("fleet", "policies").strip())
+    return [id_ for id_ in ids if id_]
+
+
+def policy_counts(idmap):
+    """Count the integrations on each agent policy in a map from
+    api_utils.generate_map."""
+    counts = {}
+    for integration in idmap.values():
+        counts[integration["policy_id"]] = counts.get(integration["policy_id"], 0) + 1
+    return counts
+
+
+def load_policies(args, web_info, inventory=None):
+    """Read the default policies from --policy, or failing that
+    web_config.ini, along with the integrations already on each policy
+    if --policy-cap needs them. They're counted in inventory, an extended
+    map from api_utils.generate_map, which is fetched if it isn't given."""
+    policies = args.policy or read_policies(web_info)
+    counts = {}
+    if args.policy_cap is not None:
+        if inventory is None:
+            inventory = api_utils.generate_map(
+                web_info["kibana"]["api_key"],
+                web_info["kibana"]["kibana_url"],
+                extended=True,
+                slim=True,
+            )
+        counts = policy_counts(inventory)
+    return policies, counts
+
+
+def rank(fqdn, policies):
+    """Order policies by preference for a host, by rendezvous hashing."""
+    return sorted(
+        policies,
+        key=lambda id_: (
+            hashlib.sha1(f"{id_}|{fqdn}".encode("utf-8")).digest(),
+            id_,
+        ),
+        reverse=True,
+    )
+
+
+class PolicyPlacer:
+    """Places hosts' integrations onto agent policies.
+
+    Each host goes to its most preferred policy with room for all its
+    integrations, so placement only depends on the host and the policies'
+    sizes. Without a cap, a host always goes to the same policy.
+    """
+
+    def __init__(self, cap=None, counts=None):
+        self.cap = cap
+        self.counts = dict(counts or {})
+        self.placed = {}
+
+    def place(self, fqdn, policies, count):
+        """Pick a policy for count integrations of a host,
+        or None if every policy is full."""
+        for id_ in rank(fqdn, policies):
+            if self.cap is None or self.counts.get(id_, 0) + count <= self.cap:
+                self.counts[id_] = self.counts.get(id_, 0) + count
+                self.placed[id_] = self.placed.get(id_, 0) + count
+                return id_
+        return None
+
+    def report(self):
+        """Build a table of the integrations placed on each policy."""
+        return report_counts(self.counts, self.cap, self.placed)
+
+
+def config_policies(infile):
+    """Collect the agent policy ids given by the groups of a create config
+    file, in policy_id or policy_pool. Hosts aren't expanded, since their
+    groups are the same for every host in a range."""
+    ids = set()
+    for key, item in file_utils.iter_config(infile, constants.CREATE, []):
+        if key == "templates":
+            groups = [group for groups in item.values() for group in groups]
+        else:
+            groups = item.get("groups", [])
+        for group in groups:
+            if "policy_id" in group:
+                ids.add(group["policy_id"])
+            ids.update(group.get("policy_pool", []))
+    return ids
+
+
+def check_nodes(nodes, known, errors):
+    """Drop the groups of each node yielded by nodes whose policy_id
+    isn't in known, the agent policies which exist. Each unknown policy
+    is reported once in errors, once nodes is exhausted."""
+    unknown = {}
+    for node in nodes:
+        groups = []
+        for group in node["groups"]:
+            id_ = group.get("policy_id")
+            if id_ in known:
+                groups.append(group)
+            else:
+                unknown[id_] = unknown.get(id_, 0) + 1
+        node["groups"] = groups
+        yield node
+
+    for id_, count in unknown.items():
+        errors.append(
+            f"Agent policy {id_} does not exist; skipped {count} group(s) using it"
+        )
+
+
+def report_counts(counts, cap=None, placed=None):
+    """Build a table of the integrations on each policy."""
+    placed = placed or {}
+    lines = [f"{'Policy':<40}{'Integrations':>13}{'Placed':>8}{'Room':>8}"]
+    for id_, count in sorted(counts.items()):
+        room = "-" if cap is None else max(0, cap - count)
+        lines.append(f"{id_:<40}{count:>13}{placed.get(id_, 0):>8}{room:>8}")
+    return "\n".join(lines)
+
+
+def place_nodes(nodes, placer, default_policies, errors):
+    """Set policy_id on the groups of each node yielded by nodes which
+    give a policy_pool, or no policy_id at all (using default_policies).
+
+    All of a host's groups which use the same set of policies go to the
+    same policy. Groups which can't be placed are reported in errors and
+    dropped.
+    """
+    for node in nodes:
+        pools = {}
+        groups = []
+        for group in node["groups"]:
+            if "policy_pool" in group:
+                policies = tuple(group.pop("policy_pool"))
+            elif "policy_id" not in group:
+                policies = tuple(default_policies)
+            else:
+                groups.append(group)
+                continue
+            pools.setdefault(policies, []).append(group)
+
+        for policies, pool_groups in pools.items():
+            id_ = None
+            if policies:
+                id_ = placer.place(node["fqdn"], policies, len(pool_groups))
+            if id_ is None:
+                reason = (
+                    "every policy is full" if policies else "no policies are configured"
+                )
+                errors.append(
+                    f"{node['fqdn']}: could not place {len(pool_groups)}"
+                    f" group(s) on an agent policy, {reason}"
+                )
+                continue
+            for group in pool_groups:
+                group["policy_id"] = id_
+            groups.extend(pool_groups)
+
+        node["groups"] = groups
+        yield node
@@ -0,0 +1,225 @@
+"""Functions for spreading integrations over pools of pmproxy instances.
+"""
+
+import hashlib
+import math
+import re
+import sys
+
+from utils import api_utils, plan_utils
+
+HASH = "hash"
+LEAST_LOADED = "least-loaded"
+STRATEGIES = (HASH, LEAST_LOADED)
+
+
+def parse_pool(members):
+    """Parse pool members, given as URL or URL=WEIGHT, into (url, weight) pairs."""
+    pool = []
+    for member in members:
+        url, __, weight = member.strip().partition("=")
+        if not url or (weight and not weight.isdigit()) or weight == "0":
+            raise ValueError(f"Invalid pmproxy pool member {member}")
+        pool.append((url.rstrip("/"), int(weight) if weight else 1))
+    return pool
+
+
+def read_pool(web_info):
+    """Read the default pool from the pool option of the [pmproxy] section
+    of web_config.ini, a comma or newline separated list of members."""
+    if not web_info.has_option("pmproxy", "pool"):
+        return []
+    members = re.split(r"[,\s]+", web_info.get("pmproxy", "pool").strip())
+    return parse_pool(member for member in members if member)
+
+
+def load_pool(args, web_info, inventory=None):
+    """Read the default pool from --pmproxy, or failing that web_config.ini,
+    along with the current load on each pmproxy if it's needed by
+    --strategy. The load is worked out from inventory, an extended map
+    from api_utils.generate_map, which is fetched if it isn't given.
+    Exits if the pool is invalid."""
+    try:
+        pool = parse_pool(args.pmproxy) if args.pmproxy else read_pool(web_info)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    loads = {}
+    if args.strategy == LEAST_LOADED:
+        if inventory is None:
+            inventory = api_utils.generate_map(
+                web_info["kibana"]["api_key"],
+                web_info["kibana"]["kibana_url"],
+                extended=True,
+                slim=True,
+            )
+        loads = inventory_loads(inventory)
+    return pool, loads
+
+
+def pmproxy_key(url):
+    """Normalise a pmproxy URL, so URLs with and without a scheme compare equal."""
+    return re.sub(r"^[a-z]+://", "", url).rstrip("/")
+
+
+def rendezvous(key, pool):
+    """Pick the pool member for key by weighted rendezvous hashing.
+
+    Adding a member only moves the keys which the new member now wins,
+    and removing one only moves the keys it had.
+    """
+
+    def score(member):
+        url, weight = member
+        digest = hashlib.sha1(f"{pmproxy_key(url)}|{key}".encode("utf-8")).digest()
+        unit = (int.from_bytes(digest[:8], "big") + 0.5) / 2**64
+        return (-weight / math.log(unit), url)
+
+    return max(pool, key=score)[0]
+
+
+def integration_rate(interval):
+    """Fetches per second made by an integration, or 0 if its
+    interval can't be parsed."""
+    try:
+        return 1 / plan_utils.interval_seconds(interval)
+    except ValueError:
+        return 0.0
+
+
+class Balancer:
+    """Assigns hosts to members of pmproxy pools.
+
+    With the hash strategy, each host always goes to the same member of
+    a pool. With least-loaded, it goes to the member with the fewest
+    fetches per second relative to its weight, starting from loads
+    (e.g. from the current inventory).
+    """
+
+    def __init__(self, strategy=HASH, loads=None):
+        self.strategy = strategy
+        self.loads = dict(loads or {})
+
+    def assign(self, fqdn, pool, rate=0.0):
+        """Pick a pool member for a host making rate fetches per second."""
+        if self.strategy == HASH:
+            url = rendezvous(fqdn, pool)
+        else:
+            url = min(
+                pool,
+                key=lambda member: (
+                    (self.loads.get(pmproxy_key(member[0]), 0.0) + rate) / member[1],
+                    member[0],
+                ),
+            )[0]
+        self.loads[pmproxy_key(url)] = self.loads.get(pmproxy_key(url), 0.0) + rate
+        return url
+
+
+def inventory_loads(idmap):
+    """Fetches per second sent to each pmproxy by the integrations in an
+    extended map from api_utils.generate_map."""
+    loads = {}
+    for integration in idmap.values():
+        key = pmproxy_key(integration["pmproxy_url_"])
+        loads[key] = loads.get(key, 0.0) + integration_rate(integration["interval_"])
+    return loads
+
+
+def assign_nodes(nodes, balancer, default_pool, errors):
+    """Set pmproxy_url on the groups of each node yielded by nodes which
+    give a pmproxy_pool, or no pmproxy_url at all (using default_pool).
+
+    All of a host's groups which use the same pool go to the same member.
+    Groups with no pmproxy to use are reported in errors and dropped.
+    """
+    for node in nodes:
+        pools = {}
+        groups = []
+        for group in node["groups"]:
+            if "pmproxy_pool" in group:
+                pool = parse_pool(group.pop("pmproxy_pool"))
+            elif "pmproxy_url" not in group:
+                if not default_pool:
+                    errors.append(
+                        f"{node['fqdn']}: group has no pmproxy_url or"
+                        " pmproxy_pool, and no default pool is configured"
+                    )
+                    continue
+                pool = default_pool
+            else:
+                groups.append(group)
+                continue
+            members = pools.setdefault(tuple(pool), [])
+            members.append(group)
+            groups.append(group)
+
+        for pool, pool_groups in pools.items():
+            rate = sum(integration_rate(group["interval"]) for group in pool_groups)
+            url = balancer.assign(node["fqdn"], list(pool), rate)
+            for group in pool_groups:
+                group["pmproxy_url"] = url
+
+        node["groups"] = groups
+        yield node
+
+
+def plan_moves(placements, pool, strategy=HASH):
+    """Work out which placements to move to another member of pool.
+
+    placements is a list of (fqdn, pmproxy_url, rate), where rate is the
+    fetches per second of the host's integrations on that pmproxy.
+    Returns the new pmproxy URL of each placement, or None if it stays.
+
+    With the hash strategy, every placement goes to its host's member.
+    With least-loaded, placements outside the pool are moved to the least
+    loaded members, then the largest placements which narrow the gap
+    between the most and least loaded members are moved, until none do.
+    """
+    if strategy == HASH:
+        targets = [rendezvous(fqdn, pool) for fqdn, __, __ in placements]
+        return [
+            None if pmproxy_key(target) == pmproxy_key(url) else target
+            for target, (__, url, __) in zip(targets, placements)
+        ]
+
+    weights = {pmproxy_key(url): weight for url, weight in pool}
+    urls = {pmproxy_key(url): url for url, __ in pool}
+    loads = {key: 0.0 for key in weights}
+    current = [pmproxy_key(url) for __, url, __ in placements]
+    placed = [key if key in weights else None for key in current]
+    for i, key in enumerate(placed):
+        if key is not None:
+            loads[key] += placements[i][2]
+
+    def ratio(key, extra=0.0):
+        return (loads[key] + extra) / weights[key]
+
+    # Placements on pmproxies which aren't in the pool have to move
+    for i in sorted(
+        (i for i, key in enumerate(placed) if key is None),
+        key=lambda i: -placements[i][2],
+    ):
+        key = min(loads, key=lambda key: (ratio(key, placements[i][2]), key))
+        placed[i] = key
+        loads[key] += placements[i][2]
+
+    for __ in range(len(placements)):
+        src = max(loads, key=lambda key: (ratio(key), key))
+        dst = min(loads, key=lambda key: (ratio(key), key))
+        candidates = sorted(
+            (i for i, key in enumerate(placed) if key == src),
+            key=lambda i: -placements[i][2],
+        )
+        for i in candidates:
+            rate = placements[i][2]
+            if ratio(dst, rate) < ratio(src, -rate):
+                placed[i] = dst
+                loads[src] -= rate
+                loads[dst] += rate
+                break
+        else:
+            break
+
+    return [None if key == old else urls[key] for key, old in zip(placed, current)]
@@ -0,0 +1,171 @@
+"""Functions for exporting metrics in the Prometheus text format,
+for node_exporter's textfile collector.
+"""
+
+import os
+import tempfile
+import time
+
+from utils.metric_utils import split_metrics
+from utils.pool_utils import pmproxy_key
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def family(name, mtype, help_text, samples):
+    """Format a metric family, where samples is a list of (labels, value),
+    or (suffix, labels, value) for histograms."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {mtype}"]
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("",) + sample
+        label_str = ",".join(f'{key}="{escape(val)}"' for key, val in labels.items())
+        label_str = f"{{{label_str}}}" if label_str else ""
+        lines.append(f"{name}{suffix}{label_str} {value}")
+    return lines
+
+
+def inventory_metrics(idmap):
+    """Build gauges describing the integrations in an extended map
+    from api_utils.generate_map, in a single pass over it."""
+    total = {}
+    enabled = {}
+    metrics = {}
+    intervals = {}
+    policies = {}
+
+    for integration in idmap.values():
+        # Labelled without the scheme, so series don't change with it
+        pmproxy = pmproxy_key(integration["pmproxy_url_"])
+        total[pmproxy] = total.get(pmproxy, 0) + 1
+        enabled[pmproxy] = enabled.get(pmproxy, 0) + bool(integration["enabled_"])
+        metrics[pmproxy] = metrics.get(pmproxy, 0) + len(
+            split_metrics(integration["metrics_"])
+        )
+        interval = integration["interval_"]
+        intervals[interval] = intervals.get(interval, 0) + 1
+        policy = integration["policy_id"]
+        policies[policy] = policies.get(policy, 0) + 1
+
+    lines = family(
+        "pcp_integrations",
+        "gauge",
+        "Number of PCP integrations, by pmproxy.",
+        [({"pmproxy": key}, val) for key, val in sorted(total.items())],
+    )
+    lines += family(
+        "pcp_integrations_enabled",
+        "gauge",
+        "Number of enabled PCP integrations, by pmproxy.",
+        [({"pmproxy": key}, val) for key, val in sorted(enabled.items())],
+    )
+    lines += family(
+        "pcp_integration_metrics",
+        "gauge",
+        "Number of metrics fetched by PCP integrations, by pmproxy.",
+        [({"pmproxy": key}, val) for key, val in sorted(metrics.items())],
+    )
+    lines += family(
+        "pcp_integrations_by_interval",
+        "gauge",
+        "Number of PCP integrations, by request interval.",
+        [({"interval": key}, val) for key, val in sorted(intervals.items())],
+    )
+    lines += family(
+        "pcp_integrations_by_policy",
+        "gauge",
+        "Number of PCP integrations, by agent policy.",
+        [({"policy_id": key}, val) for key, val in sorted(policies.items())],
+    )
+    return lines
+
+
+def run_metrics(stats, mode):
+    """Build counters and a latency histogram from the Kibana requests
+    recorded during this run."""
+    labels = {"mode": mode}
+    requests = {}
+    failures = {}
+    buckets = {}
+    sums = {}
+    for rec in stats.kibana_requests():
+        key = (rec.method, rec.endpoint)
+        status = "none" if rec.status is None else str(rec.status)
+        requests[key + (status,)] = requests.get(key + (status,), 0) + 1
+        if rec.status is None or rec.status >= 400:
+            failures[key] = failures.get(key, 0) + 1
+
+        counts = buckets.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 1))
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if rec.latency <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        sums[key] = sums.get(key, 0.0) + rec.latency
+
+    lines = family(
+        "integrations_requests_total",
+        "counter",
+        "Kibana requests sent by integrations.py.",
+        [
+            (dict(labels, method=method, endpoint=endpoint, status=status), count)
+            for (method, endpoint, status), count in sorted(requests.items())
+        ],
+    )
+    lines += family(
+        "integrations_request_failures_total",
+        "counter",
+        "Kibana requests which failed or got an error response.",
+        [
+            (dict(labels, method=method, endpoint=endpoint), count)
+            for (method, endpoint), count in sorted(failures.items())
+        ],
+    )
+
+    samples = []
+    for (method, endpoint), counts in sorted(buckets.items()):
+        req_labels = dict(labels, method=method, endpoint=endpoint)
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+            samples.append(("_bucket", dict(req_labels, le=bound), count))
+        samples.append(("_sum", req_labels, sums[(method, endpoint)]))
+        samples.append(("_count", req_labels, counts[-1]))
+    lines += family(
+        "integrations_request_duration_seconds",
+        "histogram",
+        "Latency of Kibana requests.",
+        samples,
+    )
+
+    lines += family(
+        "integrations_last_run_timestamp_seconds",
+        "gauge",
+        "When integrations.py last finished running.",
+        [(labels, time.time())],
+    )
+    lines += family(
+        "integrations_run_duration_seconds",
+        "gauge",
+        "How long the last run of integrations.py took.",
+        [(labels, time.monotonic() - stats.started)],
+    )
+    return lines
+
+
+def write_textfile(path, lines):
+    """Atomically replace the file at path with the given lines."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".prom.tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+            tmp.write("\n".join(lines) + "\n")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
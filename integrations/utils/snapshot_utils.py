@@ -0,0 +1,85 @@
+"""Functions for saving and comparing snapshots of the integrations.
+
+A snapshot is a gzip-compressed file with a JSON line for each
+integration, holding its id, name, the request body which creates it
+again, and a hash of that body so snapshots can be compared cheaply.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+
+from interactive.transform import transform_body
+
+
+def body_hash(body):
+    """Hash a request body, ignoring the order of its keys."""
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def entry(policy):
+    """Build the snapshot entry of a package policy from the Fleet API."""
+    body = transform_body(policy)
+    return {
+        "id": policy["id"],
+        "name": policy["name"],
+        "hash": body_hash(body),
+        "body": body,
+    }
+
+
+def write(path, entries):
+    """Atomically write entries to a snapshot at path, one at a time.
+    Returns how many were written."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    count = 0
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as outfile:
+            for item in entries:
+                outfile.write(json.dumps(item, separators=(",", ":")) + "\n")
+                count += 1
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return count
+
+
+def read(path):
+    """Yield the entries of a snapshot one at a time."""
+    with gzip.open(path, "rt", encoding="utf-8") as infile:
+        for line in infile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def diff(old, new):
+    """Compare two streams of snapshot entries by name, with a hash join:
+    old is read into a map of names to hashes, then new is streamed past it.
+
+    Returns the names which were added, removed and changed, and the
+    number which are unchanged.
+    """
+    hashes = {item["name"]: item["hash"] for item in old}
+    added = []
+    changed = []
+    unchanged = 0
+    for item in new:
+        old_hash = hashes.pop(item["name"], None)
+        if old_hash is None:
+            added.append(item["name"])
+        elif old_hash != item["hash"]:
+            changed.append(item["name"])
+        else:
+            unchanged += 1
+    return {
+        "added": sorted(added),
+        "removed": sorted(hashes),
+        "changed": sorted(changed),
+        "unchanged": unchanged,
+    }
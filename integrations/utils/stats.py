@@ -0,0 +1,226 @@
+"""Timing instrumentation for Kibana requests and the phases of a run.
+
+Requests to pmproxy are recorded too, but kept out of the Kibana totals
+and latencies.
+"""
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+# Path segments which are ids rather than part of an endpoint's route
+_ID_SEGMENT = re.compile(r"^(?:[0-9a-fA-F-]{16,}|\d+)$")
+
+# Services requests are sent to
+KIBANA = "kibana"
+PMPROXY = "pmproxy"
+
+
+class RequestRecord:
+    """Timing and size information for a single HTTP request."""
+
+    __slots__ = (
+        "method",
+        "endpoint",
+        "status",
+        "nbytes",
+        "start",
+        "latency",
+        "retries",
+        "service",
+    )
+
+    def __init__(
+        self, method, endpoint, status, nbytes, start, latency, retries, service=KIBANA
+    ):
+        self.method = method
+        self.endpoint = endpoint
+        self.status = status
+        self.nbytes = nbytes
+        self.start = start
+        self.latency = latency
+        self.retries = retries
+        self.service = service
+
+    def to_dict(self):
+        """Convert the record to something that can be dumped as JSON."""
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class Stats:
+    """Collects request records and phase timings for a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = []
+        self.phases = {}
+
+    def record(
+        self, method, url, status, nbytes, start, latency, retries=0, service=KIBANA
+    ):
+        """Record a finished HTTP request. status is None if no response arrived."""
+        rec = RequestRecord(
+            method,
+            endpoint_template(url),
+            status,
+            nbytes,
+            start - self.started,
+            latency,
+            retries,
+            service,
+        )
+        with self.lock:
+            self.requests.append(rec)
+
+    def add_phase(self, name, duration):
+        """Add time spent in a phase. Phases can be entered many times."""
+        with self.lock:
+            total, count = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (total + duration, count + 1)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as part of a phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - start)
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, timing each step as part of a phase."""
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase(name, time.monotonic() - start)
+                return
+            self.add_phase(name, time.monotonic() - start)
+            yield item
+
+    def kibana_requests(self):
+        """The records of the requests sent to Kibana."""
+        return [rec for rec in self.requests if rec.service == KIBANA]
+
+    def latencies(self):
+        """Map each (method, endpoint) to the sorted latencies of its
+        requests to Kibana."""
+        out = {}
+        for rec in self.kibana_requests():
+            out.setdefault((rec.method, rec.endpoint), []).append(rec.latency)
+        for values in out.values():
+            values.sort()
+        return out
+
+    def report(self):
+        """Build a human-readable summary of the run's timings."""
+        lines = [f"{'Phase':<20}{'Total (s)':>12}{'Count':>8}"]
+        for name, (total, count) in self.phases.items():
+            lines.append(f"{name:<20}{total:>12.3f}{count:>8}")
+
+        lines.append("")
+        lines.append(
+            f"{'Endpoint':<52}{'Count':>7}{'Errors':>8}{'p50 ms':>9}"
+            f"{'p95 ms':>9}{'p99 ms':>9}{'KiB':>10}"
+        )
+        groups = {}
+        for rec in self.requests:
+            # pmproxy endpoints are labelled, since they aren't Kibana's
+            method = (
+                rec.method if rec.service == KIBANA else f"{rec.service} {rec.method}"
+            )
+            groups.setdefault((method, rec.endpoint), []).append(rec)
+        for (method, endpoint), recs in sorted(groups.items()):
+            values = sorted(rec.latency for rec in recs)
+            errors = len(
+                [rec for rec in recs if rec.status is None or rec.status >= 400]
+            )
+            kib = sum(rec.nbytes for rec in recs) / 1024
+            lines.append(
+                f"{f'{method} {endpoint}':<52}{len(values):>7}{errors:>8}"
+                f"{percentile(values, 50) * 1000:>9.1f}"
+                f"{percentile(values, 95) * 1000:>9.1f}"
+                f"{percentile(values, 99) * 1000:>9.1f}{kib:>10.1f}"
+            )
+
+        kibana = self.kibana_requests()
+        total = len(kibana)
+        retries = sum(rec.retries for rec in kibana)
+        if total:
+            span = max(rec.start + rec.latency for rec in kibana) - min(
+                rec.start for rec in kibana
+            )
+            rate = total / span if span > 0 else float(total)
+            lines.append(
+                f"\n{total} request(s) in {span:.3f} s ({rate:.1f} requests/s),"
+                f" {retries} retried"
+            )
+        else:
+            lines.append("\nNo requests were sent.")
+        others = len(self.requests) - total
+        if others:
+            lines.append(f"{others} request(s) to pmproxy are not counted above.")
+        return "\n".join(lines)
+
+    def save_latencies(self, path):
+        """Merge the median latency of each endpoint used in this run into
+        the JSON file at path, for estimating the length of later runs."""
+        saved = load_latencies(path)
+        for (method, endpoint), values in self.latencies().items():
+            saved[f"{method} {endpoint}"] = {
+                "p50": percentile(values, 50),
+                "count": len(values),
+            }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(saved, outfile, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def write_trace(self, path):
+        """Write every phase and request record to a JSON trace file."""
+        with self.lock:
+            trace = {
+                "phases": {
+                    name: {"total": total, "count": count}
+                    for name, (total, count) in self.phases.items()
+                },
+                "requests": [rec.to_dict() for rec in self.requests],
+            }
+        with open(path, "w", encoding="utf-8") as outfile:
+            json.dump(trace, outfile, indent=1)
+
+
+def load_latencies(path):
+    """Load the endpoint latencies saved by Stats.save_latencies,
+    or nothing if there aren't any."""
+    try:
+        with open(path, encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def endpoint_template(url):
+    """Turn a request URL into its endpoint, with ids replaced by {id}."""
+    path = re.sub(r"^[a-z]+://[^/]*", "", url).split("?")[0]
+    return "/".join(
+        "{id}" if _ID_SEGMENT.match(segment) else segment for segment in path.split("/")
+    )
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of sorted values, by nearest rank."""
+    if not values:
+        return 0.0
+    rank = max(0, -(-len(values) * pct // 100) - 1)
+    return values[int(rank)]
+
+
+# The stats for this run
+STATS = Stats()
@@ -0,0 +1,79 @@
+"""Shared fixtures for the integrations tests.
+"""
+
+import pytest
+
+
+def build_policy(
+    name,
+    id_=None,
+    host="host1.example.com",
+    pmproxy_url="http://pmproxy1:44322",
+    metrics="kernel.all.load,mem.util.used",
+    interval="30s",
+    enabled=True,
+    policy_id="policy-1",
+):
+    """Build a package policy as it is returned by the Fleet API."""
+    return {
+        "id": id_ or f"id{name}",
+        "version": "WzEsMV0=",
+        "name": name,
+        "namespace": "default",
+        "description": "",
+        "policy_id": policy_id,
+        "package": {"name": "httpjson", "title": "Custom API", "version": "1.20.0"},
+        "vars": {},
+        "revision": 1,
+        "inputs": [
+            {
+                "type": "httpjson",
+                "policy_template": "generic",
+                "enabled": enabled,
+                "streams": [
+                    {
+                        "enabled": enabled,
+                        "data_stream": {"type": "logs", "dataset": "httpjson.generic"},
+                        "vars": {
+                            "request_url": {
+                                "type": "text",
+                                "value": f"{pmproxy_url}/pmapi/fetch"
+                                f"?hostspec={host}&client={host}&names={metrics}",
+                            },
+                            "request_interval": {"type": "text", "value": interval},
+                            "tags": {"type": "text"},
+                        },
+                        "compiled_stream": {"config_version": 2},
+                    }
+                ],
+            }
+        ],
+    }
+
+
+@pytest.fixture
+def policy_factory():
+    """Return the function which builds Fleet package policies."""
+    return build_policy
+
+
+@pytest.fixture(autouse=True)
+def journal_dir(monkeypatch, tmp_path):
+    """Keep the journals written by tests out of the config directory."""
+    from utils.journal import JOURNAL
+
+    monkeypatch.setattr(JOURNAL, "directory", str(tmp_path / "journal"))
+    yield JOURNAL.directory
+    JOURNAL.close()
+
+
+@pytest.fixture(autouse=True)
+def key_cache(monkeypatch, tmp_path):
+    """Keep the API key cache written by tests out of the config directory."""
+    import constants
+    from utils import api_utils
+
+    path = str(tmp_path / "key-cache.json")
+    monkeypatch.setattr(constants, "KEY_CACHE", path)
+    monkeypatch.setattr(api_utils, "_validated", set())
+    return path
@@ -0,0 +1,268 @@
+"""Tests for utils/api_utils.py.
+"""
+
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from utils import api_utils
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"{}", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.text = content.decode("utf-8")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise api_utils.requests.exceptions.HTTPError(str(self.status_code))
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """Queue responses for requests.request to return, in order."""
+    queued = []
+
+    def fake_request(method, url, **kwargs):
+        resp = queued.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    monkeypatch.setattr(api_utils.requests, "request", fake_request)
+    monkeypatch.setattr(api_utils.time, "sleep", lambda secs: None)
+    return queued
+
+
+def test_send_retries(responses):
+    responses.extend([FakeResponse(503), FakeResponse(429), FakeResponse(200)])
+    resp = api_utils.send("PUT", "http://kibana/api/fleet/package_policies/x")
+    assert resp.status_code == 200
+    assert api_utils.STATS.requests[-1].retries == 2
+
+
+def test_send_gives_up(responses):
+    responses.extend([FakeResponse(503)] * 3)
+    resp = api_utils.send("GET", "http://kibana/api/status", retries=2)
+    assert resp.status_code == 503 and not responses
+
+
+def test_send_no_post_retry(responses):
+    responses.append(api_utils.requests.exceptions.ConnectionError())
+    with pytest.raises(api_utils.requests.exceptions.ConnectionError):
+        api_utils.send("POST", "http://kibana/api/fleet/package_policies")
+    assert api_utils.STATS.requests[-1].status is None
+
+
+def test_send_post_gateway_error(responses):
+    # The create may have gone through behind the gateway
+    responses.extend([FakeResponse(504), FakeResponse(200)])
+    resp = api_utils.send("POST", "http://kibana/api/fleet/package_policies")
+    assert resp.status_code == 504 and len(responses) == 1
+
+    responses[:] = [FakeResponse(503), FakeResponse(200)]
+    resp = api_utils.send("POST", "http://kibana/api/fleet/package_policies")
+    assert resp.status_code == 200
+
+
+def test_send_retry_after_cap(responses, monkeypatch):
+    slept = []
+    monkeypatch.setattr(api_utils.time, "sleep", slept.append)
+    responses.extend([FakeResponse(429, headers={"Retry-After": "3600"})])
+    responses.append(FakeResponse(200))
+    api_utils.send("GET", "http://kibana/api/status")
+    assert slept == [api_utils.MAX_RETRY_DELAY]
+
+
+def test_validate_key(responses, key_cache):
+    responses.append(FakeResponse(200))
+    assert api_utils.validate_key("key", "http://kibana")
+    # Validated keys aren't checked again, in this run or the next
+    assert api_utils.validate_key("key", "http://kibana")
+    api_utils._validated.clear()
+    assert api_utils.validate_key("key", "http://kibana")
+    assert not responses
+
+    with open(key_cache, encoding="utf-8") as infile:
+        cached = json.load(infile)
+    assert list(cached) == [api_utils.key_digest("key", "http://kibana")]
+    assert "key" not in json.dumps(cached)
+
+
+def test_validate_key_expired(responses, key_cache, monkeypatch):
+    responses.extend([FakeResponse(200), FakeResponse(401)])
+    api_utils.validate_key("key", "http://kibana")
+    api_utils._validated.clear()
+    now = time.time()
+    monkeypatch.setattr(api_utils.time, "time", lambda: now + 3600)
+
+    with pytest.raises(SystemExit):
+        api_utils.validate_key("key", "http://kibana")
+
+
+class StreamResponse:
+    """A streamed response whose body arrives in small chunks."""
+
+    def __init__(self, body, chunk_size=7):
+        self.status_code = 200
+        self.headers = {}
+        self.body = json.dumps(body).encode("utf-8")
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i : i + self.chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_agent_policies(monkeypatch):
+    batches = []
+
+    def fake_send(method, url, **kwargs):
+        assert url == "http://kibana/api/fleet/agent_policies/_bulk_get"
+        batches.append(kwargs["json"]["ids"])
+        # Missing policies are left out of the response
+        items = [{"id": id_} for id_ in kwargs["json"]["ids"] if id_ != "gone"]
+        return StreamResponse({"items": items})
+
+    monkeypatch.setattr(api_utils, "send", fake_send)
+    monkeypatch.setattr(api_utils, "BULK_SIZE", 2)
+    ids = ["policy-2", "gone", "policy-1", "policy-2"]
+    found = api_utils.agent_policies("key", "http://kibana", ids)
+    assert found == {"policy-1", "policy-2"}
+    assert batches == [["gone", "policy-1"], ["policy-2"]]
+    assert api_utils.agent_policies("key", "http://kibana", []) == set()
+    assert len(batches) == 2
+
+
+@pytest.fixture
+def inventory(monkeypatch, policy_factory):
+    """Serve a small package policy inventory from send."""
+    items = [
+        policy_factory(".pcp-web1-30s", host="web1.example.com"),
+        policy_factory("other-integration"),
+        policy_factory(".pcp-db1-1m", host="db1.example.com", interval="1m"),
+    ]
+    resp = StreamResponse({"items": items, "total": 3, "page": 1})
+    monkeypatch.setattr(api_utils, "send", lambda *args, **kwargs: resp)
+    return resp
+
+
+def test_generate_map(inventory):
+    idmap = api_utils.generate_map("key", "http://kibana")
+    assert idmap == {
+        ".pcp-web1-30s": {"id": "id.pcp-web1-30s"},
+        ".pcp-db1-1m": {"id": "id.pcp-db1-1m"},
+    }
+    assert inventory.closed
+
+
+def test_generate_map_extended(inventory):
+    full = api_utils.generate_map("key", "http://kibana", extended=True)
+    slim = api_utils.generate_map("key", "http://kibana", extended=True, slim=True)
+
+    assert full[".pcp-db1-1m"]["inputs"][0]["streams"][0]["vars"]
+    assert set(slim[".pcp-db1-1m"]) == set(api_utils.SLIM_FIELDS) | {
+        "enabled_",
+        "pmproxy_url_",
+        "metrics_",
+        "hostname_",
+        "interval_",
+        "package_version_",
+    }
+    for name in full:
+        for field in api_utils.SLIM_FIELDS + ("hostname_", "interval_", "metrics_"):
+            assert slim[name][field] == full[name][field]
+    assert slim[".pcp-db1-1m"]["hostname_"] == "db1.example.com"
+    assert slim[".pcp-db1-1m"]["interval_"] == "1m"
+
+
+def test_fetch_policies(monkeypatch, policy_factory):
+    items = [
+        policy_factory(f".pcp-host{i}-30s", host=f"host{i}.example.com")
+        for i in range(5)
+    ]
+    bulk = []
+
+    def fake_send(method, url, **kwargs):
+        if method == "POST":
+            bulk.append(kwargs["json"]["ids"])
+            return StreamResponse(
+                {"items": [item for item in items if item["id"] in bulk[-1]]}
+            )
+        return StreamResponse({"items": items})
+
+    monkeypatch.setattr(api_utils, "send", fake_send)
+    monkeypatch.setattr(api_utils, "BULK_SIZE", 2)
+    inv = api_utils.generate_map("key", "http://kibana", extended=True, slim=True)
+    names = [".pcp-host0-30s", ".pcp-host2-30s", ".pcp-host4-30s"]
+    policies = api_utils.fetch_policies("key", "http://kibana", inv, names)
+
+    assert [len(ids) for ids in bulk] == [2, 1]
+    assert sorted(policies) == names
+    for name in names:
+        assert policies[name]["inputs"]
+        assert policies[name]["metrics_"] == inv[name]["metrics_"]
+
+    # Policies which are already held in full aren't fetched again
+    assert api_utils.fetch_policies("key", "http://kibana", policies, names) == (
+        policies
+    )
+    assert len(bulk) == 2
+
+
+@pytest.mark.skipif(
+    not os.environ.get("INTEGRATIONS_BENCH"), reason="set INTEGRATIONS_BENCH to run"
+)
+def test_print_generate_map_bench(monkeypatch, policy_factory):
+    items = [
+        dict(policy_factory(f".pcp-host{i}-30s", host=f"host{i}.example.com"))
+        for i in range(50000)
+    ]
+    body = {"items": items, "total": len(items), "page": 1}
+    resp = StreamResponse(body, chunk_size=1 << 16)
+    del items, body
+
+    def run(load):
+        # Tracing memory slows everything down, so time a separate run
+        gc.collect()
+        start = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        tracemalloc.start()
+        result = load()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, elapsed, peak
+
+    # What generate_map used to do: decode the whole response, then pick
+    # fields out of it
+    def whole():
+        resp_body = json.loads(resp.body)
+        return {
+            item["name"]: {field: item.get(field) for field in api_utils.SLIM_FIELDS}
+            for item in resp_body["items"]
+        }
+
+    monkeypatch.setattr(api_utils, "send", lambda *args, **kwargs: resp)
+    __, old_time, old_peak = run(whole)
+    idmap, new_time, new_peak = run(
+        lambda: api_utils.generate_map("key", "http://kibana", extended=True, slim=True)
+    )
+    assert len(idmap) == 50000
+    print(f"\nresponse: {len(resp.body) / 2**20:.1f} MiB")
+    print(f"whole:     {old_time:.2f} s, peak {old_peak / 2**20:.1f} MiB")
+    print(f"streaming: {new_time:.2f} s, peak {new_peak / 2**20:.1f} MiB")
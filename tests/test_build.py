@@ -0,0 +1,51 @@
+"""Tests for build/setup.py, the optional mypyc build.
+"""
+
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import constants
+
+SETUP = os.path.join(os.path.dirname(constants.ROOT_DIR), "build", "setup.py")
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("mypyc") is None, reason="mypyc isn't installed"
+)
+def test_mypyc_build(tmp_path):
+    # Built in a copy, so the compiled modules don't shadow the sources
+    # the rest of the tests run against
+    src = tmp_path / "integrations"
+    shutil.copytree(
+        constants.ROOT_DIR,
+        str(src),
+        ignore=shutil.ignore_patterns("__pycache__", "*.so", "build", "config"),
+    )
+    proc = subprocess.run(
+        [sys.executable, SETUP, "build_ext", "--inplace"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        cwd=str(src),
+        check=False,
+    )
+    assert proc.returncode == 0, proc.stdout
+
+    # The compiled modules are the ones imported
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from utils import api_utils; print(api_utils.__file__)",
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=str(src),
+        check=True,
+    )
+    assert proc.stdout.strip().endswith(".so")
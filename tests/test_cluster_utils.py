@@ -0,0 +1,87 @@
+"""Tests for utils/cluster_utils.py.
+"""
+
+import configparser
+import sys
+import threading
+
+import pytest
+
+from utils import cluster_utils
+
+
+@pytest.fixture
+def web_info():
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "kibana": {"kibana_url": "http://kibana1", "api_key": "key1"},
+            "pmproxy": {"pool": "http://pmproxy1:44322"},
+            "kibana:dc2": {"kibana_url": "http://kibana2", "api_key": "key2"},
+            "kibana:dc3": {"kibana_url": "http://kibana3", "api_key": "key3"},
+        }
+    )
+    return config
+
+
+def test_select(web_info):
+    assert cluster_utils.clusters(web_info) == ["default", "dc2", "dc3"]
+    assert cluster_utils.select(web_info, []) == ["default"]
+    assert cluster_utils.select(web_info, ["all"]) == ["default", "dc2", "dc3"]
+    assert cluster_utils.select(web_info, ["dc3,dc2", "dc3"]) == ["dc3", "dc2"]
+    with pytest.raises(ValueError):
+        cluster_utils.select(web_info, ["dc4"])
+
+
+def test_cluster_config(web_info):
+    assert cluster_utils.cluster_config(web_info) is web_info
+    config = cluster_utils.cluster_config(web_info, "dc2")
+    assert dict(config["kibana"]) == {"kibana_url": "http://kibana2", "api_key": "key2"}
+    assert config["pmproxy"]["pool"] == "http://pmproxy1:44322"
+    assert cluster_utils.run_in(
+        "dc3", lambda: cluster_utils.cluster_config(web_info)["kibana"]["kibana_url"]
+    ) == ("http://kibana3")
+    assert cluster_utils.current() is None
+
+
+def test_cluster_path():
+    assert cluster_utils.cluster_path("config/id-map.json") == "config/id-map.json"
+    assert cluster_utils.cluster_path("config/id-map.json", "dc2") == (
+        "config/id-map.dc2.json"
+    )
+
+
+def test_fan_out(capsys):
+    # Every cluster has to be running at once to get past the barrier
+    barrier = threading.Barrier(3, timeout=5)
+
+    def run():
+        name = cluster_utils.current()
+        print(f"{name} started")
+        barrier.wait()
+        print(f"{name} finished")
+        if name == "dc3":
+            print("dc3 failed", file=sys.stderr)
+            sys.exit(2)
+
+    statuses = cluster_utils.fan_out(["default", "dc2", "dc3"], run)
+    assert statuses == {"default": 0, "dc2": 0, "dc3": 2}
+
+    captured = capsys.readouterr()
+    lines = captured.out.splitlines()
+    for name in statuses:
+        # Each cluster's output is printed in one piece
+        start = lines.index(f"{name} started")
+        assert lines[start + 1] == f"{name} finished"
+    assert "=== cluster dc3 ===\ndc3 failed" in captured.err
+    assert not isinstance(sys.stdout, cluster_utils.ClusterOutput)
+    assert cluster_utils.current() is None
+
+
+def test_fan_out_sequential(capsys):
+    order = []
+    statuses = cluster_utils.fan_out(
+        ["dc2", "dc3"], lambda: order.append(cluster_utils.current()), workers=1
+    )
+    assert statuses == {"dc2": 0, "dc3": 0}
+    assert order == ["dc2", "dc3"]
@@ -0,0 +1,57 @@
+"""Tests for interactive/commands.py.
+"""
+
+import pytest
+
+import constants
+from interactive import commands
+from utils import api_utils
+
+
+@pytest.fixture
+def handler(policy_factory):
+    name_map = {
+        ".pcp-host1-30s": policy_factory(".pcp-host1-30s"),
+        ".pcp-host2-30s": policy_factory(".pcp-host2-30s", enabled=False),
+    }
+    config = {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}}
+    return commands.UpdateHandler(sorted(name_map), name_map, config, False)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    reqs = []
+    monkeypatch.setattr(api_utils, "request", lambda req, mode: reqs.append(req))
+    return reqs
+
+
+def test_init_reqs_metrics(handler):
+    assert str(handler.req_bodies[0]["metrics_"]) == "kernel.all.load,mem.util.used"
+    assert not any(handler.changed(body) for body in handler.req_bodies)
+
+
+def test_save_skips_noop(handler, sent):
+    handler.enable()
+    handler.save()
+    assert [req[1] for req in sent] == [
+        "http://kibana/api/fleet/package_policies/id.pcp-host2-30s"
+    ]
+    assert req_body_enabled(sent[0])
+
+
+def test_save_skips_saved(handler, sent, monkeypatch):
+    monkeypatch.setattr("builtins.input", lambda prompt: "disk.dev.read")
+    handler.add_metrics()
+    handler.save()
+    handler.save()
+    assert len(sent) == 2
+    assert sent[0][3]["inputs"]["generic-httpjson"]["streams"]["httpjson.generic"][
+        "vars"
+    ]["request_url"] == (
+        "http://pmproxy1:44322/pmapi/fetch?hostspec=host1.example.com"
+        "&client=host1.example.com&names=kernel.all.load,mem.util.used,disk.dev.read"
+    )
+
+
+def req_body_enabled(req):
+    return req[3]["inputs"]["generic-httpjson"]["enabled"]
@@ -0,0 +1,69 @@
+"""Tests for modes/create.py.
+"""
+
+import configparser
+import json
+
+import pytest
+
+import main
+from modes import create
+from utils import api_utils, file_utils
+
+
+def group(policy_id):
+    return {
+        "policy_id": policy_id,
+        "pmproxy_url": "http://pmproxy1:44322",
+        "interval": "30s",
+        "metrics": "kernel.all.load",
+    }
+
+
+@pytest.fixture
+def kibana(monkeypatch):
+    """Fake the Kibana API, recording the agent policy lookups and the
+    integrations created, in the order they happen."""
+    web_info = configparser.ConfigParser()
+    web_info.read_dict({"kibana": {"kibana_url": "http://kibana", "api_key": "key"}})
+    events = []
+
+    def agent_policies(key, url, ids):
+        events.append(("lookup", sorted(ids)))
+        return {id_ for id_ in ids if id_ != "gone"}
+
+    def request(req, mode):
+        events.append(("create", req[3]["name"]))
+        return {req[3]["name"]: "id"}
+
+    monkeypatch.setattr(file_utils, "read_config", lambda: web_info)
+    monkeypatch.setattr(api_utils, "validate_key", lambda key, url: True)
+    monkeypatch.setattr(api_utils, "package_version", lambda key, url: "1.20.0")
+    monkeypatch.setattr(api_utils, "generate_map", lambda *args, **kwargs: {})
+    monkeypatch.setattr(api_utils, "agent_policies", agent_policies)
+    monkeypatch.setattr(api_utils, "request", request)
+    return events
+
+
+def test_create_unknown_policy_after_known(kibana, tmp_path, capsys):
+    config = tmp_path / "create.json"
+    config.write_text(
+        json.dumps(
+            {
+                "nodes": [
+                    {"fqdn": "web1.example.com", "groups": [group("policy-1")]},
+                    {"fqdn": "web2.example.com", "groups": [group("gone")]},
+                ]
+            }
+        )
+    )
+    args = main.build_parser(["create", str(config), "--no-outfile"])
+    with pytest.raises(SystemExit):
+        create.create(args)
+
+    # The unknown policy is found before anything is created
+    assert kibana == [
+        ("lookup", ["gone", "policy-1"]),
+        ("create", ".pcp-web1-30s"),
+    ]
+    assert "Agent policy gone does not exist" in capsys.readouterr().err
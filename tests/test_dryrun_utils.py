@@ -0,0 +1,74 @@
+"""Tests for utils/dryrun_utils.py.
+"""
+
+import json
+
+import pytest
+
+import main
+from modes import update
+from utils import api_utils, dryrun_utils, stats
+from utils.dryrun_utils import DRY_RUN
+
+KIBANA = "http://kibana/api/fleet/package_policies"
+
+
+@pytest.fixture
+def dry_run(monkeypatch):
+    """A fresh dry run, which is disabled again after the test."""
+    run = dryrun_utils.DryRun()
+    monkeypatch.setattr(DRY_RUN, "enabled", False)
+    monkeypatch.setattr(DRY_RUN, "calls", [])
+    return run
+
+
+def test_estimate(dry_run, tmp_path):
+    path = tmp_path / "latency.json"
+    path.write_text(json.dumps({"PUT /api/fleet/package_policies/{id}": {"p50": 0.4}}))
+    for i in range(10):
+        dry_run.record(("PUT", f"{KIBANA}/{i}", {}, {"name": f".pcp-host{i}-30s"}))
+    dry_run.record(("POST", KIBANA, {}, {"name": ".pcp-new-30s"}))
+
+    run_stats = stats.Stats()
+    run_stats.record("GET", KIBANA, 200, 0, run_stats.started, 0.2)
+    seconds, unmeasured = dry_run.estimate(4, run_stats, str(path))
+    assert seconds == pytest.approx((10 * 0.4 + 0.2) / 4)
+    assert unmeasured == 1
+
+    report = dry_run.report(1, stats.Stats(), str(tmp_path / "missing.json"))
+    assert f"PUT {KIBANA}/0  (.pcp-host0-30s)" in report
+    assert f"{11 * dryrun_utils.DEFAULT_LATENCY:.1f} s with 1 worker(s)" in report
+
+
+def test_save_latencies(tmp_path):
+    path = str(tmp_path / "latency.json")
+    run_stats = stats.Stats()
+    for latency in (0.1, 0.3, 0.2):
+        run_stats.record("PUT", f"{KIBANA}/123", 200, 0, run_stats.started, latency)
+    run_stats.save_latencies(path)
+    assert stats.load_latencies(path) == {
+        "PUT /api/fleet/package_policies/{id}": {"p50": 0.2, "count": 3}
+    }
+
+
+def test_batch_update_dry_run(dry_run, monkeypatch, policy_factory, capsys):
+    def fail(*args, **kwargs):
+        raise AssertionError("dry runs must not send requests")
+
+    monkeypatch.setattr(api_utils, "send", fail)
+    name_map = {
+        name: policy_factory(name) for name in [".pcp-web1-30s", ".pcp-web2-30s"]
+    }
+    args = main.build_parser(
+        ["update", "--select", "web1", "--set", "interval=1m", "--dry-run"]
+    )
+    web_info = {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}}
+    update.batch_update(args, name_map, web_info)
+
+    captured = capsys.readouterr()
+    result = json.loads(captured.out)
+    assert result["planned"] == [".pcp-web1-30s"]
+    assert "PUT http://kibana/api/fleet/package_policies/id.pcp-web1-30s" in (
+        captured.err
+    )
+    assert "1 request(s) planned" in captured.err
@@ -0,0 +1,108 @@
+"""Tests for utils/export_utils.py and modes/export_config.py.
+"""
+
+import io
+import json
+
+import jsonschema
+
+import constants
+import main
+from interactive import commands
+from modes import export_config
+from utils import api_utils, export_utils, file_utils
+from utils.inventory import Inventory, derived_fields
+
+
+def extended(policy):
+    policy.update(derived_fields(policy))
+    return policy
+
+
+def test_group(policy_factory):
+    policy = extended(policy_factory(".pcp-web1-1m-fast", interval="1m"))
+    policy["hostname_"] = "web1.example.com"
+    assert export_utils.group(policy) == {
+        "policy_id": "policy-1",
+        "pmproxy_url": "http://pmproxy1:44322",
+        "interval": "1m",
+        "metrics": "kernel.all.load,mem.util.used",
+        "suffix": "-fast",
+    }
+    policy["name"] = ".pcp-web1-1m"
+    assert "suffix" not in export_utils.group(policy)
+
+
+def test_group_nodes(policy_factory):
+    # Interleaved hosts, which the old quadratic grouping skipped
+    policies = [
+        policy_factory(".pcp-web1-30s", host="web1.example.com"),
+        policy_factory(".pcp-web2-30s", host="web2.example.com"),
+        policy_factory(".pcp-web1-1m", host="web1.example.com", interval="1m"),
+        policy_factory(".pcp-web1-5m", host="web1.example.com", interval="5m"),
+        policy_factory(".pcp-web2-1m", host="web2.example.com", interval="1m"),
+    ]
+    nodes = list(export_utils.group_nodes(Inventory(policies).values()))
+
+    assert [node["fqdn"] for node in nodes] == ["web1.example.com", "web2.example.com"]
+    assert [group["interval"] for group in nodes[0]["groups"]] == ["30s", "1m", "5m"]
+    assert [group["interval"] for group in nodes[1]["groups"]] == ["30s", "1m"]
+
+
+def test_write_config(policy_factory):
+    policies = [
+        extended(policy_factory(f".pcp-host{i}-30s", host=f"host{i}.example.com"))
+        for i in range(3)
+    ]
+    outfile = io.StringIO()
+    assert export_utils.write_config(export_utils.group_nodes(policies), outfile) == 3
+
+    config = json.loads(outfile.getvalue())
+    jsonschema.validate(config, file_utils.SCHEMAS[constants.CREATE])
+    assert len(config["nodes"]) == 3
+
+    outfile = io.StringIO()
+    export_utils.write_config(iter([]), outfile)
+    assert json.loads(outfile.getvalue()) == {"nodes": []}
+
+
+def test_export_config(tmp_path, monkeypatch, policy_factory, capsys):
+    policies = [
+        policy_factory(".pcp-web1-30s", host="web1.example.com"),
+        policy_factory(".pcp-db1-30s", host="db1.example.com"),
+    ]
+    monkeypatch.setattr(api_utils, "pcp_policies", lambda key, url: iter(policies))
+    monkeypatch.setattr(
+        file_utils,
+        "read_config",
+        lambda: {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}},
+    )
+
+    export_config.export_config(main.build_parser(["export-config", "--select", "web"]))
+    config = json.loads(capsys.readouterr().out)
+    assert [node["fqdn"] for node in config["nodes"]] == ["web1.example.com"]
+
+    out = tmp_path / "config.json"
+    export_config.export_config(main.build_parser(["export-config", "-o", str(out)]))
+    assert "2 node(s)" in capsys.readouterr().out
+    assert len(json.loads(out.read_text())["nodes"]) == 2
+    assert list(tmp_path.iterdir()) == [out]
+
+
+def test_create_config(tmp_path, monkeypatch, policy_factory, capsys):
+    names = [".pcp-web1-30s", ".pcp-web2-30s", ".pcp-web1-1m"]
+    name_map = Inventory(
+        policy_factory(name, host=f"{name.split('-')[1]}.example.com") for name in names
+    )
+    handler = commands.UpdateHandler([], name_map, {}, False)
+    handler.selected = names
+    (tmp_path / "config").mkdir()
+    monkeypatch.setattr(constants, "ROOT_DIR", str(tmp_path))
+
+    handler.create_config()
+    with open(tmp_path / "config" / "sample_config.json", encoding="utf-8") as infile:
+        nodes = json.load(infile)["nodes"]
+    assert [len(node["groups"]) for node in nodes] == [2, 1]
+    assert "Wrote config for 2 node(s) to config/sample_config.json" in (
+        capsys.readouterr().out
+    )
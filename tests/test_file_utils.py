@@ -0,0 +1,123 @@
+"""Tests for utils/file_utils.py.
+"""
+
+import json
+
+import pytest
+
+import constants
+from utils import file_utils
+
+
+def group(**kwargs):
+    out = {
+        "policy_id": "policy-1",
+        "pmproxy_url": "http://pmproxy1:44322",
+        "interval": "30s",
+        "metrics": "kernel.all.load",
+    }
+    out.update(kwargs)
+    return out
+
+
+@pytest.fixture
+def create_file(tmp_path):
+    path = tmp_path / "create.json"
+    nodes = [
+        {"fqdn": "host1.example.com", "groups": [group()]},
+        {"fqdn": "host2.example.com", "groups": [group(interval=30)]},
+        {"groups": [group()]},
+        {"fqdn": "host4.example.com", "groups": [group(), group()]},
+    ]
+    path.write_text(json.dumps({"nodes": nodes}))
+    return str(path)
+
+
+def test_iter_config_errors(create_file):
+    errors = []
+    nodes = [
+        node["fqdn"]
+        for __, node in file_utils.iter_config(create_file, constants.CREATE, errors)
+    ]
+    assert nodes == ["host1.example.com", "host4.example.com"]
+    assert errors == [
+        "$.nodes[1].groups[0].interval: 30 is not of type 'string'",
+        "$.nodes[2]: 'fqdn' is a required property",
+    ]
+
+
+def test_iter_config_missing_nodes(tmp_path):
+    path = tmp_path / "create.json"
+    path.write_text("{}")
+    errors = []
+    assert not list(file_utils.iter_config(str(path), constants.CREATE, errors))
+    assert errors == ["$: {} is not valid under any of the given schemas"]
+
+
+def test_load_config_delete(tmp_path):
+    path = tmp_path / "delete.json"
+    path.write_text(json.dumps({"names": [".pcp-host1-30s", ".pcp-host2-30s"]}))
+    config = file_utils.load_config(str(path), constants.DELETE)
+    assert config == {"names": [".pcp-host1-30s", ".pcp-host2-30s"]}
+
+
+def test_load_config_delete_conflict(tmp_path):
+    path = tmp_path / "delete.json"
+    path.write_text(json.dumps({"names": ["a"], "ids": [1]}))
+    with pytest.raises(SystemExit) as wrapped_e:
+        file_utils.load_config(str(path), constants.DELETE)
+    assert wrapped_e.value.code == 1
+
+
+def test_check_file_valid(tmp_path):
+    path = tmp_path / "create.json"
+    path.write_text(json.dumps({"nodes": [{"fqdn": "h", "groups": [group()]}]}))
+    with pytest.raises(SystemExit) as wrapped_e:
+        file_utils.check_file(str(path), constants.CREATE)
+    assert wrapped_e.value.code == 0
+
+
+def test_get_validator_cached():
+    assert file_utils.get_validator(constants.CREATE, "nodes") is (
+        file_utils.get_validator(constants.CREATE, "nodes")
+    )
+
+
+def test_iter_nodes_compact(tmp_path):
+    path = tmp_path / "create.json"
+    config = {
+        "templates": {"web": [group(), group(interval="10s")], "base": [group()]},
+        "hosts": [
+            {"fqdn": "web[001-400].dc1.example.com", "template": "web"},
+            {"fqdn": "db1", "templates": ["base"], "groups": [group(interval="1m")]},
+            {"fqdn": "db2", "template": "missing"},
+            {"fqdn": "db[3-x]", "template": "base"},
+        ],
+        "nodes": [{"fqdn": "other", "groups": [group()]}],
+    }
+    path.write_text(json.dumps(config))
+    errors = []
+    nodes = list(file_utils.iter_nodes(str(path), errors))
+
+    assert len(nodes) == 402
+    assert nodes[0]["fqdn"] == "web001.dc1.example.com"
+    assert nodes[399]["fqdn"] == "web400.dc1.example.com"
+    assert [g["interval"] for g in nodes[400]["groups"]] == ["30s", "1m"]
+    assert nodes[401]["fqdn"] == "other"
+    # Each node gets its own copies of the groups
+    nodes[0]["groups"][0]["fqdn"] = "web001.dc1.example.com"
+    assert "fqdn" not in nodes[1]["groups"][0]
+    assert len(errors) == 2
+    assert errors[0].startswith("db2: unknown template(s) missing.")
+
+
+def test_iter_nodes_invalid_template(tmp_path):
+    path = tmp_path / "create.json"
+    config = {
+        "templates": {"web": [group(interval=30)]},
+        "hosts": [{"fqdn": "web1", "template": "web"}],
+    }
+    path.write_text(json.dumps(config))
+    errors = []
+    assert not list(file_utils.iter_nodes(str(path), errors))
+    assert errors[0] == "$.templates.web[0].interval: 30 is not of type 'string'"
@@ -0,0 +1,26 @@
+"""Tests for utils/host_utils.py.
+"""
+
+import pytest
+
+from utils import host_utils
+
+
+@pytest.mark.parametrize(
+    "pattern, hosts",
+    [
+        ("web1.example.com", ["web1.example.com"]),
+        ("web[8-10].dc1", ["web8.dc1", "web9.dc1", "web10.dc1"]),
+        ("web[008-010]", ["web008", "web009", "web010"]),
+        ("db[1,3,5-6]", ["db1", "db3", "db5", "db6"]),
+        ("r[1-2]n[1-2]", ["r1n1", "r1n2", "r2n1", "r2n2"]),
+    ],
+)
+def test_expand_hosts(pattern, hosts):
+    assert list(host_utils.expand_hosts(pattern)) == hosts
+
+
+@pytest.mark.parametrize("pattern", ["web[2-1]", "web[a-b]", "web[1-2", "web[]"])
+def test_expand_hosts_invalid(pattern):
+    with pytest.raises(ValueError):
+        list(host_utils.expand_hosts(pattern))
@@ -1,6 +1,8 @@
 """Tests for integrations.py.
 """
 
+import sys
+
 import pytest
 
 import main
@@ -59,5 +61,96 @@ def test_validate_args():
     assert wrapped_e.value.code == 1
 
 
-def test_run_cmd():
+def test_run_cmd(monkeypatch):
+    called = []
+    args = main.build_parser(["list"])
+    monkeypatch.setattr("modes.ilist.ilist", lambda args: called.append("list"))
+    main.run_command(args)
+    assert called == ["list"]
+
+
+def test_parser_update_1():
+    args = main.build_parser(["update"])
+    assert args.select is None and args.file is None and args.enabled is None
+
+
+def test_parser_update_2():
+    args = main.build_parser(
+        ["update", "--select", "host1", "--set", "interval=30s", "--disable"]
+    )
+    assert args.set == ["interval=30s"] and args.enabled is False
+
+
+def test_validate_args_update_1():
+    args = main.build_parser(["update", "--enable"])
+    with pytest.raises(SystemExit) as wrapped_e:
+        main.validate_args(args)
+    assert wrapped_e.value.code == 1
+
+
+def test_validate_args_update_2():
+    args = main.build_parser(["update", "--select", "x", "--set", "policy_id=y"])
+    with pytest.raises(SystemExit) as wrapped_e:
+        main.validate_args(args)
+    assert wrapped_e.value.code == 1
+
+
+def test_parser_plan():
+    args = main.build_parser(["plan", "create.json", "--max-url-length", "1000"])
+    assert args.command == "plan"
+    assert args.max_url_length == 1000
+    assert args.out is None
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["plan"],
+        ["plan", "create.json", "--inventory"],
+        ["plan", "x", "--stagger", "60"],
+    ],
+)
+def test_validate_args_plan(argv):
+    args = main.build_parser(argv)
+    with pytest.raises(SystemExit) as wrapped_e:
+        main.validate_args(args)
+    assert wrapped_e.value.code == 1
+
+
+def test_validate_args_update_dry_run():
+    args = main.build_parser(["update", "--dry-run"])
+    with pytest.raises(SystemExit) as wrapped_e:
+        main.validate_args(args)
+    assert wrapped_e.value.code == 1
+
+
+def test_run_clusters(monkeypatch, tmp_path):
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "web_config.ini").write_text(
+        "[kibana]\nkibana_url = http://kibana1\napi_key = key1\n"
+        "[kibana:dc2]\nkibana_url = http://kibana2\napi_key = key2\n"
+    )
+    monkeypatch.setattr(main.constants, "ROOT_DIR", str(tmp_path))
+    seen = []
+
+    def run():
+        from utils import file_utils
+
+        url = file_utils.read_config()["kibana"]["kibana_url"]
+        seen.append(url)
+        if url == "http://kibana2":
+            sys.exit(1)
+
+    args = main.build_parser(["rebalance", "--cluster", "all"])
+    with pytest.raises(SystemExit) as wrapped_e:
+        main.run_clusters(args, run)
+    assert wrapped_e.value.code == 1
+    assert sorted(seen) == ["http://kibana1", "http://kibana2"]
+
+    seen.clear()
+    main.run_clusters(main.build_parser(["rebalance"]), run)
+    assert seen == ["http://kibana1"]
 
+    args = main.build_parser(["rebalance", "--cluster", "dc3"])
+    with pytest.raises(SystemExit):
+        main.run_clusters(args, run)
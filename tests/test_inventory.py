@@ -0,0 +1,102 @@
+"""Tests for utils/inventory.py.
+"""
+
+import gc
+import os
+import tracemalloc
+
+import pytest
+
+from utils import inventory
+
+
+def test_inventory(policy_factory):
+    policies = [
+        policy_factory(".pcp-web1-30s", host="web1.example.com"),
+        policy_factory(".pcp-web2-30s", host="web2.example.com", enabled=False),
+        policy_factory(".pcp-web2-1m", host="web2.example.com", metrics="a.b,,a.b"),
+    ]
+    inv = inventory.Inventory(policies)
+
+    assert list(inv) == [".pcp-web1-30s", ".pcp-web2-30s", ".pcp-web2-1m"]
+    for policy in policies:
+        expected = {field: policy[field] for field in ("id", "name", "policy_id")}
+        expected.update(inventory.derived_fields(policy))
+        expected["version"] = policy["version"]
+        assert dict(inv[policy["name"]]) == expected
+
+    record = inv[".pcp-web2-1m"]
+    assert record.metrics == ("a.b", "", "a.b")
+    assert record["metrics_"] == "a.b,,a.b"
+    assert record.get("missing") is None
+    assert not inv[".pcp-web2-30s"]["enabled_"]
+
+
+def test_inventory_request_urls(policy_factory, capsys):
+    broken = policy_factory(".pcp-web3-30s")
+    stream = broken["inputs"][0]["streams"][0]
+    stream["vars"]["request_url"]["value"] = "pmproxy1:44322/metrics"
+    inv = inventory.Inventory(
+        [
+            policy_factory(".pcp-web1-30s", pmproxy_url="https://pmproxy1:44323"),
+            broken,
+            policy_factory(".pcp-web2-30s"),
+        ]
+    )
+
+    assert list(inv) == [".pcp-web1-30s", ".pcp-web2-30s"]
+    assert inv[".pcp-web1-30s"]["pmproxy_url_"] == "https://pmproxy1:44323"
+    assert inv[".pcp-web2-30s"]["pmproxy_url_"] == "http://pmproxy1:44322"
+    assert "Skipping .pcp-web3-30s" in capsys.readouterr().err
+
+
+def test_inventory_sharing(policy_factory):
+    inv = inventory.Inventory(
+        policy_factory(f".pcp-host{i}-30s", host=f"host{i}.example.com")
+        for i in range(3)
+    )
+    first, second = inv[".pcp-host0-30s"], inv[".pcp-host1-30s"]
+    assert first.metric_ids is second.metric_ids
+    assert first.pmproxy_url is second.pmproxy_url
+    assert inv.metric_table == ["kernel.all.load", "mem.util.used"]
+
+
+@pytest.mark.skipif(
+    not os.environ.get("INTEGRATIONS_BENCH"), reason="set INTEGRATIONS_BENCH to run"
+)
+def test_print_inventory_bench(policy_factory):
+    count = 100000
+    metrics = ",".join(f"kernel.percpu.cpu.metric{i}" for i in range(20))
+
+    def policies():
+        for i in range(count):
+            yield policy_factory(
+                f".pcp-host{i}-30s",
+                id_=f"{i:08x}-0000-4000-8000-000000000000",
+                host=f"host{i}.example.com",
+                pmproxy_url=f"http://pmproxy{i % 8}:44322",
+                metrics=metrics,
+            )
+
+    def measure(load):
+        gc.collect()
+        tracemalloc.start()
+        result = load()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, size
+
+    # What update and rebalance used to keep: every policy in full
+    def full():
+        idmap = {}
+        for policy in policies():
+            policy.update(inventory.derived_fields(policy))
+            idmap[policy["name"]] = policy
+        return idmap
+
+    __, full_size = measure(full)
+    inv, inv_size = measure(lambda: inventory.Inventory(policies()))
+    assert len(inv) == count
+    print(f"\nfull map:  {full_size / 2**20:.1f} MiB")
+    print(f"inventory: {inv_size / 2**20:.1f} MiB")
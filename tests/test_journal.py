@@ -0,0 +1,99 @@
+"""Tests for utils/journal.py and modes/rollback.py.
+"""
+
+import functools
+import json
+
+import pytest
+
+import main
+from modes import rollback
+from utils import api_utils, file_utils, journal
+
+
+def test_journal(journal_dir, policy_factory):
+    log = journal.Journal(journal_dir)
+    old = policy_factory(".pcp-web1-30s", host="web1.example.com")
+    log.record(journal.PUT, old)
+    # Later changes to the same integration don't replace its first state
+    log.record(journal.PUT, policy_factory(".pcp-web1-30s", interval="1m"))
+    log.record(journal.DELETE, policy_factory(".pcp-db1-30s"))
+    log.close()
+
+    path = journal.journal_path(log.run_id, journal_dir)
+    with open(path, "a", encoding="utf-8") as outfile:
+        outfile.write('{"kind":"PUT","id":')
+
+    entries = journal.load(log.run_id, journal_dir)
+    assert [(entry["kind"], entry["name"]) for entry in entries] == [
+        ("PUT", ".pcp-web1-30s"),
+        ("DELETE", ".pcp-db1-30s"),
+    ]
+    stream = entries[0]["body"]["inputs"]["generic-httpjson"]["streams"]
+    assert stream["httpjson.generic"]["vars"]["request_interval"] == "30s"
+    assert "revision" not in entries[0]["body"]
+
+
+def test_journal_outcomes(journal_dir, policy_factory):
+    log = journal.Journal(journal_dir)
+    web1 = policy_factory(".pcp-web1-30s")
+    failed = log.record(journal.PUT, web1)
+    log.resolve(failed, web1["id"], False)
+    # After a refused change, the next attempt holds the state to restore
+    applied = log.record(journal.PUT, policy_factory(".pcp-web1-30s", interval="1m"))
+    log.resolve(applied, web1["id"], True)
+    db1 = policy_factory(".pcp-db1-30s")
+    log.resolve(log.record(journal.DELETE, db1), db1["id"], False)
+    # Changes with no outcome may have been applied before the run died
+    log.record(journal.DELETE, policy_factory(".pcp-db2-30s"))
+    log.close()
+
+    entries = journal.load(log.run_id, journal_dir)
+    assert [(entry["kind"], entry["name"]) for entry in entries] == [
+        ("PUT", ".pcp-web1-30s"),
+        ("DELETE", ".pcp-db2-30s"),
+    ]
+    stream = entries[0]["body"]["inputs"]["generic-httpjson"]["streams"]
+    assert stream["httpjson.generic"]["vars"]["request_interval"] == "1m"
+
+
+def test_rollback(journal_dir, monkeypatch, policy_factory, capsys):
+    log = journal.Journal(journal_dir)
+    for i in range(20):
+        log.record(journal.PUT, policy_factory(f".pcp-host{i}-30s"))
+    log.record(journal.DELETE, policy_factory(".pcp-db1-30s"))
+    log.close()
+
+    sent = []
+
+    def fake_request(req, mode):
+        sent.append(req)
+        if req[3]["name"] == ".pcp-host3-30s":
+            raise api_utils.requests.exceptions.HTTPError("500")
+        return {}
+
+    monkeypatch.setattr(api_utils, "request", fake_request)
+    monkeypatch.setattr(
+        journal, "load", functools.partial(journal.load, directory=journal_dir)
+    )
+    monkeypatch.setattr(
+        file_utils,
+        "read_config",
+        lambda: {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}},
+    )
+    with pytest.raises(SystemExit):
+        rollback.rollback(main.build_parser(["rollback", log.run_id]))
+
+    result = json.loads(capsys.readouterr().out)
+    assert len(result["restored"]) == 19 and len(sent) == 21
+    assert result["recreated"] == [".pcp-db1-30s"]
+    assert list(result["failed"]) == [".pcp-host3-30s"]
+    post = [req for req in sent if req[0] == "POST"][0]
+    assert post[1] == "http://kibana/api/fleet/package_policies"
+    assert post[3]["id"] == "id.pcp-db1-30s"
+
+
+def test_rollback_missing(journal_dir, capsys):
+    with pytest.raises(SystemExit):
+        rollback.rollback(main.build_parser(["rollback", "no-such-run"]))
+    assert "no-such-run" in capsys.readouterr().err
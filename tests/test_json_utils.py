@@ -0,0 +1,46 @@
+"""Tests for utils/json_utils.py.
+"""
+
+import json
+
+import pytest
+
+from utils import json_utils
+
+
+def chunked(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_iter_object_streamed(size):
+    doc = {"a": 123, "items": [{"x": [1, 2]}, "y", 45.5, None], "b": {"c": "d"}}
+    out = list(json_utils.iter_object(chunked(json.dumps(doc), size), ("items",)))
+    assert out == [
+        ("a", None, 123),
+        ("items", None, []),
+        ("items", 0, {"x": [1, 2]}),
+        ("items", 1, "y"),
+        ("items", 2, 45.5),
+        ("items", 3, None),
+        ("b", None, {"c": "d"}),
+    ]
+
+
+def test_iter_object_bytes():
+    doc = json.dumps({"items": ["héllo"]}).encode("utf-8")
+    out = list(json_utils.iter_object(chunked(doc, 1), ("items",)))
+    assert out[-1] == ("items", 0, "héllo")
+
+
+def test_iter_object_empty():
+    assert list(json_utils.iter_object(['{"items": [] }'], ("items",))) == [
+        ("items", None, [])
+    ]
+    assert not list(json_utils.iter_object(["{}"]))
+
+
+@pytest.mark.parametrize("text", ['{"a": [1, 2}', '{"a": 1} x', "[1]", '{"a" 1}'])
+def test_iter_object_invalid(text):
+    with pytest.raises(json.JSONDecodeError):
+        list(json_utils.iter_object(chunked(text, 2), ("a",)))
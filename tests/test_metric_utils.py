@@ -0,0 +1,64 @@
+"""Tests for utils/metric_utils.py.
+"""
+
+import pytest
+
+from utils import metric_utils
+
+
+def test_metric_set_unchanged():
+    mset = metric_utils.MetricSet("a.b,c.d,a.b")
+    assert mset.to_string() == "a.b,c.d,a.b"
+    assert not mset.changed()
+
+
+def test_metric_set_add():
+    mset = metric_utils.MetricSet("a.b,c.d")
+    assert mset.add(["c.d", "e.f", "e.f"]) == ["e.f"]
+    assert mset.to_string() == "a.b,c.d,e.f"
+    assert mset.changed()
+
+
+def test_metric_set_add_duplicates():
+    mset = metric_utils.MetricSet("a.b,c.d", allow_duplicates=True)
+    mset.add(["a.b"])
+    assert mset.to_string() == "a.b,c.d,a.b"
+    assert len(mset) == 3
+
+
+def test_metric_set_duplicates_order():
+    # Copies stay where they were configured, so the fetch URL keeps
+    # the user's order
+    mset = metric_utils.MetricSet("a.b,c.d,a.b", allow_duplicates=True)
+    assert list(mset) == ["a.b", "c.d", "a.b"]
+    mset.add(["e.f", "c.d"])
+    assert mset.to_string() == "a.b,c.d,a.b,e.f,c.d"
+    mset.remove(["e.f"])
+    assert mset.to_string() == "a.b,c.d,a.b,c.d"
+
+
+def test_metric_set_remove():
+    mset = metric_utils.MetricSet("a.b,c.d,a.b", allow_duplicates=True)
+    assert mset.remove(["a.b", "x.y"]) == ["a.b"]
+    assert mset.to_string() == "c.d"
+    assert mset.removed == ["a.b"]
+
+
+def test_metric_set_noop_edit():
+    mset = metric_utils.MetricSet("a.b,c.d")
+    mset.add(["e.f"])
+    mset.remove(["e.f"])
+    assert not mset.changed()
+
+
+def test_metric_set_commit():
+    mset = metric_utils.MetricSet("a.b")
+    mset.add(["c.d"])
+    mset.commit()
+    assert mset.original == "a.b,c.d"
+    assert not mset.added and not mset.changed()
+
+
+@pytest.mark.parametrize("metrics", ["", "a.b,,c.d"])
+def test_split_metrics(metrics):
+    assert "" not in metric_utils.split_metrics(metrics)
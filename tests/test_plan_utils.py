@@ -0,0 +1,258 @@
+"""Tests for utils/plan_utils.py.
+"""
+
+import pytest
+
+import constants
+from utils import api_utils, plan_utils, policy_utils
+
+
+def group(**kwargs):
+    out = {
+        "policy_id": "policy-1",
+        "pmproxy_url": "http://pmproxy1:44322",
+        "interval": "30s",
+        "metrics": "kernel.all.load",
+    }
+    out.update(kwargs)
+    return out
+
+
+@pytest.mark.parametrize("interval, seconds", [("10s", 10), ("5m", 300), ("1h", 3600)])
+def test_interval_seconds(interval, seconds):
+    assert plan_utils.interval_seconds(interval) == seconds
+
+
+def test_interval_seconds_invalid():
+    with pytest.raises(ValueError):
+        plan_utils.interval_seconds("10d")
+
+
+def test_pack_groups():
+    groups = [
+        group(metrics="kernel.all.load,mem.util.used"),
+        group(metrics="mem.util.used,disk.all.read"),
+        group(interval="10s"),
+        group(policy_id="policy-2"),
+    ]
+    packed = plan_utils.pack_groups("host1.example.com", groups)
+
+    assert packed == [
+        group(metrics="kernel.all.load,mem.util.used,disk.all.read"),
+        group(interval="10s"),
+        group(policy_id="policy-2"),
+    ]
+    assert plan_utils.fetch_rate(groups) > plan_utils.fetch_rate(packed)
+
+
+def test_pack_groups_max_url_length():
+    metrics = [f"metric.number{i}" for i in range(10)]
+    groups = [group(metrics=name) for name in metrics]
+    max_length = len(
+        api_utils.fetch_url(groups[0]["pmproxy_url"], "host1", ",".join(metrics[:4]))
+    )
+    packed = plan_utils.pack_groups("host1", groups, max_length)
+
+    assert [g["metrics"].split(",") for g in packed] == [
+        metrics[:4],
+        metrics[4:8],
+        metrics[8:],
+    ]
+    assert [g.get("suffix") for g in packed] == [None, "-2", "-3"]
+    for g in packed:
+        url = api_utils.fetch_url(g["pmproxy_url"], "host1", g["metrics"])
+        assert len(url) <= max_length
+
+
+def collision_nodes():
+    return [
+        {
+            "fqdn": "web1.example.com",
+            "groups": [
+                group(),
+                group(metrics="mem.util.used"),
+                group(pmproxy_url="http://pmproxy2:44322"),
+                group(interval="1m"),
+            ],
+        },
+        # Same short name in another domain
+        {"fqdn": "web1.example.org", "groups": [group()]},
+    ]
+
+
+def names(nodes):
+    return [
+        api_utils.integration_name(node["fqdn"], g)
+        for node in nodes
+        for g in node["groups"]
+    ]
+
+
+def test_dedupe_nodes_skip():
+    errors = []
+    nodes = list(
+        plan_utils.dedupe_nodes(
+            collision_nodes(), {".pcp-web1-1m"}, constants.SKIP, errors, 2048
+        )
+    )
+    assert names(nodes) == [".pcp-web1-30s"]
+    assert errors == [
+        "web1.example.com: integration .pcp-web1-30s already exists in the config",
+        "web1.example.com: integration .pcp-web1-30s already exists in the config",
+        "web1.example.com: integration .pcp-web1-1m already exists in Kibana",
+        "web1.example.org: integration .pcp-web1-30s already exists in the config",
+    ]
+
+
+def test_dedupe_nodes_suffix():
+    errors = []
+    nodes = list(
+        plan_utils.dedupe_nodes(
+            collision_nodes(), {".pcp-web1-30s-2"}, constants.SUFFIX, errors, 2048
+        )
+    )
+    assert names(nodes) == [
+        ".pcp-web1-30s",
+        ".pcp-web1-30s-3",
+        ".pcp-web1-30s-4",
+        ".pcp-web1-1m",
+        ".pcp-web1-30s-5",
+    ]
+    assert not errors
+    assert len(set(names(nodes))) == len(names(nodes))
+
+
+def test_dedupe_nodes_merge():
+    errors = []
+    nodes = list(
+        plan_utils.dedupe_nodes(collision_nodes(), (), constants.MERGE, errors, 2048)
+    )
+    assert names(nodes) == [
+        ".pcp-web1-30s",
+        ".pcp-web1-30s-2",
+        ".pcp-web1-1m",
+        ".pcp-web1-30s-3",
+    ]
+    assert nodes[0]["groups"][0]["metrics"] == "kernel.all.load,mem.util.used"
+    assert nodes[0]["groups"][1]["pmproxy_url"] == "http://pmproxy2:44322"
+
+    # Merges which would make the URL too long are suffixed instead
+    max_length = len(
+        api_utils.fetch_url(
+            "http://pmproxy1:44322", "web1.example.com", "kernel.all.load"
+        )
+    )
+    nodes = list(
+        plan_utils.dedupe_nodes(
+            collision_nodes(), (), constants.MERGE, errors, max_length
+        )
+    )
+    assert names(nodes)[:2] == [".pcp-web1-30s", ".pcp-web1-30s-2"]
+    assert nodes[0]["groups"][1]["metrics"] == "mem.util.used"
+
+
+def test_pack_before_place():
+    groups = [
+        group(policy_pool=["policy-1", "policy-2"], metrics="kernel.all.load"),
+        group(policy_pool=["policy-1", "policy-2"], metrics="mem.util.used"),
+        group(metrics="disk.all.read"),
+    ]
+    for g in groups[:2]:
+        del g["policy_id"]
+    packed = plan_utils.pack_groups("host1.example.com", groups)
+    assert packed == [
+        {
+            "pmproxy_url": "http://pmproxy1:44322",
+            "interval": "30s",
+            "metrics": "kernel.all.load,mem.util.used",
+            "policy_pool": ["policy-1", "policy-2"],
+        },
+        group(metrics="disk.all.read"),
+    ]
+
+    # The cap only counts the packed group
+    errors = []
+    placer = policy_utils.PolicyPlacer(cap=1)
+    nodes = [{"fqdn": "host1.example.com", "groups": packed}]
+    (node,) = policy_utils.place_nodes(nodes, placer, [], errors)
+    assert not errors
+    assert node["groups"][0]["policy_id"] in ("policy-1", "policy-2")
+
+
+def test_pack_summary():
+    summary = plan_utils.PackSummary()
+    nodes = [
+        {"fqdn": "host1", "groups": [group(), group(), group(interval="10s")]},
+        {"fqdn": "host2", "groups": [group()]},
+    ]
+    assert len(list(plan_utils.pack_nodes(nodes, summary))) == 2
+
+    assert (summary.groups_before, summary.groups_after) == (4, 3)
+    assert summary.rate_before == pytest.approx(3 / 30 + 1 / 10)
+    assert summary.rate_after == pytest.approx(2 / 30 + 1 / 10)
+    assert "4 group(s) packed into 3 integration(s)" in summary.report()
+
+
+def test_stagger_interval():
+    variants = {
+        plan_utils.stagger_interval(f"host{i}", group(), 10) for i in range(100)
+    }
+    assert variants == {"27s", "28s", "29s", "30s", "31s", "32s", "33s"}
+    # The same group always gets the same variant
+    assert plan_utils.stagger_interval("host1", group(), 10) == (
+        plan_utils.stagger_interval("host1", group(), 10)
+    )
+    assert plan_utils.stagger_interval("host1", group(interval="5s"), 10) == "5s"
+
+
+def test_stagger_nodes_keeps_names():
+    nodes = [
+        {"fqdn": f"host{i}.example.com", "groups": [group(interval="10s")]}
+        for i in range(20)
+    ]
+    staggered = list(plan_utils.stagger_nodes(nodes, 20))
+    assert {g["interval"] for node in staggered for g in node["groups"]} != {"10s"}
+    for node in staggered:
+        (g,) = node["groups"]
+        name = api_utils.integration_name(node["fqdn"], g)
+        assert name == f".pcp-{node['fqdn'].split('.')[0]}-10s"
+
+    # Staggering again, e.g. a staggered plan passed to create --stagger,
+    # starts from the nominal interval
+    intervals = [node["groups"][0]["interval"] for node in staggered]
+    restaggered = list(plan_utils.stagger_nodes(staggered, 20))
+    assert [node["groups"][0]["interval"] for node in restaggered] == intervals
+    assert all(
+        g.get("nominal_interval", g["interval"]) == "10s"
+        for node in restaggered
+        for g in node["groups"]
+    )
+
+
+def test_load_simulator():
+    simulator = plan_utils.LoadSimulator()
+    for __ in range(3):
+        simulator.add("http://pmproxy1:44322", "10s")
+    simulator.add("http://pmproxy2:44322", "1m")
+    simulator.add("http://pmproxy2:44322", "500ms")
+
+    load = simulator.histogram(horizon=120)
+    assert load[0] == 4
+    assert load[10] == 3
+    assert load[60] == 4
+    assert sum(load) == 3 * 12 + 2
+    assert simulator.histogram(["http://pmproxy2:44322"], 120)[60] == 1
+    assert simulator.skipped == 1
+    assert "total" in simulator.report(120)
+
+
+def test_load_simulator_staggered():
+    lockstep = plan_utils.LoadSimulator()
+    staggered = plan_utils.LoadSimulator()
+    for i in range(200):
+        lockstep.add("http://pmproxy1:44322", "30s")
+        interval = plan_utils.stagger_interval(f"host{i}", group(), 20)
+        staggered.add("http://pmproxy1:44322", interval)
+
+    assert max(lockstep.histogram()) == 200
+    assert max(staggered.histogram()) < 200
@@ -0,0 +1,142 @@
+"""Tests for utils/pmproxy_utils.py, using a local stand-in for pmproxy.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import socket
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from utils import api_utils, pmproxy_utils, stats
+
+PMNS = [
+    "kernel.all.load",
+    "kernel.all.cpu.user",
+    "kernel.all.cpu.sys",
+    "mem.util.used",
+]
+
+
+class PMProxyHandler(BaseHTTPRequestHandler):
+    """Serve /pmapi/metric?prefix= from PMNS."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/pmapi/context":
+            self.server.seen.append((url.path,))
+            return self.reply(200, {"context": 1})
+        if url.path == "/pmapi/fetch":
+            host = query["hostspec"][0]
+            self.server.seen.append((url.path, host))
+            if host.startswith("down"):
+                return self.reply(400, {"success": False, "message": "no pmcd"})
+            return self.reply(200, {"values": []})
+
+        self.server.seen.append((url.path, query["hostspec"][0], query["prefix"][0]))
+
+        prefix = query["prefix"][0]
+        names = [
+            name for name in PMNS if name == prefix or name.startswith(prefix + ".")
+        ]
+        self.reply(200 if names else 400, {"metrics": [{"name": n} for n in names]})
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pmproxy():
+    server = HTTPServer(("127.0.0.1", 0), PMProxyHandler)
+    server.seen = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def groups(server, metrics="kernel.all.cpu,mem.util.used"):
+    url = f"http://127.0.0.1:{server.server_port}"
+    return [
+        {"fqdn": "host1.example.com", "pmproxy_url": url, "metrics": metrics},
+        {"fqdn": "host1.example.com", "pmproxy_url": url, "metrics": metrics},
+        {"fqdn": "host2.example.com", "pmproxy_url": url, "metrics": metrics},
+    ]
+
+
+def test_expand_groups(pmproxy, tmp_path):
+    cache = pmproxy_utils.PMNSCache(str(tmp_path / "cache.json"))
+    targets = groups(pmproxy)
+    pmproxy_utils.expand_groups(targets, cache)
+
+    assert (
+        targets[0]["metrics"] == "kernel.all.cpu.user,kernel.all.cpu.sys,mem.util.used"
+    )
+    # Identical lookups are only sent once
+    assert len(pmproxy.seen) == 4
+
+
+def test_expand_groups_cached(pmproxy, tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = pmproxy_utils.PMNSCache(path)
+    pmproxy_utils.expand_groups(groups(pmproxy), cache)
+    cache.save()
+
+    pmproxy.seen.clear()
+    targets = groups(pmproxy)
+    pmproxy_utils.expand_groups(targets, pmproxy_utils.PMNSCache(path))
+    assert not pmproxy.seen
+    assert "kernel.all.cpu.sys" in targets[2]["metrics"]
+
+    pmproxy_utils.expand_groups(groups(pmproxy), pmproxy_utils.PMNSCache(path, ttl=-1))
+    assert len(pmproxy.seen) == 4
+
+
+def test_expand_groups_unknown(pmproxy, tmp_path):
+    cache = pmproxy_utils.PMNSCache(str(tmp_path / "cache.json"))
+    targets = groups(pmproxy, "no.such.metric,mem.util")
+    pmproxy_utils.expand_groups(targets, cache)
+    assert targets[0]["metrics"] == "no.such.metric,mem.util.used"
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_preflight(pmproxy, monkeypatch):
+    run = stats.Stats()
+    monkeypatch.setattr(api_utils, "STATS", run)
+    url = f"http://127.0.0.1:{pmproxy.server_port}"
+    dead = f"http://127.0.0.1:{closed_port()}"
+    targets = [
+        (url, "up.example.com"),
+        (url, "up.example.com"),
+        (url, "down.example.com"),
+        (dead, "up.example.com"),
+    ]
+    failures = pmproxy_utils.preflight(targets, timeout=1)
+
+    assert failures == {
+        (url, "down.example.com"): "HTTP 400: no pmcd",
+        (dead, "up.example.com"): "pmproxy unreachable: could not connect",
+    }
+    # One probe per distinct pmproxy and target
+    assert sorted(pmproxy.seen) == [
+        ("/pmapi/context",),
+        ("/pmapi/fetch", "down.example.com"),
+        ("/pmapi/fetch", "up.example.com"),
+    ]
+    # Probes are kept out of the Kibana request stats
+    assert {rec.service for rec in run.requests} == {stats.PMPROXY}
+    assert not run.kibana_requests()
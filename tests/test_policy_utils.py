@@ -0,0 +1,128 @@
+"""Tests for utils/policy_utils.py.
+"""
+
+import configparser
+import json
+
+from utils import policy_utils
+
+POLICIES = ["policy-1", "policy-2", "policy-3"]
+
+
+def group(**kwargs):
+    out = {"pmproxy_url": "http://pmproxy1:44322", "interval": "30s", "metrics": "a"}
+    out.update(kwargs)
+    return out
+
+
+def test_read_policies():
+    web_info = configparser.ConfigParser()
+    assert policy_utils.read_policies(web_info) == []
+    web_info.read_string("[fleet]\npolicies = policy-1, policy-2\n  policy-3\n")
+    assert policy_utils.read_policies(web_info) == POLICIES
+
+
+def test_place_deterministic():
+    first = policy_utils.PolicyPlacer()
+    second = policy_utils.PolicyPlacer()
+    for i in range(50):
+        fqdn = f"host{i}.example.com"
+        assert first.place(fqdn, POLICIES, 2) == second.place(
+            fqdn, list(reversed(POLICIES)), 2
+        )
+    assert sum(first.counts.values()) == 100
+    assert len(first.counts) == 3
+
+
+def test_place_cap():
+    placer = policy_utils.PolicyPlacer(cap=10, counts={"policy-1": 9})
+    for i in range(10):
+        assert placer.place(f"host{i}", POLICIES, 2) is not None
+    assert all(count <= 10 for count in placer.counts.values())
+    assert placer.place("host-last", POLICIES, 2) is None
+    assert placer.placed == {"policy-2": 10, "policy-3": 10}
+
+
+def test_place_nodes():
+    nodes = [
+        {
+            "fqdn": "host1",
+            "groups": [
+                group(policy_id="fixed"),
+                group(policy_pool=["policy-4"]),
+                group(),
+                group(interval="10s"),
+            ],
+        },
+        {"fqdn": "host2", "groups": [group(), group(), group()]},
+    ]
+    errors = []
+    placer = policy_utils.PolicyPlacer(cap=3)
+    placed = list(policy_utils.place_nodes(nodes, placer, POLICIES, errors))
+
+    ids = [group["policy_id"] for group in placed[0]["groups"]]
+    assert ids[:2] == ["fixed", "policy-4"]
+    assert ids[2] == ids[3] and ids[2] in POLICIES
+    assert "policy_pool" not in placed[0]["groups"][1]
+    assert [g["policy_id"] for g in placed[1]["groups"]] != []
+    assert not errors
+
+    nodes = [
+        {
+            "fqdn": "host3",
+            "groups": [group(policy_pool=["policy-4"]) for __ in range(3)],
+        }
+    ]
+    (node,) = policy_utils.place_nodes(nodes, placer, POLICIES, errors)
+    assert node["groups"] == []
+    assert errors == [
+        "host3: could not place 3 group(s) on an agent policy, every policy is full"
+    ]
+
+
+def test_config_policies(tmp_path):
+    config = tmp_path / "create.json"
+    config.write_text(
+        json.dumps(
+            {
+                "templates": {"web": [group(policy_id="policy-1")]},
+                "hosts": [
+                    {"fqdn": "web[1-3].example.com", "template": "web"},
+                    {
+                        "fqdn": "db1.example.com",
+                        "groups": [group(policy_pool=POLICIES)],
+                    },
+                ],
+                "nodes": [
+                    {"fqdn": "host1", "groups": [group(), group(policy_id="gone")]}
+                ],
+            }
+        )
+    )
+    assert policy_utils.config_policies(str(config)) == set(POLICIES) | {"gone"}
+
+
+def test_check_nodes():
+    nodes = [
+        {
+            "fqdn": "host1",
+            "groups": [group(policy_id="policy-1"), group(policy_id="gone")],
+        },
+        {"fqdn": "host2", "groups": [group(policy_id="gone")]},
+    ]
+    errors = []
+    checked = list(policy_utils.check_nodes(nodes, {"policy-1"}, errors))
+
+    assert [len(node["groups"]) for node in checked] == [1, 0]
+    assert errors == ["Agent policy gone does not exist; skipped 2 group(s) using it"]
+
+
+def test_report_counts(policy_factory):
+    idmap = {
+        name: policy_factory(name, policy_id=policy_id)
+        for name, policy_id in [("a", "policy-1"), ("b", "policy-1"), ("c", "p2")]
+    }
+    counts = policy_utils.policy_counts(idmap)
+    assert counts == {"policy-1": 2, "p2": 1}
+    report = policy_utils.report_counts(counts, cap=2)
+    assert report.splitlines()[1].split() == ["p2", "1", "0", "1"]
@@ -0,0 +1,217 @@
+"""Tests for utils/pool_utils.py and modes/rebalance.py.
+"""
+
+import configparser
+import json
+
+import pytest
+
+import main
+from modes import rebalance
+from utils import api_utils, file_utils, policy_utils, pool_utils
+from utils.inventory import Inventory
+
+POOL = [("http://pmproxy1:44322", 1), ("http://pmproxy2:44322", 1)]
+HOSTS = [f"host{i}.example.com" for i in range(400)]
+
+
+def test_parse_pool():
+    assert pool_utils.parse_pool(["http://a:44322/", "http://b:44322=3"]) == [
+        ("http://a:44322", 1),
+        ("http://b:44322", 3),
+    ]
+    for member in ["http://a=0", "http://a=x", "=2"]:
+        with pytest.raises(ValueError):
+            pool_utils.parse_pool([member])
+
+
+def test_read_pool():
+    web_info = configparser.ConfigParser()
+    assert pool_utils.read_pool(web_info) == []
+    web_info.read_string(
+        "[pmproxy]\npool = http://a:44322,\n  http://b:44322=2 http://c:44322\n"
+    )
+    assert pool_utils.read_pool(web_info) == [
+        ("http://a:44322", 1),
+        ("http://b:44322", 2),
+        ("http://c:44322", 1),
+    ]
+
+
+def test_rendezvous_minimal_moves():
+    before = {host: pool_utils.rendezvous(host, POOL) for host in HOSTS}
+    grown = POOL + [("http://pmproxy3:44322", 1)]
+    after = {host: pool_utils.rendezvous(host, grown) for host in HOSTS}
+
+    moved = [host for host in HOSTS if before[host] != after[host]]
+    # Only hosts won by the new member move, about a third of them
+    assert all(after[host] == "http://pmproxy3:44322" for host in moved)
+    assert 80 < len(moved) < 190
+
+
+def test_rendezvous_weighted():
+    pool = [("http://pmproxy1:44322", 1), ("http://pmproxy2:44322", 3)]
+    counts = {}
+    for host in HOSTS:
+        url = pool_utils.rendezvous(host, pool)
+        counts[url] = counts.get(url, 0) + 1
+    assert 250 < counts["http://pmproxy2:44322"] < 350
+
+
+def test_balancer_least_loaded():
+    balancer = pool_utils.Balancer(pool_utils.LEAST_LOADED, {"pmproxy1:44322": 1.0})
+    assert balancer.assign("host1", POOL, 0.5) == "http://pmproxy2:44322"
+    assert balancer.assign("host2", POOL, 0.6) == "http://pmproxy2:44322"
+    assert balancer.assign("host3", POOL, 0.5) == "http://pmproxy1:44322"
+
+
+def test_load_pool_inventory(monkeypatch, policy_factory):
+    def fetch(*args, **kwargs):
+        raise AssertionError("the inventory was fetched again")
+
+    monkeypatch.setattr(api_utils, "generate_map", fetch)
+    inventory = Inventory([policy_factory(".pcp-host1-30s")])
+    args = main.build_parser(
+        ["create", "x.json", "--pmproxy", "http://pmproxy1:44322"]
+        + ["--strategy", "least-loaded", "--policy-cap", "10"]
+    )
+    __, loads = pool_utils.load_pool(args, configparser.ConfigParser(), inventory)
+    assert loads == {"pmproxy1:44322": pool_utils.integration_rate("30s")}
+    web_info = configparser.ConfigParser()
+    __, counts = policy_utils.load_policies(args, web_info, inventory)
+    assert counts == {"policy-1": 1}
+
+
+def test_assign_nodes():
+    group = {"policy_id": "p", "interval": "10s", "metrics": "a.b"}
+    nodes = [
+        {
+            "fqdn": "host1",
+            "groups": [
+                dict(group, pmproxy_url="http://fixed:44322"),
+                dict(group, pmproxy_pool=["http://other:44322"]),
+                dict(group),
+                dict(group, interval="1m"),
+            ],
+        }
+    ]
+    errors = []
+    balancer = pool_utils.Balancer(pool_utils.LEAST_LOADED)
+    (node,) = pool_utils.assign_nodes(nodes, balancer, POOL, errors)
+
+    urls = [group["pmproxy_url"] for group in node["groups"]]
+    assert urls[:2] == ["http://fixed:44322", "http://other:44322"]
+    # A host's groups on the same pool stay together
+    assert urls[2] == urls[3]
+    assert "pmproxy_pool" not in node["groups"][1]
+    assert not errors
+
+    nodes = [{"fqdn": "host1", "groups": [dict(group)]}]
+    (node,) = pool_utils.assign_nodes(nodes, balancer, [], errors)
+    assert node["groups"] == []
+    assert len(errors) == 1
+
+
+def test_plan_moves_hash():
+    placements = [(host, "pmproxy1:44322", 0.1) for host in HOSTS[:20]]
+    targets = pool_utils.plan_moves(placements, POOL)
+    for (host, __, __), target in zip(placements, targets):
+        expected = pool_utils.rendezvous(host, POOL)
+        assert target == (None if expected == "http://pmproxy1:44322" else expected)
+
+
+def test_plan_moves_least_loaded():
+    placements = [(f"host{i}", "pmproxy1:44322", 0.1) for i in range(10)]
+    placements.append(("old1", "retired:44322", 0.1))
+    targets = pool_utils.plan_moves(placements, POOL, pool_utils.LEAST_LOADED)
+
+    assert targets[-1] is not None
+    moved = [target for target in targets if target is not None]
+    assert moved.count("http://pmproxy2:44322") == 5 + (
+        targets[-1] == "http://pmproxy1:44322"
+    )
+    # Balanced placements aren't moved
+    balanced = [("host1", "pmproxy1:44322", 0.1), ("host2", "pmproxy2:44322", 0.1)]
+    assert pool_utils.plan_moves(balanced, POOL, pool_utils.LEAST_LOADED) == [
+        None,
+        None,
+    ]
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = json.dumps(body).encode("utf-8")
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_rebalance(monkeypatch, policy_factory, capsys):
+    policies = [
+        policy_factory(f".pcp-host{i}-30s", host=f"host{i}.example.com")
+        for i in range(20)
+    ]
+    config = configparser.ConfigParser()
+    config.read_dict({"kibana": {"kibana_url": "http://kibana", "api_key": "key"}})
+    sent = []
+    monkeypatch.setattr(file_utils, "read_config", lambda: config)
+    monkeypatch.setattr(
+        api_utils, "send", lambda *args, **kwargs: FakeResponse({"items": policies})
+    )
+    monkeypatch.setattr(api_utils, "request", lambda req, mode: sent.append(req))
+
+    args = main.build_parser(
+        [
+            "rebalance",
+            "--pmproxy",
+            "http://pmproxy1:44322",
+            "--pmproxy",
+            "http://pmproxy2:44322",
+        ]
+    )
+    rebalance.rebalance(args)
+    out = capsys.readouterr().out
+    result = json.loads(out[out.index("{") :])
+
+    assert len(result["updated"]) == len(sent) > 0
+    for req in sent:
+        url = req[3]["inputs"]["generic-httpjson"]["streams"]["httpjson.generic"][
+            "vars"
+        ]["request_url"]
+        host = url.split("hostspec=")[1].split("&")[0]
+        assert url.startswith(pool_utils.rendezvous(host, POOL) + "/pmapi/fetch")
+
+
+def test_rebalance_leaves_other_pmproxies(monkeypatch, policy_factory, capsys):
+    policies = [
+        policy_factory(
+            f".pcp-host{i}-30s",
+            host=f"host{i}.example.com",
+            pmproxy_url="http://pmproxy9:44322",
+        )
+        for i in range(5)
+    ]
+    config = configparser.ConfigParser()
+    config.read_dict({"kibana": {"kibana_url": "http://kibana", "api_key": "key"}})
+    sent = []
+    monkeypatch.setattr(file_utils, "read_config", lambda: config)
+    monkeypatch.setattr(
+        api_utils, "send", lambda *args, **kwargs: FakeResponse({"items": policies})
+    )
+    monkeypatch.setattr(api_utils, "request", lambda req, mode: sent.append(req))
+
+    pool = ["--pmproxy", "http://pmproxy1:44322", "--pmproxy", "http://pmproxy2:44322"]
+    rebalance.rebalance(main.build_parser(["rebalance"] + pool))
+    out = capsys.readouterr().out
+    assert json.loads(out[out.index("{") :])["updated"] == []
+    assert not sent
+
+    rebalance.rebalance(main.build_parser(["rebalance", "--adopt"] + pool))
+    assert len(sent) == 5
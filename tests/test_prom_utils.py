@@ -0,0 +1,57 @@
+"""Tests for utils/prom_utils.py.
+"""
+
+import os
+
+from utils import prom_utils, stats
+
+
+def integration(pmproxy, enabled, metrics, interval="30s", policy_id="policy-1"):
+    return {
+        "pmproxy_url_": pmproxy,
+        "enabled_": enabled,
+        "metrics_": metrics,
+        "interval_": interval,
+        "policy_id": policy_id,
+    }
+
+
+def test_inventory_metrics():
+    idmap = {
+        ".pcp-a-30s": integration("pmproxy1:44322", True, "a.b,c.d"),
+        ".pcp-b-30s": integration("pmproxy1:44322", False, "a.b"),
+        ".pcp-c-1m": integration("pmproxy2:44322", True, "a.b", interval="1m"),
+    }
+    lines = prom_utils.inventory_metrics(idmap)
+    assert 'pcp_integrations{pmproxy="pmproxy1:44322"} 2' in lines
+    assert 'pcp_integrations_enabled{pmproxy="pmproxy1:44322"} 1' in lines
+    assert 'pcp_integration_metrics{pmproxy="pmproxy1:44322"} 3' in lines
+    assert 'pcp_integrations_by_interval{interval="1m"} 1' in lines
+    assert "# TYPE pcp_integrations gauge" in lines
+
+
+def test_run_metrics():
+    run = stats.Stats()
+    run.record("GET", "http://k/api/fleet/package_policies", 200, 1, 0, 0.07)
+    run.record("GET", "http://k/api/fleet/package_policies", 503, 1, 0, 3.0)
+    lines = prom_utils.run_metrics(run, "list")
+    labels = 'mode="list",method="GET",endpoint="/api/fleet/package_policies"'
+    assert f"integrations_request_failures_total{{{labels}}} 1" in lines
+    assert (
+        f'integrations_request_duration_seconds_bucket{{{labels},le="0.1"}} 1' in lines
+    )
+    assert (
+        f'integrations_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    )
+
+
+def test_escape():
+    assert prom_utils.escape('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_write_textfile(tmp_path):
+    path = tmp_path / "integrations.prom"
+    path.write_text("old\n")
+    prom_utils.write_textfile(str(path), ["a 1", "b 2"])
+    assert path.read_text() == "a 1\nb 2\n"
+    assert os.listdir(tmp_path) == ["integrations.prom"]
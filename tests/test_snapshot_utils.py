@@ -0,0 +1,119 @@
+"""Tests for utils/snapshot_utils.py and modes/snapshot.py.
+"""
+
+import gzip
+import json
+
+import pytest
+
+import main
+from modes import snapshot
+from utils import api_utils, file_utils, snapshot_utils
+
+
+def test_write_read(tmp_path, policy_factory):
+    path = str(tmp_path / "snapshots" / "a.jsonl.gz")
+    policies = [policy_factory(f".pcp-host{i}-30s") for i in range(3)]
+    count = snapshot_utils.write(path, (snapshot_utils.entry(p) for p in policies))
+
+    assert count == 3
+    with gzip.open(path, "rt", encoding="utf-8") as infile:
+        assert len(infile.readlines()) == 3
+    entries = list(snapshot_utils.read(path))
+    assert [item["name"] for item in entries] == [p["name"] for p in policies]
+    assert entries[0]["hash"] == snapshot_utils.body_hash(entries[0]["body"])
+    assert not (tmp_path / "snapshots" / "a.jsonl.gz.tmp").exists()
+
+
+def test_write_failure(tmp_path, policy_factory):
+    path = str(tmp_path / "a.jsonl.gz")
+    snapshot_utils.write(path, [snapshot_utils.entry(policy_factory(".pcp-a-30s"))])
+
+    def entries():
+        yield snapshot_utils.entry(policy_factory(".pcp-b-30s"))
+        raise RuntimeError("fetch failed")
+
+    # A failed save leaves the old snapshot alone
+    with pytest.raises(RuntimeError):
+        snapshot_utils.write(path, entries())
+    assert [item["name"] for item in snapshot_utils.read(path)] == [".pcp-a-30s"]
+    assert list(tmp_path.iterdir()) == [tmp_path / "a.jsonl.gz"]
+
+
+def test_diff(policy_factory):
+    old = [
+        snapshot_utils.entry(policy_factory(name))
+        for name in (".pcp-a-30s", ".pcp-b-30s", ".pcp-c-30s")
+    ]
+    new = [
+        snapshot_utils.entry(policy_factory(".pcp-a-30s")),
+        snapshot_utils.entry(policy_factory(".pcp-b-30s", interval="1m")),
+        snapshot_utils.entry(policy_factory(".pcp-d-30s")),
+    ]
+    assert snapshot_utils.diff(iter(old), iter(new)) == {
+        "added": [".pcp-d-30s"],
+        "removed": [".pcp-c-30s"],
+        "changed": [".pcp-b-30s"],
+        "unchanged": 1,
+    }
+
+
+@pytest.fixture
+def kibana(monkeypatch, policy_factory):
+    live = [policy_factory(".pcp-a-30s"), policy_factory(".pcp-b-30s")]
+    monkeypatch.setattr(api_utils, "pcp_policies", lambda key, url: iter(live))
+    monkeypatch.setattr(
+        file_utils,
+        "read_config",
+        lambda: {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}},
+    )
+    return live
+
+
+def test_snapshot_save_diff(tmp_path, kibana, policy_factory, capsys):
+    path = str(tmp_path / "a.jsonl.gz")
+    snapshot.snapshot(main.build_parser(["snapshot", "save", "-o", path]))
+    assert "Saved 2 integration(s)" in capsys.readouterr().out
+
+    kibana[1] = policy_factory(".pcp-b-30s", enabled=False)
+    kibana.append(policy_factory(".pcp-c-30s"))
+    snapshot.snapshot(main.build_parser(["snapshot", "diff", path]))
+    result = json.loads(capsys.readouterr().out)
+    assert result["added"] == [".pcp-c-30s"]
+    assert result["changed"] == [".pcp-b-30s"]
+    assert result["unchanged"] == 1
+
+
+def test_snapshot_diff_unreadable(tmp_path, kibana, capsys):
+    path = tmp_path / "bad.jsonl.gz"
+    path.write_bytes(b"not gzip")
+    with pytest.raises(SystemExit):
+        snapshot.snapshot(main.build_parser(["snapshot", "diff", str(path)]))
+    assert "Could not read snapshot" in capsys.readouterr().err
+
+
+def test_snapshot_restore(tmp_path, kibana, monkeypatch, policy_factory, capsys):
+    path = str(tmp_path / "a.jsonl.gz")
+    names = [".pcp-a-30s", ".pcp-b-30s", ".pcp-c-30s", ".pcp-d-30s"]
+    snapshot_utils.write(
+        path, (snapshot_utils.entry(policy_factory(name)) for name in names)
+    )
+
+    sent = []
+
+    def fake_request(req, mode):
+        sent.append(req)
+        if req[3]["name"] == ".pcp-d-30s":
+            raise api_utils.requests.exceptions.HTTPError("500")
+        return {}
+
+    monkeypatch.setattr(api_utils, "request", fake_request)
+    with pytest.raises(SystemExit):
+        snapshot.snapshot(main.build_parser(["snapshot", "restore", path]))
+
+    result = json.loads(capsys.readouterr().out)
+    assert result["recreated"] == [".pcp-c-30s"]
+    assert result["present"] == 2
+    assert list(result["failed"]) == [".pcp-d-30s"]
+    assert {req[0] for req in sent} == {"POST"}
+    assert sorted(req[3]["id"] for req in sent) == ["id.pcp-c-30s", "id.pcp-d-30s"]
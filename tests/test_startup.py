@@ -0,0 +1,74 @@
+"""Startup-time benchmarks for main.py, based on python -X importtime.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import constants
+
+# Generous, so that slow machines don't fail, but far below
+# what importing requests, jsonschema and the interactive package takes
+BUDGET_US = 150000
+
+HEAVY = ("requests", "jsonschema", "interactive", "urllib3")
+
+
+def import_times(*argv, cwd=None):
+    """Run main.py with python -X importtime, and return a map of
+    each module it imported (after interpreter startup) to its self time in us."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", f"{constants.ROOT_DIR}/main.py", *argv],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=cwd,
+        check=False,
+    )
+
+    times = {}
+    started = False
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, __, name = line[len("import time:") :].split("|")
+        name = name.strip()
+        if not started:
+            # Everything up to and including site is interpreter startup
+            started = name == "site"
+            continue
+        times[name] = int(self_us)
+    return times
+
+
+def heavy_imports(times):
+    return [name for name in times if name.split(".")[0] in HEAVY]
+
+
+def test_help_startup():
+    times = import_times("--help")
+    assert not heavy_imports(times)
+    assert not [name for name in times if name.startswith("utils")]
+    assert sum(times.values()) < BUDGET_US
+
+
+def test_check_config_startup(tmp_path):
+    config = tmp_path / "create.json"
+    config.write_text('{"nodes": []}')
+    times = import_times("create", str(config), "--check-config")
+    # importlib.import_module isn't logged by -X importtime, but its imports are
+    assert "utils.file_utils" in times
+    assert not [
+        name for name in heavy_imports(times) if not name.startswith("jsonschema")
+    ]
+
+
+@pytest.mark.skipif(
+    not os.environ.get("INTEGRATIONS_BENCH"), reason="set INTEGRATIONS_BENCH to run"
+)
+def test_print_startup_times():
+    times = import_times("--help")
+    for name, self_us in sorted(times.items(), key=lambda item: -item[1])[:15]:
+        print(f"{self_us:>8} us  {name}")
@@ -0,0 +1,70 @@
+"""Tests for utils/stats.py.
+"""
+
+import json
+
+import pytest
+
+from utils import stats
+
+
+@pytest.mark.parametrize(
+    "url,endpoint",
+    [
+        (
+            "http://kibana:5601/api/fleet/package_policies",
+            "/api/fleet/package_policies",
+        ),
+        (
+            "https://kibana/api/fleet/package_policies/"
+            "2b6f6bd0-1c2e-11ee-9c3f-0242ac120002?format=simplified",
+            "/api/fleet/package_policies/{id}",
+        ),
+        (
+            "http://kibana/api/fleet/agent_policies?perPage=1",
+            "/api/fleet/agent_policies",
+        ),
+    ],
+)
+def test_endpoint_template(url, endpoint):
+    assert stats.endpoint_template(url) == endpoint
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert stats.percentile(values, 50) == 50
+    assert stats.percentile(values, 99) == 99
+    assert stats.percentile([3], 95) == 3
+    assert stats.percentile([], 50) == 0.0
+
+
+def test_phases():
+    run = stats.Stats()
+    with run.phase("dispatch"):
+        pass
+    assert list(run.timed_iter("config load", [1, 2])) == [1, 2]
+    assert run.phases["dispatch"][1] == 1
+    assert run.phases["config load"][1] == 3
+
+
+def test_report_and_trace(tmp_path):
+    run = stats.Stats()
+    for i in range(10):
+        run.record("PUT", f"http://k/api/fleet/package_policies/{i}", 200, 10, 0, 0.01)
+    run.record("GET", "http://k/api/fleet/package_policies", 500, 100, 0, 0.2, 2)
+
+    report = run.report()
+    assert "PUT /api/fleet/package_policies/{id}" in report
+    assert "11 request(s)" in report and "2 retried" in report
+
+    # Requests to pmproxy are labelled, and left out of the Kibana totals
+    run.record("GET", "http://pmproxy:44322/pmapi/fetch", 200, 10, 0, 5.0, 0, "pmproxy")
+    report = run.report()
+    assert "pmproxy GET /pmapi/fetch" in report
+    assert "11 request(s)" in report
+    assert "1 request(s) to pmproxy are not counted above." in report
+    assert ("GET", "/pmapi/fetch") not in run.latencies()
+
+    trace = tmp_path / "trace.json"
+    run.write_trace(str(trace))
+    assert len(json.loads(trace.read_text())["requests"]) == 12
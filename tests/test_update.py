@@ -0,0 +1,136 @@
+"""Tests for modes/update.py.
+"""
+
+import json
+
+import pytest
+
+import main
+from modes import update
+from utils import api_utils
+
+
+@pytest.fixture
+def name_map(policy_factory):
+    return {
+        name: policy_factory(name, host=f"{name.split('-')[1]}.example.com")
+        for name in [".pcp-web1-30s", ".pcp-web2-30s", ".pcp-db1-30s"]
+    }
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    reqs = []
+    monkeypatch.setattr(api_utils, "request", lambda req, mode: reqs.append(req))
+    return reqs
+
+
+def config():
+    return {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}}
+
+
+def test_batch_update_cli(name_map, sent, capsys):
+    args = main.build_parser(
+        ["update", "--select", "web", "--set", "interval=1m", "--add-metrics", "a.b"]
+    )
+    update.batch_update(args, name_map, config())
+
+    result = json.loads(capsys.readouterr().out)
+    assert result["selected"] == 2
+    assert sorted(result["updated"]) == [".pcp-web1-30s", ".pcp-web2-30s"]
+    assert all(
+        req[3]["inputs"]["generic-httpjson"]["streams"]["httpjson.generic"]["vars"][
+            "request_interval"
+        ]
+        == "1m"
+        for req in sent
+    )
+
+
+def test_batch_update_file(name_map, sent, capsys, tmp_path):
+    batch = tmp_path / "batch.json"
+    batch.write_text(
+        json.dumps(
+            {
+                "operations": [
+                    {"select": "db1", "enabled": True},
+                    {"select": "web1", "remove_metrics": "mem.util.used"},
+                ]
+            }
+        )
+    )
+    args = main.build_parser(["update", "--file", str(batch)])
+    update.batch_update(args, name_map, config())
+
+    result = json.loads(capsys.readouterr().out)
+    assert result["updated"] == [".pcp-web1-30s"]
+    assert result["unchanged"] == [".pcp-db1-30s"]
+    assert len(sent) == 1
+
+
+def test_batch_update_invalid(name_map, sent):
+    args = main.build_parser(["update", "--select", "web", "--set", "interval=1x"])
+    with pytest.raises(SystemExit):
+        update.batch_update(args, name_map, config())
+    assert not sent
+
+
+def test_batch_update_conflict(name_map, monkeypatch, policy_factory, capsys):
+    # Someone else adds a metric to web1 after it was fetched
+    current = policy_factory(
+        ".pcp-web1-30s",
+        host="web1.example.com",
+        metrics="kernel.all.load,mem.util.used,disk.all.read",
+    )
+    current["version"] = "WzIsMV0="
+    sent = []
+
+    def fake_request(req, mode):
+        sent.append(req)
+        if req[3]["version"] != current["version"]:
+            response = type("Response", (), {"status_code": 409})()
+            raise api_utils.requests.exceptions.HTTPError("409", response=response)
+        return {"version": "WzMsMV0="}
+
+    refetched = []
+
+    def fake_bulk_get(key, url, ids):
+        refetched.append(list(ids))
+        return [dict(current)] if current["id"] in ids else []
+
+    monkeypatch.setattr(api_utils, "request", fake_request)
+    monkeypatch.setattr(api_utils, "bulk_get", fake_bulk_get)
+    args = main.build_parser(
+        ["update", "--select", "web1", "--set", "interval=1m", "--add-metrics", "a.b"]
+    )
+    update.batch_update(args, name_map, config())
+
+    result = json.loads(capsys.readouterr().out)
+    assert result["updated"] == [".pcp-web1-30s"] and not result["failed"]
+    # Only the conflicted policy is fetched again, in one batch
+    assert refetched == [["id.pcp-web1-30s"]]
+    assert len(sent) == 2
+    stream = sent[-1][3]["inputs"]["generic-httpjson"]["streams"]["httpjson.generic"]
+    assert stream["vars"]["request_interval"] == "1m"
+    assert stream["vars"]["request_url"].endswith(
+        "names=kernel.all.load,mem.util.used,disk.all.read,a.b"
+    )
+
+
+def test_batch_update_journal(name_map, sent, capsys):
+    from utils import journal
+    from utils.journal import JOURNAL
+
+    args = main.build_parser(["update", "--select", "web", "--set", "interval=1m"])
+    update.batch_update(args, name_map, config())
+    JOURNAL.close()
+
+    entries = journal.load(JOURNAL.run_id, JOURNAL.directory)
+    assert sorted(entry["name"] for entry in entries) == [
+        ".pcp-web1-30s",
+        ".pcp-web2-30s",
+    ]
+    # The journal holds the integrations as they were before the update
+    for entry in entries:
+        stream = entry["body"]["inputs"]["generic-httpjson"]["streams"]
+        assert stream["httpjson.generic"]["vars"]["request_interval"] == "30s"
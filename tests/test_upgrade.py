@@ -0,0 +1,142 @@
+"""Tests for modes/upgrade.py.
+"""
+
+import json
+
+import pytest
+
+import main
+from modes import upgrade
+from utils import api_utils, file_utils, journal
+from utils.dryrun_utils import DRY_RUN
+from utils.journal import JOURNAL
+
+
+class JSONResponse:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+        self.content = json.dumps(body).encode("utf-8")
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise api_utils.requests.exceptions.HTTPError(str(self.status_code))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def kibana(monkeypatch, policy_factory):
+    """Serve an inventory where host0 is up to date, host5 is on a newer
+    version and host3 can't be upgraded, recording the bulk requests sent.
+    Dry run results come back in reverse order."""
+    policies = [
+        policy_factory(f".pcp-host{i}-30s", host=f"host{i}.example.com")
+        for i in range(6)
+    ]
+    policies[0]["package"]["version"] = "1.21.0"
+    policies[5]["package"]["version"] = "1.22.0"
+    bulk = []
+
+    def fake_send(method, url, **kwargs):
+        if url.endswith("/epm/packages/httpjson"):
+            return JSONResponse({"item": {"installationInfo": {"version": "1.21.0"}}})
+        if method == "GET":
+            return JSONResponse({"items": policies})
+        if url.endswith("/_bulk_get"):
+            wanted = kwargs["json"]["ids"]
+            return JSONResponse(
+                {"items": [policy for policy in policies if policy["id"] in wanted]}
+            )
+        ids = kwargs["json"]["packagePolicyIds"]
+        bulk.append((url.rsplit("/", 1)[1], ids))
+        if url.endswith("/dryrun"):
+            return JSONResponse(
+                [
+                    {
+                        "hasErrors": id_ == "id.pcp-host3-30s",
+                        "packagePolicy": {"id": id_},
+                        "body": {"message": "conflict"},
+                    }
+                    for id_ in reversed(ids)
+                ]
+            )
+        return JSONResponse([{"id": id_, "success": True} for id_ in ids])
+
+    monkeypatch.setattr(api_utils, "send", fake_send)
+    monkeypatch.setattr(api_utils, "_package_versions", {})
+    # Dry runs are disabled again after the test
+    monkeypatch.setattr(DRY_RUN, "enabled", False)
+    monkeypatch.setattr(DRY_RUN, "calls", [])
+    monkeypatch.setattr(
+        file_utils,
+        "read_config",
+        lambda: {"kibana": {"kibana_url": "http://kibana", "api_key": "key"}},
+    )
+    return bulk
+
+
+def test_upgrade(kibana, capsys):
+    args = main.build_parser(["upgrade", "--chunk-size", "2"])
+    with pytest.raises(SystemExit):
+        upgrade.upgrade(args)
+
+    result = json.loads(capsys.readouterr().out)
+    assert result["version"] == "1.21.0"
+    assert result["current"] == [".pcp-host0-30s"]
+    assert result["newer"] == [".pcp-host5-30s"]
+    assert result["failed"] == {".pcp-host3-30s": "conflict"}
+    assert result["upgraded"] == [
+        ".pcp-host1-30s",
+        ".pcp-host2-30s",
+        ".pcp-host4-30s",
+    ]
+    assert [kind for kind, __ in kibana] == ["dryrun"] * 2 + ["upgrade"] * 2
+    assert all(len(ids) <= 2 for __, ids in kibana)
+
+    # The upgraded policies can be rolled back
+    JOURNAL.close()
+    entries = journal.load(JOURNAL.run_id, JOURNAL.directory)
+    assert sorted(entry["name"] for entry in entries) == result["upgraded"]
+    assert {entry["body"]["package"]["version"] for entry in entries} == {"1.20.0"}
+
+
+def test_parse_version():
+    assert upgrade.parse_version("1.21.0") > upgrade.parse_version("1.20.10")
+    assert upgrade.parse_version("1.21.0") > upgrade.parse_version("1.21.0-beta1")
+    assert upgrade.parse_version("1.21") == upgrade.parse_version("1.21.0")
+
+
+def test_upgrade_dry_run(kibana, capsys):
+    args = main.build_parser(["upgrade", "--select", "host[12]", "--dry-run"])
+    upgrade.upgrade(args)
+
+    captured = capsys.readouterr()
+    result = json.loads(captured.out)
+    assert result["planned"] == [".pcp-host1-30s", ".pcp-host2-30s"]
+    assert [kind for kind, __ in kibana] == ["dryrun"]
+    assert "POST http://kibana/api/fleet/package_policies/upgrade" in captured.err
+
+
+def test_create_uses_installed_version(kibana):
+    version = api_utils.package_version("key", "http://kibana")
+    __, __, __, body = api_utils.build_request(
+        {"api_key": "key", "kibana_url": "http://kibana", "package_version": version},
+        "create",
+        {
+            "fqdn": "host1.example.com",
+            "policy_id": "policy-1",
+            "pmproxy_url": "http://pmproxy1:44322",
+            "interval": "30s",
+            "metrics": "kernel.all.load",
+        },
+    )
+    assert body["package"] == {"name": "httpjson", "version": "1.21.0"}